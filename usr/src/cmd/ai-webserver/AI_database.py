@@ -25,9 +25,56 @@ A/I Database Routines
 
 """
 
+import binascii
+import bisect
+from collections import OrderedDict
+import marshal
+import os
 import Queue
 from sqlite3 import dbapi2 as sqlite
+import sys
 import threading
+import time
+
+import osol_install.auto_install.server_stats as server_stats
+
+# number of prepared statements each DBthread connection keeps for reuse;
+# queries bind their values as parameters so their SQL text repeats
+STATEMENT_CACHE = 256
+
+# version of the manifests table layout, recorded in the database's
+# user_version; version 0 databases predate the criteria indexes and
+# version 1 databases store mac addresses as blobs and IPv4 addresses as
+# zero-padded decimal digits rather than as integers
+SCHEMA_VERSION = 2
+
+# the schema version from which mac and IPv4 addresses are stored as
+# integers (see upgradeDB())
+INTEGER_ADDRESS_VERSION = 2
+
+# name of the compiled criteria index written next to the database by the
+# commands changing it (see writeCriteriaIndex()), and the magic string and
+# format version heading it; version 1 indexes do not record the stamp of
+# the database they were compiled from
+INDEX_FILE = "AI.idx"
+INDEX_MAGIC = "AI criteria index"
+INDEX_VERSION = 2
+
+# seconds a DBrequest may take, from its creation, before its caller gives
+# up on it (arbitrary, to prevent possible deadlock)
+DEFAULT_TIMEOUT = 15
+
+class DBError(Exception):
+    """
+    Raised for a DBrequest which failed in the database
+    """
+    pass
+
+class DBTimeout(DBError):
+    """
+    Raised for a DBrequest which was not answered before its deadline
+    """
+    pass
 
 class DB:
     """
@@ -35,22 +82,87 @@ class DB:
     """
 
 
-    def __init__(self, db, commit=False):
+    def __init__(self, db, commit=False, readers=1, stats=None):
         """
-        Here we initialize the queue the DB thread will run, the DB
-        thread itself (as well as daemonize it, and start it)
+        Here we initialize the queue the DB thread(s) will run, the DB
+        thread(s) themselves (as well as daemonize them, and start them).
+        With more than one reader a pool of read-only DB threads, each with
+        its own connection, services queries in parallel (the database is put
+        in WAL mode so readers do not block each other or a writer) and a
+        single dedicated writer thread handles requests needing a commit.
+        The DB threads account the requests they run in stats, a DBstats
+        object, if given.
         """
-        self._requests = Queue.Queue()
-        self._runner = DBthread(db, self._requests, commit)
-        self._runner.setDaemon(True)
-        self._runner.start()
+        self._dBfile = db
+        self._metadata = DBmetadata(db)
+        self._commit = commit
+        self._stats = stats
+        reads = Queue.Queue()
+        if readers > 1:
+            if commit:
+                writes = Queue.Queue()
+            else:
+                # let the readers refuse any commit requests
+                writes = reads
+            self._runners = [DBthread(db, reads, False, wal=True,
+                                      stats=stats)
+                             for i in range(readers)]
+            # commit requests are only ever serviced by one connection
+            if commit:
+                self._runners.append(DBthread(db, writes, True, wal=True,
+                                              metadata=self._metadata,
+                                              stats=stats))
+        else:
+            writes = reads
+            self._runners = [DBthread(db, reads, commit,
+                                      metadata=self._metadata, stats=stats)]
+        self._requests = DBqueue(reads, writes, self._metadata, stats)
+        for runner in self._runners:
+            runner.setDaemon(True)
+            runner.start()
 
     def getQueue(self):
         return self._requests
 
+    def executeMany(self, requests):
+        """
+        Submits each of requests (DBrequests or SQL query strings) before
+        waiting on any of them, so independent queries are pipelined (and
+        serviced in parallel by a pool of readers). Returns the DBrequests
+        once each has finished or passed its deadline.
+        """
+        requests = [request if isinstance(request, DBrequest)
+                    else DBrequest(request) for request in requests]
+        for request in requests:
+            self._requests.put(request)
+        for request in requests:
+            request.waitAns()
+        return requests
+
+    def getMetadata(self):
+        return self._metadata
+
+    def getStats(self):
+        return self._stats
+
+    def close(self):
+        """
+        Stops the DB thread(s) once the requests already queued have run,
+        closing their connections, and waits for them to finish
+        """
+        for runner in self._runners:
+            runner.getQueue().put(None)
+        for runner in self._runners:
+            runner.join()
+
     def verifyDBStructure(self):
         """
-        Ensures reasonable DB schema and columns or else raises a SystemExit
+        Ensures reasonable DB schema and columns or else raises a SystemExit.
+        A database with an older schema version is upgraded in place,
+        through a connection of its own (closed once done) for a read-only
+        DB (i.e. the webserver of an install service enabled after a package
+        update), as older layouts can not be read. The database is refused
+        only if it can not be upgraded.
         """
         # get the names of each table in the database
         query = DBrequest("SELECT * FROM SQLITE_MASTER")
@@ -79,21 +191,202 @@ class DB:
             len(columns) < 3:
             raise SystemExit(_("Error:\tDatabase columns appear malformed"))
 
+        # bring an older database up to date
+        version = getSchemaVersion(self._requests)
+        if version >= SCHEMA_VERSION:
+            return
+        if self._commit:
+            upgradeDB(self._requests)
+            return
+        upgrader = DB(self._dBfile, commit=True)
+        try:
+            upgradeDB(upgrader.getQueue())
+        except SystemExit, err:
+            raise SystemExit(_("Error:\tDatabase schema version %d is "
+                               "out of date and could not be upgraded; "
+                               "run installadm upgrade-db\n%s") %
+                             (version, err))
+        finally:
+            upgrader.close()
+
+class DBqueue(object):
+    """
+    Class to hand DBrequests to the DB thread(s); requests needing a commit
+    go to the writer's queue and all others to the readers' queue (both
+    queues are the same when a single DB thread is running)
+    """
+
+
+    def __init__(self, reads, writes=None, metadata=None, stats=None):
+        """
+        Store the Queue.Queue objects the DB thread(s) read requests from,
+        the DBmetadata cache of the database they run against and the
+        DBstats (if any) accounting the requests queued
+        """
+        self._reads = reads
+        if writes is None:
+            writes = reads
+        self._writes = writes
+        self._metadata = metadata
+        self._stats = stats
+
+    def getReadQueue(self):
+        """ Use getReadQueue() to access the queue of read-only requests. """
+        return(self._reads)
+
+    def getWriteQueue(self):
+        """ Use getWriteQueue() to access the queue of commit requests. """
+        return(self._writes)
+
+    def getMetadata(self):
+        """ Use getMetadata() to access the database's DBmetadata cache. """
+        return(self._metadata)
+
+    def put(self, request, block=True, timeout=None):
+        """
+        Use put() to queue a DBrequest for the appropriate DB thread(s)
+        """
+        if request is not None and self._stats is not None:
+            self._stats.queued(request)
+        if request is not None and request.needsCommit():
+            self._writes.put(request, block, timeout)
+        else:
+            self._reads.put(request, block, timeout)
+
+    def qsize(self):
+        """ Use qsize() to get the number of requests waiting to be run. """
+        if self._writes is self._reads:
+            return(self._reads.qsize())
+        return(self._reads.qsize() + self._writes.qsize())
+
+class DBmetadata(object):
+    """
+    Class to cache the criteria columns of the manifests table, whether each
+    is a range or value criteria and whether each is in use by any manifest.
+    The cache is invalidated when a request commits through a DB thread, or
+    when the database file changes underneath us (i.e. another process
+    publishes a manifest).
+    """
+
+
+    def __init__(self, db):
+        """
+        Track the DB filename and start with an empty cache
+        """
+        self._dBfile = db
+        # tuple of (database stamp, criteria columns, used columns)
+        self._cache = None
+        # bumped on every invalidation so a cache built across a commit
+        # is not kept
+        self._generation = 0
+
+    def invalidate(self):
+        """
+        Use invalidate() to drop the cached metadata
+        """
+        self._generation += 1
+        self._cache = None
+
+    def getColumns(self, queue, onlyUsed=False):
+        """
+        Use getColumns() to get the criteria column names of the manifests
+        table (in table order), only those in use if onlyUsed is True.
+        Queries are run through queue when the cache needs to be rebuilt.
+        """
+        stamp = getDBStamp(self._dBfile)
+        cache = self._cache
+        if cache is None or cache[0] != stamp:
+            generation = self._generation
+            cache = (stamp,) + self._load(queue)
+            if generation == self._generation:
+                self._cache = cache
+        if onlyUsed:
+            return cache[2]
+        return cache[1]
+
+    def _load(self, queue):
+        """
+        Read the criteria columns and which are in use from the database
+        """
+        # first get the names of the columns (criteria) by using the SQL
+        # PRAGMA statement on the manifest table
+        query = DBrequest("PRAGMA table_info(manifests)")
+        queue.put(query)
+        query.waitAns()
+
+        # skip the manifest name and instance column as they are not criteria
+        columns = [str(col['name']) for col in query.getResponse()
+                   if col['name'] not in ("name", "instance")]
+        if not columns:
+            return (columns, columns)
+
+        # use the SQL COUNT() aggregator to determine which criteria are in
+        # use with a query like:
+        # "SELECT COUNT(memMIN), COUNT(memMAX), ... FROM manifests"
+        query = DBrequest("SELECT " +
+                          ", ".join(["COUNT(" + col + ") as " + col
+                                     for col in columns]) +
+                          " FROM manifests")
+        queue.put(query)
+        query.waitAns()
+        counts = query.getResponse()[0]
+        return (columns, [col for col in columns if counts[col] > 0])
+
+class DBstats(server_stats.StatsGroup):
+    """
+    Class accounting the requests DB threads run: how long they waited to
+    be run and the depth of the queue when they were, and the time spent
+    running them (executing the SQL and fetching its results), so the time
+    a caller spends in the database can be told apart from its own.
+    """
+
+
+    def __init__(self):
+        server_stats.StatsGroup.__init__(self, "ai_db_",
+            counters=("requests", "errors", "seconds"),
+            histograms=(("wait_seconds", server_stats.SECONDS_BUCKETS),
+                        ("run_seconds", server_stats.SECONDS_BUCKETS),
+                        ("queue_depth", server_stats.COUNT_BUCKETS)))
+
+    def queued(self, request):
+        """ Notes the DBrequest request being queued """
+        request.setQueued(time.time())
+
 class DBrequest(object):
     """
     Class to hold SQL queries and their responses
     """
 
 
-    def __init__(self, query, commit=False):
+    def __init__(self, query, commit=False, params=None, timeout=None,
+                 callback=None):
         """
-        Set the private SQL query and create the event to flag when
-        the query has returned.
+        Set the private SQL query (and any parameters to bind to its
+        placeholders) and create the event to flag when the query has
+        returned. The request's deadline is timeout seconds from now
+        (DEFAULT_TIMEOUT if not given); a DB thread which reaches the
+        request after its deadline fails it rather than running it.
+        callback, if given, is called with the request once it finishes; an
+        exception it raises is re-raised by getResponse() and getResult().
         """
         self._sql = str(query)
+        if params is None:
+            params = ()
+        self._params = params
         self._e = threading.Event()
         self._ans = None
         self._committable = commit
+        if timeout is None:
+            timeout = DEFAULT_TIMEOUT
+        self._deadline = time.time() + timeout
+        self._lock = threading.Lock()
+        self._callbacks = list()
+        if callback is not None:
+            self._callbacks.append(callback)
+        self._queued = None
+        # exc_info() of the first error raised by Python code run for the
+        # request (a failed callback, or a DBtransaction's function)
+        self._error = None
 
     def needsCommit(self):
         """
@@ -105,21 +398,92 @@ class DBrequest(object):
         """ Use getSql() to access the SQL query string. """
         return(self._sql)
 
+    def setQueued(self, when):
+        """ Use setQueued() to note when the request was queued. """
+        self._queued = when
+
+    def getQueued(self):
+        """
+        Use getQueued() to get when the request was queued (if noted).
+        """
+        return(self._queued)
+
+    def getParams(self):
+        """ Use getParams() to access the parameters bound to the query. """
+        return(self._params)
+
+    def isExpired(self):
+        """ Use isExpired() to determine if the deadline has passed. """
+        return(time.time() > self._deadline)
+
+    def addCallback(self, callback):
+        """
+        Use addCallback() to have callback called with the request once it
+        finishes (immediately, in the caller's thread, if it already has --
+        any exception it raises is then passed on to the caller).
+        """
+        self._lock.acquire()
+        try:
+            if not self._e.isSet():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+        callback(self)
+
+    def _runCallback(self, callback):
+        """
+        Call callback, recording the first error raised for getResponse()
+        and getResult() to re-raise (it would be lost in the DB thread).
+        """
+        try:
+            callback(self)
+        except Exception:
+            self.setError(sys.exc_info())
+
+    def setError(self, excInfo):
+        """
+        Use setError() to record the exc_info() of an error raised running
+        Python code for the request, for getResponse() and getResult() to
+        re-raise (only the first error is kept).
+        """
+        if self._error is None:
+            self._error = excInfo
+
+    def _raiseError(self):
+        """ Re-raise the error recorded by setError(), if any. """
+        if self._error is not None:
+            (errType, errValue, errTraceback) = self._error
+            raise errType, errValue, errTraceback
+
     def setResponse(self, resp):
         """
         Use setResponse() to set the DB response and update the event flag.
         (Will throw a RuntimeError if already set.)
         """
-        if self._e.isSet():
-            raise RuntimeError('Setting already set value')
-        self._ans = resp
-        self._e.set()
+        self._lock.acquire()
+        try:
+            if self._e.isSet():
+                raise RuntimeError('Setting already set value')
+            self._ans = resp
+            self._e.set()
+            callbacks = self._callbacks
+            self._callbacks = list()
+        finally:
+            self._lock.release()
+        for callback in callbacks:
+            self._runCallback(callback)
 
     def getResponse(self):
         """
-        Use getResponse() to retrieve the DB response. (Will throw a
-        NameError if not yet set.)
+        Use getResponse() to retrieve the DB response. Errors are printed,
+        or, for a request needing a commit, raised as a DBError (a
+        DBTimeout if the response is not yet set). The error of a failed
+        callback is re-raised.
         """
+        if self._committable:
+            return(self.getResult(wait=False))
+        self._raiseError()
         # ensure the DBrequest's event is set and that _ans is a PySQLite list
         if self._e.isSet() and isinstance(self._ans, list):
             return(self._ans)
@@ -129,6 +493,24 @@ class DBrequest(object):
         else:
             print _("Value not yet set")
 
+    def getResult(self, wait=True):
+        """
+        Use getResult() to wait (unless wait is False) for the DB response
+        and retrieve it.
+        Raises DBTimeout if the response is not set by the deadline, the
+        error recorded by setError() (i.e. of a failed callback) and DBError
+        if the query failed.
+        """
+        if wait:
+            self.waitAns()
+        if not self._e.isSet():
+            raise DBTimeout(_("Database failure with SQL: %s") % self._sql +
+                            "\n\t" + _("Error: Value not yet set"))
+        self._raiseError()
+        if isinstance(self._ans, basestring):
+            raise DBError(self._ans)
+        return(self._ans)
+
     def isFinished(self):
         """
         finished() is similar to getResponse() allowing one to determine if the
@@ -138,10 +520,110 @@ class DBrequest(object):
 
     def waitAns(self):
         """
-        Use waitAns() to wait for setResponse() to set the event
+        Use waitAns() to wait, until the deadline at most, for setResponse()
+        to set the event. Returns True if the response is set.
+        """
+        self._e.wait(max(self._deadline - time.time(), 0))
+        return(self._e.isSet())
+
+class DBbatch(DBrequest):
+    """
+    Class to hold an SQL statement to run once for each of a list of
+    parameter tuples, committed as a single transaction: either every row
+    is applied or, on any error, none are
+    """
+
+
+    def __init__(self, query, paramsList, timeout=None, callback=None):
+        """
+        Set up the committing DBrequest and the parameter tuples to run the
+        query with
+        """
+        super(DBbatch, self).__init__(query, commit=True, timeout=timeout,
+                                      callback=callback)
+        self._paramsList = list(paramsList)
+
+    def getParamsList(self):
+        """ Use getParamsList() to access each row's parameters. """
+        return(self._paramsList)
+
+class DBtransaction(DBrequest):
+    """
+    Class to run a function against the database in one IMMEDIATE
+    transaction of the writer's connection, so no other connection (or
+    process) can write between the reads and writes it makes
+    """
+
+
+    def __init__(self, function, timeout=None, callback=None):
+        """
+        function is called with the DB thread's cursor (rows are accessible
+        by index and column name) and may not queue other DBrequests (the DB
+        thread would wait on itself). The transaction is committed if
+        function returns, its return value (which may not be a string) being
+        the response; if function raises, the transaction is rolled back and
+        the error is re-raised by getResponse() and getResult().
+        """
+        super(DBtransaction, self).__init__(function.__name__, commit=True,
+                                            timeout=timeout,
+                                            callback=callback)
+        self._function = function
+
+    def getFunction(self):
+        """ Use getFunction() to access the function to run. """
+        return(self._function)
+
+class DBstream(DBrequest):
+    """
+    Class to hold an SQL query whose response rows are streamed back from
+    the DB thread in batches; iterate over the DBstream for the rows
+    """
+
+
+    def __init__(self, query, params=None, batch=256):
         """
-        # 15 second timeout is arbitrary to prevent possible deadlock
-        self._e.wait(15)
+        Set up the DBrequest and the queue of row batches, of batch rows
+        each, the DB thread will fill
+        """
+        super(DBstream, self).__init__(query, params=params)
+        self._batch = batch
+        self._batches = Queue.Queue()
+
+    def getBatchSize(self):
+        """ Use getBatchSize() to access the number of rows per batch. """
+        return(self._batch)
+
+    def putBatch(self, rows):
+        """ Use putBatch() to hand the caller a batch of rows. """
+        self._batches.put(rows)
+
+    def setResponse(self, resp):
+        """
+        Use setResponse() to flag the end of the rows (resp being an empty
+        list, or an error string)
+        """
+        super(DBstream, self).setResponse(resp)
+        self._batches.put(None)
+
+    def __iter__(self):
+        """
+        Provides each row of the response as its batch arrives
+        """
+        while True:
+            try:
+                # wait as long for each batch as a DBrequest may take to
+                # prevent possible deadlock
+                rows = self._batches.get(True, DEFAULT_TIMEOUT)
+            except Queue.Empty:
+                print _("Value not yet set")
+                return
+            if rows is None:
+                break
+            for row in rows:
+                yield row
+        # in case there's an error call the response function (which will
+        # print the error)
+        self.getResponse()
 
 class DBthread(threading.Thread):
     """
@@ -149,16 +631,28 @@ class DBthread(threading.Thread):
     """
 
 
-    def __init__(self, db, queue, commit):
+    def __init__(self, db, queue, commit, wal=False, metadata=None,
+                 stats=None):
         """
         Here we create a new thread object, create a DB connection object, keep
-        track of the DB filename and track the request queue to run on.
+        track of the DB filename and track the request queue to run on. If wal
+        is True the database is switched to write-ahead logging so that this
+        connection may read concurrently with other connections. The
+        metadata DBmetadata cache (if any) is invalidated on each commit and
+        the requests run are accounted in the stats DBstats (if any).
         """
         threading.Thread.__init__(self)
         self._con = None
         self._dBfile = db
         self._requests = queue
         self._committable = commit
+        self._wal = wal
+        self._metadata = metadata
+        self._stats = stats
+
+    def getQueue(self):
+        """ Use getQueue() to access the queue of requests this thread runs """
+        return self._requests
 
     def __del__(self):
         """ On destruction, close the DB connection if still open """
@@ -175,80 +669,168 @@ class DBthread(threading.Thread):
             # the DB while we are working on it (but don't use EXCLUSIVE since
             # there may be persistent readers)
             self._con = sqlite.connect(self._dBfile,
-                                       isolation_level="IMMEDIATE")
+                                       isolation_level="IMMEDIATE",
+                                       cached_statements=STATEMENT_CACHE)
         else:
-            self._con = sqlite.connect(self._dBfile)
+            self._con = sqlite.connect(self._dBfile,
+                                       cached_statements=STATEMENT_CACHE)
+        if self._wal:
+            # the journal mode is persistent in the database file so this
+            # only needs to succeed once; a busy or read-only database
+            # keeps its current mode
+            try:
+                self._con.execute("PRAGMA journal_mode=WAL")
+            except sqlite.Error:
+                pass
+        if not self._committable:
+            # ensure a reader can not modify the database (older SQLite
+            # versions silently ignore this pragma)
+            self._con.execute("PRAGMA query_only=1")
         # allow access by both index and column name
         self._con.row_factory = sqlite.Row
         self._cursor = self._con.cursor()
-        # iterate over each DBrequest object in the queue
+        # iterate over each DBrequest object in the queue until handed None
+        # (see DB.close())
         while True:
             request = self._requests.get()
+            if request is None:
+                break
             # skip already processed DBrequest's
-            if request is not None and not request.isFinished():
-                # if the connection and query are committable then execute the
-                # query and commit it
-                if request.needsCommit() and self._committable:
-                    try:
-                        self._cursor.execute(request.getSql())
-                        self._con.commit()
-                    except Exception, e:
-                        # save error string for caller to trigger
-                        request.setResponse(_("Database failure with SQL: %s") %
-                                            request.getSql() +
-                                            "\n\t" +
-                                            _("Error: %s") % str(e))
-                        # ensure we do not continue processing this request
-                        continue
-                # the query does not need to commit
-                elif not request.needsCommit():
-                    try:
-                        self._cursor.execute(request.getSql())
-                    except Exception, e:
-                        # save error string for caller to trigger
-                        request.setResponse(_("Database failure with SQL: %s") %
-                                            request.getSql() +
-                                            "\n\t" +
-                                            _("Error: %s") % str(e))
-                        # ensure we do not continue processing this request
-                        continue
-                # the query needs commit access and the connection does not
-                # support it
-                else:
-                    # save error string for caller to trigger
-                    request.setResponse(_("Database failure with SQL: %s") %
-                                        request.getSql() +
-                                        "\n\t" +
-                                        _("Error: Connection not committable"))
-                    # ensure we do not continue processing this request
+            if not request.isFinished():
+                if self._stats is None:
+                    self._run(request)
                     continue
-                request.setResponse(self._cursor.fetchall())
+                started = time.time()
+                depth = self._requests.qsize()
+                succeeded = self._run(request)
+                finished = time.time()
+                self._stats.count(requests=1, errors=int(not succeeded),
+                                  seconds=finished - started)
+                self._stats.observe(queue_depth=depth,
+                                    run_seconds=finished - started)
+                if request.getQueued() is not None:
+                    self._stats.observe(wait_seconds=started -
+                                        request.getQueued())
+        self._con.close()
+        self._con = None
+
+    def _run(self, request):
+        """
+        Runs request, setting its response (or error string).  Returns
+        False if the request failed.
+        """
+        # fail requests whose caller has already given up on them
+        if request.isExpired():
+            request.setResponse(_("Database failure with SQL: %s") %
+                                request.getSql() +
+                                "\n\t" +
+                                _("Error: Deadline expired"))
+            return False
+        if isinstance(request, DBtransaction) and self._committable:
+            return self._runTransaction(request)
+        # if the connection and query are committable then execute the
+        # query and commit it
+        if request.needsCommit() and self._committable:
+            try:
+                if isinstance(request, DBbatch):
+                    self._cursor.executemany(request.getSql(),
+                        request.getParamsList())
+                else:
+                    self._cursor.execute(request.getSql(),
+                                         request.getParams())
+                self._con.commit()
+                if self._metadata is not None:
+                    self._metadata.invalidate()
+            except Exception, e:
+                # do not leave a partial transaction open for the
+                # next request to commit
+                self._con.rollback()
+                # save error string for caller to trigger
+                request.setResponse(_("Database failure with SQL: %s") %
+                                    request.getSql() +
+                                    "\n\t" +
+                                    _("Error: %s") % str(e))
+                # ensure we do not continue processing this request
+                return False
+        # the query does not need to commit
+        elif not request.needsCommit():
+            try:
+                self._cursor.execute(request.getSql(),
+                                     request.getParams())
+            except Exception, e:
+                # save error string for caller to trigger
+                request.setResponse(_("Database failure with SQL: %s") %
+                                    request.getSql() +
+                                    "\n\t" +
+                                    _("Error: %s") % str(e))
+                # ensure we do not continue processing this request
+                return False
+        # the query needs commit access and the connection does not
+        # support it
+        else:
+            # save error string for caller to trigger
+            request.setResponse(_("Database failure with SQL: %s") %
+                                request.getSql() +
+                                "\n\t" +
+                                _("Error: Connection not committable"))
+            # ensure we do not continue processing this request
+            return False
+        if isinstance(request, DBstream):
+            # hand the rows back in batches as they are read so the
+            # caller can start on them before the query completes
+            rows = self._cursor.fetchmany(request.getBatchSize())
+            while rows:
+                request.putBatch(rows)
+                rows = self._cursor.fetchmany(request.getBatchSize())
+            request.setResponse(list())
+        else:
+            request.setResponse(self._cursor.fetchall())
+        return True
+
+    def _runTransaction(self, request):
+        """
+        Runs the function of the DBtransaction request in an IMMEDIATE
+        transaction, setting its response (or error).  Returns False if
+        the request failed.
+        """
+        isolation = self._con.isolation_level
+        # begin and end the transaction ourselves (the connection would
+        # otherwise only begin one on the first data modifying statement)
+        self._con.isolation_level = None
+        try:
+            try:
+                self._cursor.execute("BEGIN IMMEDIATE")
+                response = request.getFunction()(self._cursor)
+                self._cursor.execute("COMMIT")
+            # the function may raise SystemExit (i.e. on a criteria
+            # collision) which must not end the DB thread
+            except BaseException, e:
+                try:
+                    self._cursor.execute("ROLLBACK")
+                except sqlite.Error:
+                    # BEGIN failed so there is nothing to roll back
+                    pass
+                request.setError(sys.exc_info())
+                request.setResponse(_("Database failure with SQL: %s") %
+                                    request.getSql() +
+                                    "\n\t" +
+                                    _("Error: %s") % str(e))
+                return False
+        finally:
+            self._con.isolation_level = isolation
+        if self._metadata is not None:
+            self._metadata.invalidate()
+        request.setResponse(response)
+        return True
+
 #
 # Functions below here
 #
 
-def sanitizeSQL(s):
-    """
-    Use to remove special SQL characters which could cause damage or
-    unintended results if unexpectedly embedded in an SQL query.
-    This shouldn't be expected to make a SQL injection attack somehow
-    return valid data, but it should cause it to not be a threat to the DB.
-    """
-    s = s.replace('%', '')
-    s = s.replace('*', '')
-    s = s.replace(',', '')
-    s = s.replace(';', '')
-    s = s.replace('(', '')
-    s = s.replace(')', '')
-    # note: "'" should not get stripped as x'<hex>' is how one flags a hex
-    # value to SQLite3 so that it returns the string in a string not byte
-    # format
-    return str(s)
-
 def numInstances(manifest, queue):
     """ Run to return the number of instances for manifest in the DB """
     query = DBrequest('SELECT COUNT(instance) FROM manifests WHERE ' +
-                      'name = "' + manifest + '"')
+                      'name = ?', params=(manifest,))
     queue.put(query)
     query.waitAns()
     return(query.getResponse()[0][0])
@@ -260,21 +842,160 @@ def numManifests(queue):
     query.waitAns()
     return(query.getResponse()[0][0])
 
+def getSchemaVersion(queue):
+    """ Run to return the schema version recorded in the DB """
+    query = DBrequest('PRAGMA user_version')
+    queue.put(query)
+    query.waitAns()
+    return(query.getResponse()[0][0])
+
+def upgradeDB(queue):
+    """
+    Upgrades the DB on the committable queue provided to SCHEMA_VERSION:
+    from version 0 by adding the criteria indexes (one on name and
+    instance, a covering index on each value criteria column and a
+    composite index on each MIN and MAX range criteria pair) and from
+    version 1 by converting the mac and IPv4 range columns to integers (see
+    rangeValue()).  Indexes which already exist are left alone, so an upgrade
+    interrupted while indexing may simply be run again; the addresses are
+    converted in a single transaction just before the version is recorded.
+    Returns the schema version the DB was upgraded from.
+    Raises SystemExit if the DB could not be upgraded.
+    """
+    version = getSchemaVersion(queue)
+    if version >= SCHEMA_VERSION:
+        return version
+
+    columns = list(getCriteria(queue, onlyUsed=False, strip=False))
+    indexes = [("manifests_name", "name, instance")]
+    for col in columns:
+        if col.startswith('MAX') and 'MIN' + col[3:] in columns:
+            # indexed together with its MIN column
+            continue
+        if col.startswith('MIN') and 'MAX' + col[3:] in columns:
+            indexes.append(("manifests_" + col[3:],
+                            col + ", MAX" + col[3:] + ", name"))
+        else:
+            indexes.append(("manifests_" + col, col + ", name"))
+
+    # submit every index before waiting on any of them, then record the
+    # version only once they all exist and the addresses are converted so
+    # a failed upgrade is retried
+    requests = [DBrequest("CREATE INDEX IF NOT EXISTS " + index +
+                          " ON manifests (" + indexCols + ")", commit=True)
+                for (index, indexCols) in indexes]
+    for query in requests:
+        queue.put(query)
+    try:
+        for query in requests:
+            query.getResult()
+        if version < INTEGER_ADDRESS_VERSION:
+            _convertAddresses(queue, columns)
+        query = DBrequest("PRAGMA user_version = %d" % SCHEMA_VERSION,
+                          commit=True)
+        queue.put(query)
+        query.getResult()
+    except DBError, e:
+        raise SystemExit(_("Error:\tUnable to upgrade database:\n%s") % e)
+    return version
+
+def _convertAddresses(queue, columns):
+    """
+    Converts the mac and IPv4 range columns of a version 1 (or older) DB
+    to integers in one transaction: mac addresses from the blobs of their
+    bytes and IPv4 addresses from their zero-padded decimal digits.
+    Raises DBError if the DB could not be updated.
+    """
+    addresses = [col for col in columns if col[3:] in ("mac", "ipv4") and
+                 (col.startswith('MIN') or col.startswith('MAX'))]
+    if not addresses:
+        return
+    query = DBrequest("SELECT rowid, " + ", ".join(addresses) +
+                      " FROM manifests WHERE " +
+                      " OR ".join(col + " IS NOT NULL" for col in addresses))
+    queue.put(query)
+    rows = list()
+    for row in query.getResult():
+        values = list()
+        for col in addresses:
+            value = row[col]
+            if col.endswith("mac") and isinstance(value, buffer):
+                value = long(binascii.hexlify(str(value)), 16)
+            elif col.endswith("ipv4") and value is not None:
+                value = rangeValue(col, "%12.12d" % long(value))
+            values.append(value)
+        rows.append(tuple(values) + (row['rowid'],))
+    if not rows:
+        return
+    query = DBbatch("UPDATE manifests SET " +
+                    ", ".join(col + " = ?" for col in addresses) +
+                    " WHERE rowid = ?", rows)
+    queue.put(query)
+    query.getResult()
+
 def getManNames(queue):
     """
     Use to create a generator which provides the names of manifests
     in the DB
     """
-    # Whether the DBrequest should be in or out of the for loop depends on if
-    # doing one large SQL query and iterating the responses (but holding the
-    # response in memory) is better than requesting row by row, and
-    # doing more DB transactions in less memory
-    for i in range(numManifests(queue)):
-        query = DBrequest('SELECT DISTINCT(name) FROM manifests LIMIT 1 ' +
-                          'OFFSET %s' % i)
-        queue.put(query)
-        query.waitAns()
-        yield(query.getResponse()[0][0])
+    # one query provides all names, streamed back from the DB thread in
+    # batches so we hold neither the whole response in memory nor run a
+    # DB transaction per name
+    query = DBstream('SELECT DISTINCT(name) FROM manifests')
+    queue.put(query)
+    for row in query:
+        yield(row[0])
+    return
+
+def getManifestTable(queue, humanOutput=False, onlyUsed=True):
+    """
+    Use to create a generator which provides for each manifest in the DB
+    (in name order) a tuple of the manifest name and a list with the
+    criteria of each of its instances (in instance order, so the length of
+    the list is the number of instances).  Each instance's criteria maps
+    criteria column names to values in column order, as
+    getManifestCriteria() would return (human output returns hexadecimal
+    strings for mac opposed to integer output).  All manifests are read by
+    one query, streamed back from the DB thread in batches.
+    """
+    columns = list(getCriteria(queue, onlyUsed=onlyUsed, strip=False))
+    query = DBstream(_manifestTableSql(columns))
+    queue.put(query)
+    return _groupManifestRows(query, columns, humanOutput)
+
+def readManifestTable(cursor, columns, humanOutput=False):
+    """
+    Use to create a generator which provides the manifests table as
+    getManifestTable() does, read through cursor (i.e. within a
+    DBtransaction, which can not queue requests) for the criteria columns
+    given
+    """
+    cursor.execute(_manifestTableSql(columns))
+    return _groupManifestRows(cursor, columns, humanOutput)
+
+def _manifestTableSql(columns):
+    """ Returns the query reading the criteria columns of all manifests """
+    return ("SELECT name, instance, " + ", ".join(columns) +
+            " FROM manifests ORDER BY name, instance")
+
+def _groupManifestRows(rows, columns, humanOutput):
+    """
+    Generator grouping rows of the manifests table (ordered by name and
+    instance) into the (name, instances) tuples of getManifestTable()
+    """
+    name = None
+    instances = list()
+    for row in rows:
+        if row['name'] != name:
+            if name is not None:
+                yield (name, instances)
+            name = row['name']
+            instances = list()
+        instances.append(OrderedDict((crit, humanOutput and
+                                      humanValue(crit, row[crit]) or
+                                      row[crit]) for crit in columns))
+    if name is not None:
+        yield (name, instances)
     return
 
 def findManifestsByCriteria(queue, criteria):
@@ -308,33 +1029,22 @@ def getSpecificCriteria(queue, criteria, criteria2=None,
     else:
         queryStr = "SELECT "
     if criteria2 is not None:
-        if criteria.endswith('mac'):
-            # for hexadecimal values we need to use the SQL HEX() function to
-            # properly return a hex value
-            queryStr += ("HEX(" + criteria + "), HEX(" + criteria2 +
-                         ") FROM manifests WHERE (" + criteria +
-                         " IS NOT NULL OR " + criteria2 + " IS NOT NULL)")
-        else:
-            # this is a decimal range value
-            queryStr += (criteria + ", " + criteria2 +
-                         " FROM manifests WHERE (" + criteria +
-                         " IS NOT NULL OR " + criteria2 + " IS NOT NULL)")
+        # this is a range value (stored as integers)
+        queryStr += (criteria + ", " + criteria2 +
+                     " FROM manifests WHERE (" + criteria +
+                     " IS NOT NULL OR " + criteria2 + " IS NOT NULL)")
     else:
-        if criteria.endswith('mac'):
-            # for hexadecimal values we need to use the SQL HEX() function to
-            # properly return a hex value
-            queryStr += ("HEX(" + criteria + ") FROM manifests WHERE " +
-                         criteria + " IS NOT NULL")
-        else:
-            # this is a decimal range value or string
-            queryStr += (criteria + " FROM manifests WHERE " + criteria +
-                         " IS NOT NULL")
+        # this is a range value or string
+        queryStr += (criteria + " FROM manifests WHERE " + criteria +
+                     " IS NOT NULL")
 
+    params = tuple()
     if excludeManifests is not None:
         for manifest in excludeManifests:
-            queryStr += " AND name IS NOT '" + manifest + "'"
+            queryStr += " AND name IS NOT ?"
+        params = tuple(excludeManifests)
 
-    query = DBrequest(queryStr)
+    query = DBrequest(queryStr, params=params)
     queue.put(query)
     query.waitAns()
     return(query.getResponse())
@@ -345,70 +1055,41 @@ def getCriteria(queue, onlyUsed=True, strip=True):
     needs to be queried on the client). If strip is False, return
     exact DB column names not (more) human names.
     """
-    # first get the names of the columns (criteria) by using the SQL PRAGMA
-    # statement on the manifest table
-    query = DBrequest("PRAGMA table_info(manifests)")
-    queue.put(query)
-    query.waitAns()
-
-    columns = list()
-    queryStr = "SELECT "
-    # build a query so we can determine which columns (criteria) are in use
-    # using the output from the PRAGMA statement
-    for col in iter(query.getResponse()):
-        colName = col['name']
-        # skip the manifest name and instance column as they are not criteria
-        if (colName == "name"): continue
-        if (colName == "instance"): continue
-        # use the SQL COUNT() aggregator to determine if the criteria is in use
-        queryStr += "COUNT(" + colName + ") as " + colName + ", "
-        # add the column name to the list of columns
-        columns.append(colName)
-    else:
-        # strip extra ", " from the query
-        queryStr = queryStr[:-2]
-        queryStr += " FROM manifests"
+    # the column names and which are in use come from the DB's metadata
+    # cache (see DBmetadata)
+    metadata = queue.getMetadata()
 
     if not (onlyUsed or strip):
         # if we are not gleaning the unused columns and not stripping the
         # column names then yield them now
-        for column in columns:
-            yield str(column)
+        for column in metadata.getColumns(queue):
+            yield column
         return
 
     elif not onlyUsed:
         # if we are only stripping the column names yield the result now
-        for column in columns:
+        for column in metadata.getColumns(queue):
             if not column.startswith('MAX'):
-                yield str(column.replace('MIN', ''))
+                yield column.replace('MIN', '')
         return
 
     else:
-        # we need to run the query from above and determine which columns are
-        # in use we will gather used criteria for the response from the above
-        # query which is like:
-        # "SELECT COUNT(memMIN), COUNT(memMAX), ... FROM manifests"
-        query = DBrequest(queryStr)
-        queue.put(query)
-        query.waitAns()
         response = dict()
-        # iterate over each column
-        for colName in columns:
-            # only take columns which have a positive count
-            if query.getResponse()[0][str(colName)] > 0:
-                if strip:
-                    # take only the criteria name, not a qualifier
-                    # (i.e. MIN, MAX) but use both MAX and MIN in case one is
-                    # unused we need ensure we still return the stripped result
-                    if colName.startswith('MAX') or colName.startswith('MIN'):
-                        # we have reported this criteria do not repeat it
-                        if response.has_key(colName.replace('MIN', '', 1).\
-                                               replace('MAX', '', 1)):
-                            continue
-                        colName = colName.replace('MIN', '', 1)
-                        colName = colName.replace('MAX', '', 1)
-                        response[colName] = 1
-                yield str(colName)
+        # iterate over each column in use
+        for colName in metadata.getColumns(queue, onlyUsed=True):
+            if strip:
+                # take only the criteria name, not a qualifier
+                # (i.e. MIN, MAX) but use both MAX and MIN in case one is
+                # unused we need ensure we still return the stripped result
+                if colName.startswith('MAX') or colName.startswith('MIN'):
+                    # we have reported this criteria do not repeat it
+                    if response.has_key(colName.replace('MIN', '', 1).\
+                                           replace('MAX', '', 1)):
+                        continue
+                    colName = colName.replace('MIN', '', 1)
+                    colName = colName.replace('MAX', '', 1)
+                    response[colName] = 1
+            yield colName
         return
 
 def isRangeCriteria(queue, name):
@@ -428,105 +1109,368 @@ def getManifestCriteria(name, instance, queue, humanOutput=False,
                         onlyUsed=True):
     """
     Returns the criteria (as a subset of used criteria) for a particular
-    manifest given (human output returns HEX() for mac opposed to byte output)
+    manifest given (human output returns a dictionary with hexadecimal
+    strings for mac opposed to a row with integer output)
     """
     queryStr = "SELECT "
     for crit in getCriteria(queue, onlyUsed=onlyUsed, strip=False):
-        if str(crit).endswith('mac') and humanOutput:
-            queryStr += "HEX(" + str(crit) + ") AS " + str(crit) + ", "
-        else:
-            queryStr += str(crit) + ", "
+        queryStr += str(crit) + ", "
     else:
         if getCriteria(queue, onlyUsed=onlyUsed, strip=False).next() is not None:
             queryStr = queryStr[:-2]
         else:
             raise AssertionError(_("Database contains no criteria!"))
-    queryStr += ' FROM manifests WHERE name = "' + name + \
-                '" AND instance = "' + str(instance) + '"'
-    query = DBrequest(queryStr)
+    queryStr += ' FROM manifests WHERE name = ? AND instance = ?'
+    query = DBrequest(queryStr, params=(name, instance))
     queue.put(query)
     query.waitAns()
-    return query.getResponse()[0]
+    row = query.getResponse()[0]
+    if humanOutput:
+        return OrderedDict((crit, humanValue(crit, row[crit]))
+                           for crit in row.keys())
+    return row
+
+def humanValue(crit, value):
+    """
+    Returns the value of the criteria column crit as human output provides
+    it: mac addresses as 12 upper case hexadecimal digits and all other
+    values as stored
+    """
+    if crit.endswith('mac') and value is not None:
+        return "%12.12X" % value
+    return value
+
+def rangeValue(crit, value):
+    """
+    Returns the integer the database stores for a value of the range
+    criteria column crit, as given by a client or a criteria manifest: mac
+    addresses are hexadecimal strings of whole bytes, IPv4 addresses are
+    dotted or zero-padded to three decimal digits per octet (as
+    verifyXML.prepValuesAndRanges() provides them) and are stored as their
+    32 bit value, and all other criteria are decimal numbers.
+    Raises ValueError if the value is malformed for the column.
+    """
+    value = str(value).strip()
+    if crit.endswith("mac"):
+        # the value has to be a hexadecimal string of whole bytes
+        value = value.replace(":", "")
+        if len(value) % 2:
+            raise ValueError(value)
+        return long(value, 16)
+    if crit.endswith("ipv4"):
+        if "." in value:
+            octets = value.split(".")
+        else:
+            value = value.zfill(12)
+            octets = [value[i:i + 3] for i in range(0, len(value), 3)]
+        if len(octets) != 4 or not all(octet.isdigit() for octet in octets):
+            raise ValueError(value)
+        address = 0L
+        for octet in octets:
+            if int(octet) > 255:
+                raise ValueError(value)
+            address = (address << 8) + int(octet)
+        return address
+    return long(value)
+
+def criteriaValue(crit, criteria):
+    """
+    Returns the client's value for the criteria column crit out of the
+    criteria dictionary, prepared for comparing against the column: an
+    integer for mac and IPv4 (see rangeValue()), a number for other range
+    criteria and a string for value criteria.
+    Raises KeyError if the client did not provide the criteria and
+    ValueError if the value is malformed for the column.
+    """
+    value = criteria[crit.replace('MIN', '', 1).replace('MAX', '', 1)]
+    if crit.startswith("MIN") or crit.startswith("MAX"):
+        if crit.endswith("mac") or crit.endswith("ipv4"):
+            return rangeValue(crit, value)
+        try:
+            return long(value)
+        except ValueError:
+            return float(value)
+    return value
 
 def findManifest(criteria, db):
     """
     findManifest() returns a query response provided a criteria
     dictionary. (The response may contain 0 or more manifests depending on
     criteria.)
+
+    Each criteria column in use is considered in turn: if any remaining
+    manifest matches the client's value for the column the remaining set is
+    narrowed to those manifests, otherwise to the manifests where the column
+    is NULL.  This is answered in a single SQL statement by scoring each row
+    with a base 3 digit per column (2 for a match, 1 for NULL, 0 otherwise;
+    the first column being most significant).  The manifests served are the
+    rows with the highest score in the table which match, or are NULL, in
+    every column.
     """
     # If we didn't get any criteria bail providing no manifest
     if len(criteria) == 0:
         return 0
 
-    curCount = 0
-    queryStr = "SELECT name FROM manifests WHERE "
-    for crit in getCriteria(db.getQueue(), strip=False):
-        prevCount = curCount
-        queryStr1 = queryStr
+    columns = list(getCriteria(db.getQueue(), strip=False))
+    if not columns:
+        return 0
+
+    scores = list()
+    clauses = list()
+    params = dict()
+    for crit in columns:
         try:
-            if crit.startswith("MIN"):
-                if crit.endswith("mac"):
-                    # setup a clause like HEX(MINmac) <= HEX(x'F00')
-                    queryStr1 += "HEX(" + crit + ") <= HEX(x'" + \
-                                 sanitizeSQL(
-                                 criteria[crit.replace('MIN', '',1)]) + "')"
-                else:
-                    # setup a clause like crit <= value
-                    queryStr1 += crit + " " + "<= " + \
-                                 sanitizeSQL(criteria[crit.replace('MIN', '',1)])
-            elif crit.startswith("MAX"):
-                if crit.endswith("mac"):
-                    # setup a clause like HEX(MINmac) >= HEX(x'F000')
-                    queryStr1 += "HEX(" + crit + ") >= HEX(x'" + \
-                                 sanitizeSQL(
-                                 criteria[crit.replace('MAX', '',1)]) + "')"
-                else:
-                    # setup a clause like crit <= value
-                    queryStr1 += crit + " " + ">= " + \
-                                 sanitizeSQL(criteria[crit.replace('MAX', '',1)])
-            else:
-                # store single values in lower case
-                # setup a clause like crit = lower(value)
-                queryStr1 += crit + " " + '= LOWER("' + \
-                             sanitizeSQL(criteria[crit]) + '")'
+            params[crit] = criteriaValue(crit, criteria)
         except KeyError:
             print _("Missing criteria: %s;returning 0 - oft default.xml") % crit
             return 0
-        query = DBrequest(queryStr1)
-        db.getQueue().put(query)
-        query.waitAns()
-
-        try:
-            curCount = len(query.getResponse())
-        except Exception:
-            # we'll not get a response if we were provided a criteria which
-            # isn't in the DB (we'll generate a DB error); shouldn't happen
-            # unless getCriteria() is really confused
+        except ValueError:
             print _("Bad criteria: %s;returning 0 - oft default.xml") % crit
             return 0
 
-        if len(query.getResponse()) >= 1:
-            queryStr = queryStr1 + " AND "
+        if crit.startswith("MIN") or crit.startswith("MAX"):
+            if crit.startswith("MIN"):
+                operator = " <= :"
+            else:
+                operator = " >= :"
+            # setup a clause like MINmem <= value
+            match = crit + operator + crit
         else:
-            # criteria reduced effective set to zero (add a NULL criteria
-            # instead)
-            queryStr += crit + " IS NULL AND "
-    else:
-        # remove extraneous " AND "
-        queryStr = queryStr[:-5]
-    query = DBrequest(queryStr)
+            # single values are stored in lower case
+            match = crit + " = LOWER(:" + crit + ")"
+
+        scores.append("(CASE WHEN " + match + " THEN 2 WHEN " + crit +
+                      " IS NULL THEN 1 ELSE 0 END) * " +
+                      str(3 ** (len(columns) - len(scores) - 1)))
+        clauses.append("(" + match + " OR " + crit + " IS NULL)")
+
+    score = " + ".join(scores)
+    query = DBrequest("SELECT name FROM manifests WHERE " +
+                      " AND ".join(clauses) + " AND " + score +
+                      " = (SELECT MAX(" + score + ") FROM manifests)",
+                      params=params)
     db.getQueue().put(query)
     query.waitAns()
 
+    response = query.getResponse()
+    if response is None:
+        # we'll not get a response if we were provided a criteria which
+        # isn't in the DB (we'll generate a DB error); shouldn't happen
+        # unless getCriteria() is really confused
+        print _("Bad criteria;returning 0 - oft default.xml")
+        return 0
+
     # see if we got one, more or zero manifests back
-    if len(query.getResponse()) == 1:
-        return query.getResponse()[0]['name']
-    elif len(query.getResponse()) > 1:
-        return len(query.getResponse())
+    if len(response) == 1:
+        return response[0]['name']
+    elif len(response) > 1:
+        return len(response)
     # got zero manifests back
     else:
         return 0
 
+class CriteriaIndex(object):
+    """
+    Class holding an in-memory index of the manifests table so clients can
+    be matched to a manifest without querying the database.  Value criteria
+    are held in a hash map of value to rows and range criteria in a sorted
+    list of bounds per MIN/MAX column.  Rows are identified by their
+    position in the table.  An index may be written to a file with dump()
+    and read back with load(), so it is only compiled when the table
+    changes; the file records the generation (getDBStamp()) of the database
+    the index was compiled from, so an index left out of date by a change
+    to the database can be told apart.
+    """
+
+
+    def __init__(self, columns, rows, generation=None):
+        """
+        Build the index from the criteria columns in use (in table order, as
+        provided by getCriteria(strip=False)) and the rows of the manifests
+        table, each a sequence of the manifest name followed by a value for
+        each column, read from the database of stamp generation
+        """
+        self._generation = generation
+        self._names = [row[0] for row in rows]
+        self._all = frozenset(range(len(rows)))
+        self._columns = list()
+        for position, crit in enumerate(columns):
+            values = [(row[position + 1], rowid)
+                      for rowid, row in enumerate(rows)]
+            nulls = frozenset(rowid for (value, rowid) in values
+                              if value is None)
+            values = [(value, rowid) for (value, rowid) in values
+                      if value is not None]
+            if crit.startswith("MIN") or crit.startswith("MAX"):
+                values.sort()
+                lookup = ([value for (value, rowid) in values],
+                          [rowid for (value, rowid) in values])
+            else:
+                lookup = dict()
+                for (value, rowid) in values:
+                    lookup.setdefault(value, set()).add(rowid)
+            self._columns.append((crit, lookup, nulls))
+
+    def getGeneration(self):
+        """
+        Returns the stamp (see getDBStamp()) of the database the index was
+        compiled from, or None if it is not known
+        """
+        return self._generation
+
+    def getCriteria(self):
+        """
+        Returns the criteria the index uses, as getCriteria() would against
+        the indexed table
+        """
+        criteria = list()
+        for (crit, lookup, nulls) in self._columns:
+            crit = crit.replace('MIN', '', 1).replace('MAX', '', 1)
+            if crit not in criteria:
+                criteria.append(crit)
+        return criteria
+
+    def dump(self, path):
+        """
+        Writes the index to the file path; the file is replaced in one
+        rename so readers see either the old or the new index.
+        Raises IOError or OSError if the file could not be written.
+        """
+        tmpPath = "%s.%d.tmp" % (path, os.getpid())
+        out = open(tmpPath, "wb")
+        try:
+            out.write("%s %d\n" % (INDEX_MAGIC, INDEX_VERSION))
+            marshal.dump((self._generation, self._names, self._columns),
+                         out)
+        finally:
+            out.close()
+        os.chmod(tmpPath, 0644)
+        os.rename(tmpPath, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns the index written to the file path by dump().
+        Raises IOError if the file could not be read and ValueError if it is
+        not an index of this format version.
+        """
+        data = open(path, "rb").read()
+        (header, sep, data) = data.partition("\n")
+        if header != "%s %d" % (INDEX_MAGIC, INDEX_VERSION):
+            raise ValueError(_("%s is not a version %d criteria index") %
+                             (path, INDEX_VERSION))
+        try:
+            (generation, names, columns) = marshal.loads(data)
+        except (EOFError, TypeError), e:
+            raise ValueError(e)
+        index = cls([], [], generation)
+        index._names = names
+        index._all = frozenset(range(len(names)))
+        index._columns = columns
+        return index
+
+    def _matches(self, crit, lookup, value):
+        """
+        Returns the rows matching the client's (prepared) value for the
+        criteria column crit
+        """
+        if crit.startswith("MIN"):
+            # rows whose minimum is less than or equal to the value
+            return lookup[1][:bisect.bisect_right(lookup[0], value)]
+        elif crit.startswith("MAX"):
+            # rows whose maximum is greater than or equal to the value
+            return lookup[1][bisect.bisect_left(lookup[0], value):]
+        # single values are stored in lower case
+        return lookup.get(value.lower(), ())
+
+    def findManifest(self, criteria):
+        """
+        findManifest() returns the same response as the module's
+        findManifest() function would against the indexed table, provided a
+        criteria dictionary
+        """
+        # If we didn't get any criteria bail providing no manifest
+        if len(criteria) == 0 or not self._columns:
+            return 0
+
+        remaining = self._all
+        for crit, lookup, nulls in self._columns:
+            try:
+                value = criteriaValue(crit, criteria)
+            except KeyError:
+                print _("Missing criteria: %s;returning 0 - oft "
+                        "default.xml") % crit
+                return 0
+            except ValueError:
+                print _("Bad criteria: %s;returning 0 - oft "
+                        "default.xml") % crit
+                return 0
+            # narrow to the manifests matching this criteria if any remain,
+            # otherwise to those not using this criteria
+            remaining = (remaining.intersection(
+                         self._matches(crit, lookup, value)) or
+                         remaining.intersection(nulls))
+
+        # see if we got one, more or zero manifests back
+        if len(remaining) == 1:
+            return self._names[iter(remaining).next()]
+        return len(remaining)
+
+def getCriteriaIndex(queue, generation=None):
+    """
+    Returns a CriteriaIndex of the manifests table, recording the stamp
+    generation of the database (taken before reading the table) if given
+    """
+    columns = list(getCriteria(queue, strip=False))
+    query = DBrequest("SELECT " + ", ".join(["name"] + columns) +
+                      " FROM manifests")
+    queue.put(query)
+    query.waitAns()
+    return CriteriaIndex(columns, query.getResponse(), generation)
+
+def writeCriteriaIndex(queue, db):
+    """
+    Compiles a CriteriaIndex of the manifests table of the database file db
+    (accessed through queue) and writes it next to the database, for the
+    webserver to match clients against.  If it can not be written the out of
+    date index is removed (so the webserver falls back to the database) and
+    a warning printed.
+    """
+    path = os.path.join(os.path.dirname(db), INDEX_FILE)
+    # move the write-ahead log into the database first, so that the log
+    # being removed once the database is closed does not change the stamp
+    # recorded with the index
+    checkpoint = DBrequest("PRAGMA wal_checkpoint(TRUNCATE)")
+    queue.put(checkpoint)
+    checkpoint.waitAns()
+    try:
+        getCriteriaIndex(queue, getDBStamp(db)).dump(path)
+    except (IOError, OSError), e:
+        print _("Warning:\tUnable to write criteria index %s: %s") % (path, e)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def getDBStamp(db):
+    """
+    Returns a value which changes whenever the database file db (or its
+    write-ahead log) is modified; an empty write-ahead log is treated as no
+    log, as the database holds all of its contents either way
+    """
+    stamp = list()
+    for path in (db, db + "-wal"):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stamp.append(None)
+            continue
+        if path == db or stat.st_size:
+            stamp.append((stat.st_mtime, stat.st_size, stat.st_ino))
+        else:
+            stamp.append(None)
+    return tuple(stamp)
+
 def formatValue(key, value):
     """
     Format and stringify database values.
@@ -535,8 +1479,10 @@ def formatValue(key, value):
       key: a database criterion key.  Starting "MIN" and "MAX" are stripped
             off to get the type of datum the key represents.
             The following user-friendly output formatting is done:
-            - mac addresses have colons added.
-            - IP addresses have dots added and leading 0's stripped.
+            - mac addresses (integers or hexadecimal strings) have colons
+              added.
+            - IP addresses (integers or zero-padded decimal strings) have
+              dots added and leading 0's stripped.
             - memory sizes have "MB" added to the end.
             - All other criteria types are stringified only.
 
@@ -550,17 +1496,20 @@ def formatValue(key, value):
     key = key.strip()
     key = key.replace("MIN", "", 1)
     key = key.replace("MAX", "", 1)
-    if (key == "mac" and value):
-        # Note: MAC addresses are already strings.
+    if (key == "mac" and value not in (None, "")):
+        if isinstance(value, basestring):
+            value = rangeValue(key, value)
+        value = humanValue(key, value)
         ret = value[0:2] + ":" + value[2:4] + ":" + \
               value[4:6] + ":" + value[6:8] + ":" + \
               value[8:10] + ":" + value[10:12]
-    elif (key == "ipv4" and value):
-        svalue = "%12.12d" % long(value)
-        ret = str(int(svalue[0:3])) + "." + \
-              str(int(svalue[3:6])) + "." + \
-              str(int(svalue[6:9])) + "." + \
-              str(int(svalue[9:12]))
+    elif (key == "ipv4" and value not in (None, "")):
+        if isinstance(value, basestring):
+            value = rangeValue(key, value)
+        ret = str(value >> 24 & 0xFF) + "." + \
+              str(value >> 16 & 0xFF) + "." + \
+              str(value >> 8 & 0xFF) + "." + \
+              str(value & 0xFF)
     elif (key == "mem" and value):
         ret = str(value) + " MB"
     else:
@@ -35,6 +35,7 @@ from optparse import OptionParser
 from sqlite3 import dbapi2 as sqlite
 
 import osol_install.auto_install.AI_database as AIdb
+import osol_install.auto_install.manifest_store as store
 
 def parse_options():
     """
@@ -60,9 +61,9 @@ def delete_manifest_from_DB(DB, manifest_instance, dataLoc):
     """
     instance = manifest_instance[1]
     # check to see that the manifest is found in the database (as entered)
-    if manifest_instance[0] not in AIdb.getManNames(DB.getQueue()):
+    if not AIdb.numInstances(manifest_instance[0], DB.getQueue()):
         # since all manifest names have to have .xml appended try adding that
-        if manifest_instance[0] + '.xml' in AIdb.getManNames(DB.getQueue()):
+        if AIdb.numInstances(manifest_instance[0] + '.xml', DB.getQueue()):
             man_name = manifest_instance[0] + '.xml'
         else:
             raise SystemExit(_("Error:\tManifest %s not found in database!" %
@@ -73,8 +74,8 @@ def delete_manifest_from_DB(DB, manifest_instance, dataLoc):
     # if we do not have an instance remove the entire manifest
     if instance is None:
         # remove manifest from database
-        query = AIdb.DBrequest("DELETE FROM manifests WHERE name = '%s'" %
-                               AIdb.sanitizeSQL(man_name), commit=True)
+        query = AIdb.DBrequest("DELETE FROM manifests WHERE name = ?",
+                               commit=True, params=(man_name,))
         DB.getQueue().put(query)
         query.waitAns()
         # run getResponse to handle and errors
@@ -82,7 +83,7 @@ def delete_manifest_from_DB(DB, manifest_instance, dataLoc):
 
         # clean up file on file system
         try:
-            os.remove(os.path.join(dataLoc, 'AI_data', man_name))
+            store.remove_manifest(os.path.join(dataLoc, 'AI_data'), man_name)
         except OSError:
             print >> sys.stderr, _("Warning:\tUnable to find file %s for " +
                                    "removal!") % man_name
@@ -98,9 +99,9 @@ def delete_manifest_from_DB(DB, manifest_instance, dataLoc):
                               AIdb.numInstances(man_name, DB.getQueue()))))
 
         # remove instance from database
-        query = "DELETE FROM manifests WHERE name = '%s' AND instance = '%i'" %\
-                (man_name, instance)
-        query = AIdb.DBrequest(query, commit=True)
+        query = AIdb.DBrequest("DELETE FROM manifests WHERE name = ? AND "
+                               "instance = ?", commit=True,
+                               params=(man_name, instance))
         DB.getQueue().put(query)
         query.waitAns()
         # run getResponse to handle and errors
@@ -111,23 +112,25 @@ def delete_manifest_from_DB(DB, manifest_instance, dataLoc):
         # increasing. We may have removed an instance with instances numbered
         # above thus leaving a gap.
 
-        # get the number of instances with a larger instance
+        # get the number of instances with a larger instance and decrement
+        # each instance number (the writer runs the updates in order so
+        # submit them all at once)
+        queries = list()
         for num in range(instance, AIdb.numInstances(man_name,
                                                      DB.getQueue())+1):
-            # now decrement the instance number
-            query = "UPDATE manifests SET instance = '%i' WHERE name = '%s' " %\
-                   (num-1, AIdb.sanitizeSQL(man_name))
-            query += "AND instance = '%i'" % num
-            query = AIdb.DBrequest(query, commit=True)
-            DB.getQueue().put(query)
-            query.waitAns()
+            queries.append(AIdb.DBrequest("UPDATE manifests SET instance = "
+                                          "? WHERE name = ? AND instance = ?",
+                                          commit=True,
+                                          params=(num-1, man_name, num)))
+        for query in DB.executeMany(queries):
             # run getResponse to handle and errors
             query.getResponse()
 
         # remove file if manifest is no longer in database
-        if man_name not in AIdb.getManNames(DB.getQueue()):
+        if not AIdb.numInstances(man_name, DB.getQueue()):
             try:
-                os.remove(os.path.join(dataLoc, 'AI_data',man_name))
+                store.remove_manifest(os.path.join(dataLoc, 'AI_data'),
+                                      man_name)
             except:
                 print >> sys.stderr, _("Warning:\tUnable to find file %s for " +
                                        "removal!") % man_name
@@ -143,4 +146,9 @@ if __name__ == '__main__':
         raise SystemExit(_("Error:\tNeed a valid A/I service directory"))
     AISQL = AIdb.DB(os.path.join(DATA_LOC, 'AI.db'), commit=True)
     AISQL.verifyDBStructure()
-    delete_manifest_from_DB(AISQL, options, DATA_LOC)
+    try:
+        delete_manifest_from_DB(AISQL, options, DATA_LOC)
+    except AIdb.DBError, err:
+        raise SystemExit(_("Error:\tUnable to delete manifest:\n%s") % err)
+    # recompile the criteria index the webserver matches clients against
+    AIdb.writeCriteriaIndex(AISQL.getQueue(), os.path.join(DATA_LOC, 'AI.db'))
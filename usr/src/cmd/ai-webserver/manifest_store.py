@@ -0,0 +1,167 @@
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+# Copyright (c) 2010, Oracle and/or its affiliates. All rights reserved.
+"""
+
+A/I Manifest Store
+
+Published manifests are kept in an install service's AI_data directory
+content-addressed: each distinct manifest is stored once, named by the
+SHA-256 hash of its content, under AI_data/.store along with a gzip
+compressed copy (<hash>.gz).  AI_data/<manifest name> is a symbolic link
+to the manifest's stored copy, so manifests published under several names
+share it and the webserver can find the hash (for an ETag) and the
+compressed copy of any manifest it serves without reading it.
+
+Manifests placed in AI_data as plain files (i.e. by an older release or
+setup-service) are still served; they simply have no hash or compressed
+copy.
+
+"""
+
+import errno
+import gzip
+import hashlib
+import os
+
+# name of the directory (in AI_data) holding the stored manifests
+STORE_DIR = ".store"
+
+# suffix of a stored manifest's gzip compressed copy
+GZIP_SUFFIX = ".gz"
+
+def store_manifest(data_dir, name, content, mode=0600, owner=None):
+    """
+    Stores a manifest and links its name to it, replacing any manifest
+    published under that name.
+    Args: data_dir - the install service's AI_data directory
+          name - the manifest's name
+          content - the manifest's content (a string)
+          mode - permissions for the stored manifest and its compressed copy
+          owner - (uid, gid) for the stored manifest and its compressed
+                  copy, if they are to be changed
+    Returns: the hash of the manifest's content
+    Raises: OSError or IOError if the manifest can not be stored
+    """
+    digest = hashlib.sha256(content).hexdigest()
+    store = os.path.join(data_dir, STORE_DIR)
+    if not os.path.isdir(store):
+        os.mkdir(store, 0755)
+
+    # write the copies under temporary names and rename them into place so
+    # the webserver never serves a partial manifest
+    for (path, write) in \
+        ((os.path.join(store, digest + GZIP_SUFFIX), _write_gzip),
+         (os.path.join(store, digest), _write_plain)):
+        if os.path.exists(path):
+            continue
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        write(tmp_path, content)
+        os.chmod(tmp_path, mode)
+        if owner is not None:
+            os.chown(tmp_path, owner[0], owner[1])
+        os.rename(tmp_path, path)
+
+    # link the manifest's name to its stored copy (relative to AI_data so
+    # the service directory may be moved)
+    old_digest = manifest_hash(data_dir, name)
+    link = os.path.join(data_dir, name)
+    tmp_link = "%s.%d.tmp" % (link, os.getpid())
+    os.symlink(os.path.join(STORE_DIR, digest), tmp_link)
+    os.rename(tmp_link, link)
+    if old_digest is not None and old_digest != digest:
+        _collect(data_dir, old_digest)
+    return digest
+
+def remove_manifest(data_dir, name):
+    """
+    Removes the manifest published under name, and its stored copy if no
+    other name links to it
+    Args: data_dir - the install service's AI_data directory
+          name - the manifest's name
+    Returns: None
+    Raises: OSError if no manifest is published under name
+    """
+    digest = manifest_hash(data_dir, name)
+    os.remove(os.path.join(data_dir, name))
+    if digest is not None:
+        _collect(data_dir, digest)
+
+def manifest_hash(data_dir, name):
+    """
+    Returns: the hash of the manifest published under name, or None if it
+             is not in the store (a plain file or missing)
+    """
+    try:
+        target = os.readlink(os.path.join(data_dir, name))
+    except OSError:
+        return None
+    (store, digest) = os.path.split(target)
+    if store != STORE_DIR:
+        return None
+    return digest
+
+def gzip_path(data_dir, digest):
+    """
+    Returns: the path of the gzip compressed copy of the stored manifest
+             with the hash given, or None if there is none
+    """
+    path = os.path.join(data_dir, STORE_DIR, digest + GZIP_SUFFIX)
+    if os.path.exists(path):
+        return path
+    return None
+
+def _collect(data_dir, digest):
+    """
+    Removes the stored manifest with the hash given (and its compressed
+    copy) unless a name still links to it
+    """
+    for name in os.listdir(data_dir):
+        if name != STORE_DIR and manifest_hash(data_dir, name) == digest:
+            return
+    stored = os.path.join(data_dir, STORE_DIR, digest)
+    for path in (stored, stored + GZIP_SUFFIX):
+        try:
+            os.remove(path)
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+
+def _write_plain(path, content):
+    """ Writes content to the file path """
+    out = open(path, "wb")
+    try:
+        out.write(content)
+    finally:
+        out.close()
+
+def _write_gzip(path, content):
+    """
+    Writes content gzip compressed to the file path (with no file name or
+    timestamp, so the same content always compresses to the same bytes)
+    """
+    out = open(path, "wb")
+    try:
+        compressed = gzip.GzipFile("", "wb", 9, out, mtime=0)
+        compressed.write(content)
+        compressed.close()
+    finally:
+        out.close()
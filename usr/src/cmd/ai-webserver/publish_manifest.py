@@ -27,6 +27,7 @@ A/I Publish_Manifest
 
 """
 
+import bisect
 import os.path
 import sys
 import StringIO
@@ -36,6 +37,7 @@ import hashlib
 from optparse import OptionParser
 
 import osol_install.auto_install.AI_database as AIdb
+import osol_install.auto_install.manifest_store as store
 import osol_install.auto_install.verifyXML as verifyXML
 import osol_install.libaiscf as smf
 
@@ -50,15 +52,21 @@ def parse_options(cmd_options=None):
     Parse and validate options
     Args: Optional cmd_options, used for unit testing. Otherwise, cmd line
           options handled by OptionParser
-    Returns: the DataFiles object populated and initialized
+    Returns: a list of the DataFiles objects populated and initialized (one
+             for each manifest; more than one only for a batch)
     Raises: The DataFiles initialization of manifest(s) A/I, SC, SMF looks for
             many error conditions and, when caught, are flagged to the user
             via raising SystemExit exceptions.
     """
 
     usage = _("usage: %prog -n service_name -m AI_manifest"
-              " [-c <criteria=value|range> ... | -C criteria_file]")
+              " [-c <criteria=value|range> ... | -C criteria_file]\n"
+              "       %prog -n service_name -b batch_directory|batch_file")
     parser = OptionParser(usage=usage, prog="add-manifest")
+    parser.add_option("-b", dest="batch",
+                      default=None, help=_("Specify a directory of "
+                      "manifests, or a file listing manifests, to publish "
+                      "together."))
     parser.add_option("-c", dest="criteria_c", action="append",
                       default=[], help=_("Specify criteria: "
                       "<-c criteria=value|range> ..."))
@@ -79,16 +87,23 @@ def parse_options(cmd_options=None):
         parser.error(_("Unexpected arguments: %s" % args))
 
     # options are:
+    #    -b  directory or list file of manifests to publish as a batch
     #    -c  criteria=<value/range> ...
     #    -C  XML file with criteria specified
     #    -n  service name
     #    -m  manifest path to work with
 
     # check that we got the install service's name and
-    # an AI manifest
-    if options.manifest_path is None or options.service_name is None:
+    # an AI manifest (or a batch of them)
+    if (options.manifest_path is None and options.batch is None) or \
+        options.service_name is None:
         parser.error(_("Missing one or more required options."))
 
+    # a batch takes its manifests and criteria from the batch
+    if options.batch is not None and (options.manifest_path or
+        options.criteria_c or options.criteria_file):
+        parser.error(_("Options used are mutually exclusive."))
+
     # check that we aren't mixing -c and -C
     if (options.criteria_c and options.criteria_file):
         parser.error(_("Options used are mutually exclusive."))
@@ -132,18 +147,83 @@ def parse_options(cmd_options=None):
         parser.error("Need a valid A/I service directory")
 
 
+    if options.batch is not None:
+        try:
+            batch = read_batch(options.batch)
+        except (IOError, OSError, ValueError) as err:
+            parser.error(err)
+    else:
+        batch = [(options.manifest_path, options.criteria_file)]
+
+    # the manifests of a batch share one database connection
+    entries = list()
     try:
-        files = DataFiles(service_dir=service_dir, image_path=image_path,
-                      database_path=os.path.join(service_dir, "AI.db"),
-                      manifest_file=options.manifest_path,
-                      criteria_dict=criteria_dict,
-                      criteria_file=options.criteria_file)
+        for (manifest_path, criteria_file) in batch:
+            if entries:
+                files = DataFiles(service_dir=service_dir,
+                                  image_path=image_path,
+                                  database=entries[0].database,
+                                  manifest_file=manifest_path,
+                                  criteria_file=criteria_file)
+            else:
+                files = DataFiles(service_dir=service_dir,
+                          image_path=image_path,
+                          database_path=os.path.join(service_dir, "AI.db"),
+                          manifest_file=manifest_path,
+                          criteria_dict=criteria_dict,
+                          criteria_file=criteria_file)
+            entries.append(files)
     except (AssertionError, IOError, ValueError) as err:
         raise SystemExit(err)
     except (lxml.etree.LxmlError) as err:
         raise SystemExit(_("Error:\tmanifest error: %s") % err)
 
-    return(files)
+    return(entries)
+
+def read_batch(batch):
+    """
+    Reads the manifests to publish as a batch.
+    Args: batch - either a directory, where each <name>.xml file is a
+                  manifest and the optional <name>.criteria.xml file its
+                  criteria, or a file listing one manifest path per line,
+                  each optionally followed by a criteria file path
+                  (relative paths are relative to the list file and lines
+                  starting with # are ignored)
+    Returns: A list of (manifest path, criteria file path or None) tuples
+    Raises: IOError if the batch can not be read, ValueError if it is
+            malformed or empty
+    """
+    entries = list()
+    if os.path.isdir(batch):
+        for name in sorted(os.listdir(batch)):
+            if not name.endswith(".xml") or name.endswith(".criteria.xml"):
+                continue
+            criteria_file = os.path.join(batch,
+                                         name[:-4] + ".criteria.xml")
+            if not os.path.exists(criteria_file):
+                criteria_file = None
+            entries.append((os.path.join(batch, name), criteria_file))
+    else:
+        batch_dir = os.path.dirname(os.path.abspath(batch))
+        batch_file = open(batch, 'r')
+        try:
+            for line in batch_file:
+                fields = line.split()
+                if not fields or fields[0].startswith("#"):
+                    continue
+                if len(fields) > 2:
+                    raise ValueError(_("Malformed batch entry: %s") %
+                                     line.strip())
+                paths = [os.path.join(batch_dir, field) for field in fields]
+                for path in paths:
+                    if not os.path.exists(path):
+                        raise ValueError(_("Unable to find file: %s") % path)
+                entries.append((paths[0], (paths[1:] or [None])[0]))
+        finally:
+            batch_file.close()
+    if not entries:
+        raise ValueError(_("No manifests found in batch: %s") % batch)
+    return entries
 
 def criteria_to_dict(criteria):
     """
@@ -178,311 +258,464 @@ def criteria_to_dict(criteria):
 
     return cri_dict
 
-def find_colliding_criteria(criteria, db, exclude_manifests=None):
+def check_divergence(columns, new_row, row, collided, man_inst):
     """
-    Returns: A dictionary of colliding criteria with keys being manifest name
-             and instance tuples and values being the DB column names which
-             collided
-    Args:    criteria - Criteria object holding the criteria that is to be
-                        added/set for a manifest.
-             db - AI_database object for the install service.
-             exclude_manifests -A list of manifest names from DB to ignore.
-                                This arg is passed in when we're calling this
-                                function to find criteria collisions for an
-                                already published manifest.
-    Raises:  SystemExit if: criteria is not found in database
-                            value is not valid for type (integer and hexadecimal
-                            checks)
-                            range is improper
+    Checks that the criteria of a manifest diverge from those of a manifest
+    instance they collide with (i.e. are not exactly the same) and that
+    colliding ranges are identical. Columns are compared in DB column
+    order up to the first which differs.
+    Args: columns - the DB column names
+          new_row - dictionary of the manifest's normalized criteria (see
+                    criteria_row())
+          row - dictionary of the manifest instance's normalized criteria
+          collided - the DB column names which collided
+          man_inst - the (name, instance) of the manifest instance
+    Returns: Nothing
+    Raises: SystemExit if a range collides, or if the manifest has the same
+            criteria as the manifest instance
     """
-    class Fields(object):
-        """
-        Define convenience indexes
-        """
-        # manifest name is row index 0
-        MANNAME = 0
-        # manifest instance is row index 1
-        MANINST = 1
-        # criteria is row index 2 (when a single valued criteria)
-        CRIT = 2
-        # minimum criteria is row index 2 (when a range valued criteria)
-        MINCRIT = 2
-        # maximum criteria is row index 3 (when a range valued criteria)
-        MAXCRIT = 3
-
-    # collisions is a dictionary to hold keys of the form (manifest name,
-    # instance) which will point to a comma-separated string of colliding
-    # criteria
-    collisions = dict()
-
-    # verify each range criteria in the manifest is well formed and collect
-    # collisions with database entries
+    for crit in columns:
+        if new_row.get(crit) == row.get(crit):
+            continue
+        if crit in collided and (crit.startswith('MIN') or
+                                 crit.startswith('MAX')):
+            raise SystemExit(_("Error:\tManifest has a range "
+                               "collision with manifest:%s/%i"
+                               "\n\tin criteria: %s!") %
+                             (man_inst[0], man_inst[1],
+                              crit.replace('MIN', '', 1).
+                              replace('MAX', '', 1)))
+        # the manifests diverge (they don't collide)
+        return
+    raise SystemExit(_("Error:\tManifest has same criteria as " +
+                       "manifest: %s/%i!") % (man_inst[0], man_inst[1]))
+
+def criteria_value(crit, value):
+    """
+    Normalizes a value of the DB column crit for comparison in memory
+    Args: crit - the DB column name (i.e. MINmem or arch)
+          value - a value from the database or a manifest's criteria
+    Returns: None for a database NULL or "unbounded", a long for range
+             criteria (as stored in the database, see AIdb.rangeValue())
+             and a lower case string for value criteria
+    Raises: ValueError if a range value is not a number
+    """
+    if value is None or value == '' or str(value).lower() == "unbounded":
+        return None
+    if crit.startswith('MIN') or crit.startswith('MAX'):
+        if isinstance(value, (int, long)):
+            # already the integer stored in the database
+            return long(value)
+        return AIdb.rangeValue(crit, value)
+    return str(value).lower()
+
+def criteria_row(criteria, columns):
+    """
+    Converts criteria to a row of normalized (see criteria_value()) column
+    values, verifying each criteria
+    Args: criteria - Criteria object holding the criteria for a manifest
+          columns - the DB column names
+    Returns: A dictionary of column name to value for the columns the
+             criteria sets
+    Raises: SystemExit if: criteria is not found in database
+                           value is not valid for type (integer and
+                           hexadecimal checks)
+                           range is improper
+    """
+    row = dict()
     for crit in criteria:
-        # gather this criteria's values from the manifest
         man_criterion = criteria[crit]
-
-        # check "value" criteria here (check the criteria exists in DB, and
-        # then find collisions)
+        if man_criterion is None:
+            continue
         if isinstance(man_criterion, basestring):
-            # only check criteria in use in the DB
-            if crit not in AIdb.getCriteria(db.getQueue(),
-                                            onlyUsed=False, strip=False):
+            if crit not in columns:
                 raise SystemExit(_("Error:\tCriteria %s is not a " +
                                    "valid criteria!") % crit)
+            row[crit] = criteria_value(crit, man_criterion)
+            continue
 
-            # get all values in the database for this criteria (and
-            # manifest/instance pairs for each value)
-            db_criteria = AIdb.getSpecificCriteria(
-                db.getQueue(), crit, 
-                provideManNameAndInstance=True,
-                excludeManifests=exclude_manifests)
-
-            # will iterate over a list of the form [manName, manInst, crit,
-            # None]
-            for row in db_criteria:
-                # check if the database and manifest values differ
-                if(str(row[Fields.CRIT]).lower() ==
-		   str(man_criterion).lower()):
-                    # record manifest name, instance and criteria name
-                    try:
-                        collisions[row[Fields.MANNAME],
-                                   row[Fields.MANINST]] += crit + ","
-                    except KeyError:
-                        collisions[row[Fields.MANNAME],
-                                   row[Fields.MANINST]] = crit + ","
-
-        # This is a range criteria.  (Check that ranges are valid, that
-        # "unbounded" gets set to 0/+inf, ensure the criteria exists
-        # in the DB, then look for collisions.)
-        else:
-            # check for a properly ordered range (with unbounded being 0 or
-            # Inf.) but ensure both are not unbounded
-            if(
-               # Check for a range of -inf to inf -- not a valid range
-               (man_criterion[0] == "unbounded" and
-                man_criterion[1] == "unbounded"
-               ) or
-               # Check min > max -- range order reversed
-               (
-                (man_criterion[0] != "unbounded" and
-                 man_criterion[1] != "unbounded"
-                ) and
-                (man_criterion[0] > man_criterion[1])
-               )
-              ):
-                raise SystemExit(_("Error:\tCriteria %s "
-                                   "is not a valid range (MIN > MAX) or "
-                                   "(MIN and MAX unbounded).") % crit)
-
-            # Clean-up NULL's and changed "unbounded"s to 0 and
-            # really large numbers in case this Python does
-            # not support IEEE754.  Note "unbounded"s are already
-            # converted to lower case during manifest processing.
-            if man_criterion[0] == "unbounded":
-                man_criterion[0] = "0"
-            if man_criterion[1] == "unbounded":
-                man_criterion[1] = INFINITY
+        if 'MIN' + crit not in columns and 'MAX' + crit not in columns:
+            raise SystemExit(_("Error:\tCriteria %s is not a "
+                               "valid criteria!") % crit)
+        try:
+            bounds = [criteria_value('MIN' + crit, man_criterion[0]),
+                      criteria_value('MAX' + crit, man_criterion[1])]
+        except ValueError:
             if crit == "mac":
-                # convert hex mac address (w/o colons) to a number
-                try:
-                    man_criterion[0] = long(str(man_criterion[0]).upper(), 16)
-                    man_criterion[1] = long(str(man_criterion[1]).upper(), 16)
-                except ValueError:
-                    raise SystemExit(_("Error:\tCriteria %s "
-                                       "is not a valid hexadecimal value") %
-                                     crit)
-
+                raise SystemExit(_("Error:\tCriteria %s "
+                                   "is not a valid hexadecimal value") %
+                                 crit)
+            if crit == "ipv4":
+                raise SystemExit(_("Error:\tCriteria %s "
+                                   "is not a valid IPv4 address") % crit)
+            raise SystemExit(_("Error:\tCriteria %s "
+                               "is not a valid integer value") % crit)
+        # both ends may not be unbounded and MIN may not exceed MAX
+        if bounds == [None, None] or (None not in bounds and
+                                      bounds[0] > bounds[1]):
+            raise SystemExit(_("Error:\tCriteria %s "
+                               "is not a valid range (MIN > MAX) or "
+                               "(MIN and MAX unbounded).") % crit)
+        (row['MIN' + crit], row['MAX' + crit]) = bounds
+    return row
+
+class IntervalIndex(object):
+    """
+    Static index of closed intervals which finds the intervals overlapping
+    a given interval. The intervals are kept sorted by their lower bound
+    with a tree holding the greatest upper bound of each span of them, so
+    a lookup only descends into spans holding an overlap.
+    """
+    def __init__(self, intervals):
+        """
+        Args: intervals - iterable of (low, high, item) tuples
+        """
+        intervals = sorted(intervals, key=lambda interval: interval[:2])
+        self._lows = [interval[0] for interval in intervals]
+        self._items = [interval[2] for interval in intervals]
+        self._size = 1
+        while self._size < len(intervals):
+            self._size *= 2
+        # the leaves are the upper bounds, each parent the greater of its
+        # children (-1 marks an empty leaf as all bounds are positive)
+        self._tree = [-1] * (2 * self._size)
+        for i, interval in enumerate(intervals):
+            self._tree[self._size + i] = interval[1]
+        for node in range(self._size - 1, 0, -1):
+            self._tree[node] = max(self._tree[2 * node],
+                                   self._tree[2 * node + 1])
+
+    def overlapping(self, low, high):
+        """
+        Returns: A list of the items whose intervals overlap [low, high]
+        """
+        # only intervals starting at or before high can overlap
+        count = bisect.bisect_right(self._lows, high)
+        items = list()
+        # walk the tree as (node, first interval, number of intervals)
+        spans = [(1, 0, self._size)]
+        while spans:
+            (node, start, width) = spans.pop()
+            if start >= count or self._tree[node] < low:
+                continue
+            if width == 1:
+                items.append(self._items[start])
             else:
-                # this is a decimal value
-                try:
-                    man_criterion = [long(str(man_criterion[0]).upper()),
-                                     long(str(man_criterion[1]).upper())]
-                except ValueError:
-                    raise SystemExit(_("Error:\tCriteria %s "
-                                       "is not a valid integer value") % crit)
-
-            # check to see that this criteria exists in the database columns
-            if ('MIN' + crit not in AIdb.getCriteria(
-                db.getQueue(), onlyUsed=False, strip=False))\
-                and ('MAX' + crit not in AIdb.getCriteria(
-                db.getQueue(), onlyUsed=False, strip=False)):
-                    raise SystemExit(_("Error:\tCriteria %s is not a "
-                                       "valid criteria!") % crit)
-
-            db_criteria = AIdb.getSpecificCriteria(
-                db.getQueue(), 'MIN' + crit, 'MAX' + crit,
-                provideManNameAndInstance=True,
-                excludeManifests=exclude_manifests)
-
-            # will iterate over a list of the form [manName, manInst, mincrit,
-            # maxcrit]
-            for row in db_criteria:
-                # arbitrarily large number in case this Python does
-                # not support IEEE754
-                db_criterion = ["0", INFINITY]
-
-                # now populate in valid database values (i.e. non-NULL values)
-                if row[Fields.MINCRIT]:
-                    db_criterion[0] = row[Fields.MINCRIT]
-                if row[Fields.MAXCRIT]:
-                    db_criterion[1] = row[Fields.MAXCRIT]
-                if crit == "mac":
-                    # use a hexadecimal conversion
-                    db_criterion = [long(str(db_criterion[0]), 16),
-                                    long(str(db_criterion[1]), 16)]
-                else:
-                    # these are decimal numbers
-                    db_criterion = [long(str(db_criterion[0])),
-                                    long(str(db_criterion[1]))]
-
-                # these three criteria can determine if there's a range overlap
-                if((man_criterion[1] >= db_criterion[0] and
-                   db_criterion[1] >= man_criterion[0]) or
-                   man_criterion[0] == db_criterion[1]):
-                    # range overlap so record the collision
-                    try:
-                        collisions[row[Fields.MANNAME],
-                                   row[Fields.MANINST]] += "MIN" + crit + ","
-                        collisions[row[Fields.MANNAME],
-                                   row[Fields.MANINST]] += "MAX" + crit + ","
-                    except KeyError:
-                        collisions[row[Fields.MANNAME],
-                                   row[Fields.MANINST]] = "MIN" + crit + ","
-                        collisions[row[Fields.MANNAME],
-                                   row[Fields.MANINST]] += "MAX" + crit + ","
-    return collisions
-
-def find_colliding_manifests(criteria, db, collisions, append_manifest=None):
+                width /= 2
+                spans.append((2 * node + 1, start + width, width))
+                spans.append((2 * node, start, width))
+        return items
+
+class CollisionIndex(object):
     """
-    For each manifest/instance pair in collisions check that the manifest
-    criteria diverge (i.e. are not exactly the same) and that the ranges do not
-    collide for ranges.
-    Raises if: a range collides, or if the manifest has the same criteria as a
-    manifest already in the database (SystemExit raised)
-    Returns: Nothing
-    Args: criteria - Criteria object holding the criteria that is to be
-                     added/set for a manifest.
+    In-memory index of the manifests table for checking the criteria of a
+    manifest being published (or changed) for collisions. The table is
+    read once; value criteria are then looked up by value and range
+    criteria through an IntervalIndex, so a check does not scan the table.
+    """
+    def __init__(self, db, exclude_manifests=None):
+        """
+        Args: db - AI_database object for the install service.
+              exclude_manifests - A list of manifest names whose instances
+                                  are not checked for collisions.
+        """
+        self._load(list(AIdb.getCriteria(db.getQueue(), onlyUsed=False,
+                                         strip=False)),
+                   AIdb.getManifestTable(db.getQueue(), humanOutput=True,
+                                         onlyUsed=False),
+                   exclude_manifests)
+
+    @classmethod
+    def from_table(cls, columns, table, exclude_manifests=None):
+        """
+        Returns: A CollisionIndex of a manifests table read otherwise (i.e.
+                 within a DB transaction, see AIdb.readManifestTable())
+        Args: columns - the DB column names
+              table - iterable of (name, instances) tuples, as
+                      AIdb.getManifestTable() provides with human output
+              exclude_manifests - as for CollisionIndex()
+        """
+        index = cls.__new__(cls)
+        index._load(columns, table, exclude_manifests)
+        return index
+
+    def _load(self, columns, table, exclude_manifests):
+        """
+        Reads the rows of table (see from_table()) and indexes them
+        """
+        self.columns = columns
+        self._exclude = set(exclude_manifests or [])
+        # normalized criteria of every manifest instance in the table
+        self._rows = dict()
+        # number of instances of each manifest
+        self._instances = dict()
+        for name, instances in table:
+            self._instances[name] = len(instances)
+            for instance, crits in enumerate(instances):
+                self._rows[name, instance] = \
+                    dict((crit, criteria_value(crit, crits[crit]))
+                         for crit in self.columns)
+        self._build()
+
+    def _build(self):
+        """
+        Indexes the rows not excluded: a dictionary of value to manifest
+        instances for each value criteria and an IntervalIndex for each
+        range criteria
+        """
+        infinity = long(INFINITY)
+        self._values = dict()
+        self._ranges = dict()
+        intervals = dict()
+        for man_inst, row in self._rows.iteritems():
+            if man_inst[0] in self._exclude:
+                continue
+            for crit in self.columns:
+                if crit.startswith('MAX'):
+                    continue
+                if not crit.startswith('MIN'):
+                    if row[crit] is not None:
+                        self._values.setdefault(crit, dict()).setdefault(
+                            row[crit], list()).append(man_inst)
+                    continue
+                crit_name = crit.replace('MIN', '', 1)
+                (low, high) = (row[crit], row.get('MAX' + crit_name))
+                if low is None and high is None:
+                    continue
+                # unbounded ends are 0 and an arbitrarily large number
+                intervals.setdefault(crit_name, list()).append(
+                    (low or 0, high or infinity, man_inst))
+        for crit_name in intervals:
+            self._ranges[crit_name] = IntervalIndex(intervals[crit_name])
+
+    def add(self, rows):
+        """
+        Adds manifest instances to the index
+        Args: rows - dictionary of (name, instance) to normalized criteria
+                     (see criteria_row())
+        """
+        for man_inst, row in rows.iteritems():
+            self._rows[man_inst] = dict((crit, row.get(crit))
+                                        for crit in self.columns)
+            self._instances[man_inst[0]] = max(man_inst[1] + 1,
+                self._instances.get(man_inst[0], 0))
+        self._build()
+
+    def num_instances(self, name):
+        """ Returns the number of instances of manifest name indexed """
+        return self._instances.get(name, 0)
+
+    def find_colliding_criteria(self, criteria):
+        """
+        Returns: A dictionary of colliding criteria with keys being manifest
+                 name and instance tuples and values being the DB column
+                 names which collided, each followed by a comma
+        Args:    criteria - Criteria object holding the criteria that is to
+                            be added/set for a manifest.
+        Raises:  SystemExit if the criteria are invalid (see criteria_row())
+        """
+        collisions = dict()
+        for man_inst, collided in self._collide(criteria).iteritems():
+            collisions[man_inst] = "".join([crit + "," for crit in collided])
+        return collisions
+
+    def _collide(self, criteria, new_row=None):
+        """
+        Returns: A dictionary of (name, instance) to the list of DB column
+                 names the criteria collide with for that manifest instance
+        """
+        if new_row is None:
+            new_row = criteria_row(criteria, self.columns)
+        infinity = long(INFINITY)
+        collisions = dict()
+        for crit in criteria:
+            if criteria[crit] is None:
+                continue
+            if crit in new_row:
+                # value criteria collide when equal
+                for man_inst in self._values.get(crit, dict()).get(
+                    new_row[crit], list()):
+                    collisions.setdefault(man_inst, list()).append(crit)
+            elif crit in self._ranges:
+                # range criteria collide when they overlap
+                for man_inst in self._ranges[crit].overlapping(
+                    new_row['MIN' + crit] or 0,
+                    new_row['MAX' + crit] or infinity):
+                    collisions.setdefault(man_inst, list()).extend(
+                        ['MIN' + crit, 'MAX' + crit])
+        return collisions
+
+    def check_manifest(self, criteria, append_manifest=None, man_inst=None):
+        """
+        Checks the criteria of a manifest collide with no manifest instance
+        in the index: each manifest instance found colliding (see
+        find_colliding_criteria()) must diverge from it (see
+        check_divergence()).
+        Args: criteria - Criteria object holding the criteria that is to be
+                         added/set for a manifest.
+              append_manifest - name of manifest we're appending criteria
+                                to; its published criteria fill in those
+                                not given
+              man_inst - the (name, instance) of the manifest if it is in
+                         the index itself (it does not collide with itself)
+        Returns: Nothing
+        Raises: SystemExit if the criteria are invalid, a range collides, or
+                the manifest has the same criteria as a manifest instance
+        """
+        given = criteria_row(criteria, self.columns)
+        new_row = dict()
+        if append_manifest is not None:
+            new_row.update(self._rows.get((append_manifest, 0), dict()))
+        new_row.update(given)
+        collisions = self._collide(criteria, given)
+        for other in sorted(collisions):
+            if other != man_inst:
+                check_divergence(self.columns, new_row, self._rows[other],
+                                 set(collisions[other]), other)
+
+def check_batch_collisions(entries, index):
+    """
+    Checks the criteria of each manifest in a batch against the manifests
+    in the CollisionIndex index and against the other manifests in the
+    batch
+    Args: entries - list of DataFiles objects for the manifests to publish
+          index - CollisionIndex of the manifests in the database
+    Returns: A dictionary of each of entries to the (name, instance) it
+             would be given
+    Raises: SystemExit if a manifest's criteria are invalid or collide
+    """
+    # index the batch's manifests under the instance numbers they will be
+    # given
+    rows = dict()
+    man_insts = dict()
+    for files in entries:
+        man_insts[files] = (files.manifest_name,
+                            index.num_instances(files.manifest_name))
+        try:
+            rows[man_insts[files]] = criteria_row(files.criteria,
+                                                  index.columns)
+        except SystemExit, err:
+            raise SystemExit(_("%s\n\tin manifest: %s") %
+                             (err, files.manifest_name))
+    index.add(rows)
+    for files in entries:
+        try:
+            index.check_manifest(files.criteria, man_inst=man_insts[files])
+        except SystemExit, err:
+            raise SystemExit(_("%s\n\tin manifest: %s") %
+                             (err, files.manifest_name))
+    return man_insts
+
+def insert_SQL(entries, db):
+    """
+    Checks the criteria of manifests for collisions and inserts them into
+    the database in one IMMEDIATE transaction, so no other publish can take
+    their instance numbers or add colliding criteria in between; either
+    every manifest is inserted or, on error, none are
+    Args: entries - list of DataFiles objects for the manifests to publish
           db - AI_database object for the install service.
-          collisions - a dictionary with collisions, as produced by
-                       find_colliding_criteria()
-          append_manifest - name of manifest we're appending criteria to.
-                            This arg is passed in when we're calling this
-                            function to find criteria collisions for an
-                            already published manifest that we're appending
-                            criteria to.
+    Returns: A list of the (name, instance) inserted for each of entries
+    Raises: SystemExit if a manifest's criteria are invalid or collide, or
+            the database could not be updated
     """
+    columns = list(AIdb.getCriteria(db.getQueue(), onlyUsed=False,
+                                    strip=False))
+    # the rows to insert, but for their instance numbers (the values are
+    # prepared first as no DB requests can be made within the transaction)
+    rows = [manifest_values(files, None) for files in entries]
+
+    def insert_manifests(cursor):
+        """ Checks and inserts the manifests (in the DB thread) """
+        index = CollisionIndex.from_table(columns,
+            AIdb.readManifestTable(cursor, columns, humanOutput=True))
+        man_insts = check_batch_collisions(entries, index)
+        for files, row in zip(entries, rows):
+            row[1] = man_insts[files][1]
+        # the values are bound to the INSERT statement's placeholders
+        # (rather than formatted into it) so SQLite can reuse the prepared
+        # statement
+        cursor.executemany("INSERT INTO manifests VALUES(" +
+                           ",".join("?" * len(rows[0])) + ")", rows)
+        return [man_insts[files] for files in entries]
+
+    query = AIdb.DBtransaction(insert_manifests)
+    db.getQueue().put(query)
+    try:
+        return query.getResult()
+    except AIdb.DBError, err:
+        raise SystemExit(_("Error:\tUnable to add manifest:\n%s") % err)
 
-    # If we're appending criteria to an already published manifest, get a
-    # dictionary of the criteria that's already published for that manifest.
-    if append_manifest is not None:
-        published_criteria = AIdb.getManifestCriteria(append_manifest, 0,
-                                                      db.getQueue(),
-                                                      humanOutput=True,
-                                                      onlyUsed=False)
-
-    # check every manifest in collisions to see if manifest collides (either
-    # identical criteria, or overlaping ranges)
-    for man_inst in collisions:
-        # get all criteria from this manifest/instance pair
-        db_criteria = AIdb.getManifestCriteria(man_inst[0],
-                                               man_inst[1],
-                                               db.getQueue(),
-                                               humanOutput=True,
-                                               onlyUsed=False)
-
-        # iterate over every criteria in the database
-        for crit in AIdb.getCriteria(db.getQueue(),
-                                     onlyUsed=False, strip=False):
-
-            # Get the criteria name (i.e. no MIN or MAX)
-            crit_name = crit.replace('MIN', '', 1).replace('MAX', '', 1)
-            # Set man_criterion to the key of the DB criteria or None
-            man_criterion = criteria[crit_name]
-
-            if man_criterion and crit.startswith('MIN'):
-                man_criterion = man_criterion[0]
-            elif man_criterion and crit.startswith('MAX'):
-                man_criterion = man_criterion[1]
-
-            # If man_criterion is still None, and if we're appending criteria
-            # to an already published manifest, look for criteria in the
-            # published set of criteria for the manifest we're appending to
-            # as well, because existing criteria might cause a collision,
-            # which we need to compare for.
-            if man_criterion is None and append_manifest is not None:
-                man_criterion = published_criteria[str(crit)]
-                # replace database NULL's with Python None
-                if man_criterion == '':
-                    man_criterion = None
-
-            # set the database criteria
-            if db_criteria[str(crit)] == '':
-                # replace database NULL's with a Python None
-                db_criterion = None
-            else:
-                db_criterion = db_criteria[str(crit)]
-
-            # Replace unbounded's in the criteria (i.e. 0/+inf)
-            # with a Python None.
-            if isinstance(man_criterion, basestring) and \
-               man_criterion == "unbounded":
-                man_criterion = None
-
-            # check to determine if this is a range collision by using
-            # collisions and if not are the manifests divergent
-
-            if((crit.startswith('MIN') and
-                collisions[man_inst].find(crit + ",") != -1) or
-               (crit.startswith('MAX') and
-                collisions[man_inst].find(crit + ",") != -1)
-              ):
-                if (str(db_criterion).lower() != str(man_criterion).lower()):
-                    raise SystemExit(_("Error:\tManifest has a range "
-                                       "collision with manifest:%s/%i"
-                                       "\n\tin criteria: %s!") %
-                                     (man_inst[0], man_inst[1],
-                                      crit.replace('MIN', '', 1).
-                                      replace('MAX', '', 1)))
-
-            # the range did not collide or this is a single value (if we
-            # differ we can break out knowing we diverge for this
-            # manifest/instance)
-            elif(str(db_criterion).lower() != str(man_criterion).lower()):
-                # manifests diverge (they don't collide)
-                break
-
-        # end of for loop and we never broke out (diverged)
-        else:
-            raise SystemExit(_("Error:\tManifest has same criteria as " +
-                               "manifest: %s/%i!") %
-                             (man_inst[0], man_inst[1]))
+def remove_SQL(man_insts, db):
+    """
+    Removes manifest instances inserted by insert_SQL() from the database
+    in one transaction, renumbering any instances added after them so the
+    instances of each manifest stay contiguous
+    Args: man_insts - list of (name, instance) tuples to remove
+          db - AI_database object for the install service.
+    Returns: None
+    Raises: SystemExit if the database could not be updated
+    """
+    def remove_manifests(cursor):
+        """ Removes the manifest instances (in the DB thread) """
+        for name, instance in man_insts:
+            cursor.execute("DELETE FROM manifests WHERE name = ? AND "
+                           "instance = ?", (name, instance))
+            cursor.execute("UPDATE manifests SET instance = instance - 1 "
+                           "WHERE name = ? AND instance > ?",
+                           (name, instance))
+
+    query = AIdb.DBtransaction(remove_manifests)
+    db.getQueue().put(query)
+    try:
+        query.getResult()
+    except AIdb.DBError, err:
+        raise SystemExit(_("Error:\tUnable to remove manifest:\n%s") % err)
 
-def insert_SQL(files):
+def publish_manifests(entries, db):
     """
-    Ensures all data is properly sanitized and formatted, then inserts it into
-    the database
-    Args: None
+    Adds manifests to the database (see insert_SQL()) and moves them into
+    place; if a manifest can not be placed, the manifests placed before it
+    and every manifest's database rows are removed again so no row points
+    at no manifest
+    Args: entries - list of DataFiles objects for the manifests to publish
+          db - AI_database object for the install service.
     Returns: None
+    Raises: SystemExit if a manifest can not be published (in which case
+            none are)
     """
-    query = "INSERT INTO manifests VALUES("
-
-    # add the manifest name to the query string
-    query += "'" + AIdb.sanitizeSQL(files.manifest_name) + "',"
-    # check to see if manifest name is alreay in database (affects instance
-    # number)
-    if AIdb.sanitizeSQL(files.manifest_name) in \
-        AIdb.getManNames(files.database.getQueue()):
-            # database already has this manifest name get the number of
-            # instances
-        instance = AIdb.numInstances(AIdb.sanitizeSQL(files.manifest_name),
-                                     files.database.getQueue())
-
-    # this a new manifest
-    else:
-        instance = 0
+    man_insts = insert_SQL(entries, db)
+    placed = list()
+    try:
+        for files in entries:
+            data_dir = os.path.join(files.get_service(), "AI_data")
+            existed = os.path.lexists(os.path.join(data_dir,
+                                                   files.manifest_name))
+            place_manifest(files)
+            if not existed:
+                placed.append((data_dir, files.manifest_name))
+    except:
+        for data_dir, name in placed:
+            try:
+                store.remove_manifest(data_dir, name)
+            except (IOError, OSError):
+                print >> sys.stderr, _("Warning:\tUnable to remove "
+                                       "manifest %s") % name
+        remove_SQL(man_insts, db)
+        raise
+
+def manifest_values(files, instance):
+    """
+    Ensures all data is properly formatted for a manifests table row (the
+    values are bound as parameters, so are stored as given)
+    Args: files - DataFiles object for the manifest
+          instance - the instance number for the row
+    Returns: A list of the row's values, in column order
+    """
+    values = list()
 
-    # actually add the instance to the query string
-    query += str(instance) + ","
+    # add the manifest name and instance to the values
+    values.append(files.manifest_name)
+    values.append(instance)
 
     # we need to fill in the criteria or NULLs for each criteria the database
     # supports (so iterate over each criteria)
@@ -494,51 +727,69 @@ def insert_SQL(files):
             continue
 
         # get the values from the manifest
-        values = files.criteria[crit.replace('MAX', '', 1)]
+        crit_values = files.criteria[crit.replace('MAX', '', 1)]
 
         # If the critera manifest didn't specify this criteria, fill in NULLs
-        if values is None:
+        if crit_values is None:
             # use the criteria name to determine if this is a range
             if crit.startswith('MAX'):
-                query += "NULL,NULL,"
+                values.extend([None, None])
             # this is a single value
             else:
-                query += "NULL,"
+                values.append(None)
 
         # this is a single criteria (not a range)
-        elif isinstance(values, basestring):
+        elif isinstance(crit_values, basestring):
             # translate "unbounded" to a database NULL
-            if values == "unbounded":
-                query += "NULL,"
+            if crit_values == "unbounded":
+                values.append(None)
             else:
                 # use lower case for text strings
-                query += "'" + AIdb.sanitizeSQL(str(values).lower()) + "',"
+                values.append(str(crit_values).lower())
 
         # else values is a range
         else:
-            for value in values:
+            for value in crit_values:
                 # translate "unbounded" to a database NULL
                 if value == "unbounded":
-                    query += "NULL,"
-                # we need to deal with mac addresses specially being
-                # hexadecimal
-                elif crit.endswith("mac"):
-                    # need to insert with hex operand x'<val>'
-                    # use an upper case string for hex values
-                    query += "x'" + AIdb.sanitizeSQL(str(value).upper())+"',"
+                    values.append(None)
+                # mac and IPv4 addresses are stored as integers
+                elif crit.endswith("mac") or crit.endswith("ipv4"):
+                    values.append(AIdb.rangeValue(crit, value))
                 else:
-                    query += AIdb.sanitizeSQL(str(value).upper()) + ","
+                    # the column's INTEGER affinity stores this as a number
+                    values.append(str(value).upper())
 
-    # strip trailing comma and close parentheses
-    query = query[:-1] + ")"
+    return values
 
-    # update the database
-    query = AIdb.DBrequest(query, commit=True)
-    files.database.getQueue().put(query)
-    query.waitAns()
-    # in case there's an error call the response function (which will print the
-    # error)
-    query.getResponse()
+def publish_batch(entries):
+    """
+    Publishes a batch of manifests: all of their criteria are checked for
+    collisions before any are added to the database, and they are added in
+    a single transaction
+    Args: entries - list of DataFiles objects for the manifests to publish
+                    (sharing one database object)
+    Returns: None
+    Raises: SystemExit if a manifest can not be published (in which case
+            none are)
+    """
+    names = set()
+    for files in entries:
+        if files.manifest_name == "default.xml":
+            raise SystemExit(_("Error:\tCan not publish a default manifest "
+                               "in a batch"))
+        if files.manifest_name in names:
+            raise SystemExit(_("Error:\tManifest %s appears more than once "
+                               "in the batch") % files.manifest_name)
+        names.add(files.manifest_name)
+        # a non-default manifest must have criteria
+        if not files.criteria:
+            raise SystemExit(_("Error:\tAt least one criterion must be "
+                               "provided with manifest %s.") %
+                             files.manifest_name)
+
+    # check and add the manifests to the database and move them into place
+    publish_manifests(entries, entries[0].database)
 
 def do_default(files):
     """
@@ -556,16 +807,18 @@ def do_default(files):
                            "manifest"))
     # remove old manifest
     try:
-        os.remove(os.path.join(files.get_service(), 'AI_data', 'default.xml'))
-    except IOError, ioerr:
+        store.remove_manifest(os.path.join(files.get_service(), 'AI_data'),
+                              'default.xml')
+    except (IOError, OSError), ioerr:
         raise SystemExit(_("Error:\tUnable to remove default.xml:\n\t%s") %
                            ioerr)
 
 def place_manifest(files):
     """
     Compares src and dst manifests to ensure they are the same; if manifest
-    does not yet exist, copies new manifest into place and sets correct
-    permissions and ownership
+    does not yet exist, stores the new manifest (and a compressed copy for
+    the webserver, see manifest_store) with correct permissions and
+    ownership and links the manifest's name to it
     Args: files - DataFiles object holding all of the relevant and verified
                   information for the manifest we're publishing.
     Returns: None
@@ -573,8 +826,8 @@ def place_manifest(files):
                manifest (raises SystemExit -- no clean up of database performed)
     """
 
-    manifest_path = os.path.join(files.get_service(), "AI_data",
-                                files.manifest_name)
+    data_dir = os.path.join(files.get_service(), "AI_data")
+    manifest_path = os.path.join(data_dir, files.manifest_name)
 
     if files.is_dtd:
         root = files._AI_root
@@ -593,6 +846,10 @@ def place_manifest(files):
             raise SystemExit(_("Error:\tNot copying manifest, source and "
                                "current versions differ -- criteria in "
                                "place."))
+        # change read and write for owner
+        os.chmod(manifest_path, 0600)
+        # change to user/group root (uid/gid 0)
+        os.chown(manifest_path, 0, 0)
 
     # the manifest does not yet exist so write it out
     else:
@@ -601,17 +858,16 @@ def place_manifest(files):
         for tag in root.xpath('/ai_criteria_manifest/ai_criteria'):
             tag.getparent().remove(tag)
  
+        # store the manifest read and write for owner and user/group root
+        # (uid/gid 0)
         try:
-            root.write(manifest_path, pretty_print=True)
-        except IOError as err:
+            store.store_manifest(data_dir, files.manifest_name,
+                                 lxml.etree.tostring(root, pretty_print=True),
+                                 mode=0600, owner=(0, 0))
+        except (IOError, OSError) as err:
             raise SystemExit(_("Error:\tUnable to write to dest. "
                                "manifest:\n\t%s") % err)
 
-    # change read and write for owner
-    os.chmod(manifest_path, 0600)
-    # change to user/group root (uid/gid 0)
-    os.chown(manifest_path, 0, 0)
-
 def verifyCriteria(schema, criteria_path, db, is_dtd=True):
     """
     Used for verifying and loading criteria XML from a Criteria manifest,
@@ -825,11 +1081,13 @@ class DataFiles(object):
 
     def __init__(self, service_dir=None, image_path=None,
                  database_path=None, manifest_file=None,
-                 criteria_dict=None, criteria_file=None):
+                 criteria_dict=None, criteria_file=None, database=None):
 
         """
         Initialize DataFiles instance. All parameters optional, however, proper
-        setup order asurred, if all data provided upon instantiation.
+        setup order asurred, if all data provided upon instantiation. An
+        already open (and verified) database object may be passed as
+        database instead of database_path.
         """
 
         #
@@ -883,7 +1141,9 @@ class DataFiles(object):
 
         # Holds database object for criteria database
         self._db = None
-        if database_path:
+        if database is not None:
+            self._db = database
+        elif database_path:
             # Set Database Path and Open SQLite3 Object
             self.database = database_path
             # verify the database's table/column structure (or exit if errors)
@@ -1423,23 +1683,33 @@ if __name__ == '__main__':
         raise SystemExit(_("Error:\tNeed root privileges to execute"))
 
     # load in all the options and file data
-    data = parse_options()
+    entries = parse_options()
+
+    # a batch is checked and added to the database as a whole
+    if len(entries) > 1:
+        publish_batch(entries)
+        # recompile the criteria index now the manifests are in place
+        AIdb.writeCriteriaIndex(entries[0].database.getQueue(),
+                                os.path.join(entries[0].get_service(),
+                                             "AI.db"))
 
     # if we have a default manifest do default manifest handling
-    if data.manifest_name == "default.xml":
-        do_default(data)
+    elif entries[0].manifest_name == "default.xml":
+        do_default(entries[0])
+        # move the manifest into place
+        place_manifest(entries[0])
 
     # if we have a non-default manifest first ensure it is a unique criteria
     # set and then, if unique, add the manifest to the criteria database
     else:
+        data = entries[0]
         # if we have a None criteria from the criteria list then the manifest
         # has no criteria which is illegal for a non-default manifest
         if not data.criteria:
             raise SystemExit(_("Error:\tAt least one criterion must be " +
                                "provided with a non-default manifest."))
-        find_colliding_manifests(data.criteria, data.database,
-            find_colliding_criteria(data.criteria, data.database))
-        insert_SQL(data)
-
-    # move the manifest into place
-    place_manifest(data)
+        # check and add the manifest to the database and move it into place
+        publish_manifests([data], data.database)
+        # recompile the criteria index now the manifest is in place
+        AIdb.writeCriteriaIndex(data.database.getQueue(),
+                                os.path.join(data.get_service(), "AI.db"))
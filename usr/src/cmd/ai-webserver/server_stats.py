@@ -0,0 +1,145 @@
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+# Copyright (c) 2010, Oracle and/or its affiliates. All rights reserved.
+"""
+
+A/I Server Statistics
+
+Counters and histograms the AI webserver (and the database threads serving
+it) keep about the work they do, listed on the webserver's /stats page.
+Each group of statistics is a StatsGroup; code which is not handed one (the
+webserver was started with statistics disabled) skips its accounting
+altogether, including reading the clock.
+
+"""
+
+import bisect
+import threading
+from collections import OrderedDict
+
+# upper bounds (in seconds) of the buckets of histograms of durations
+SECONDS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# upper bounds of the buckets of histograms of small counts
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+class Histogram(object):
+    """
+    Class counting observed values into buckets by upper bound (along with
+    their sum), callers serializing access to it
+    """
+
+
+    def __init__(self, bounds):
+        self._bounds = bounds
+        # the last bucket holds values past the highest bound
+        self._counts = [0] * (len(bounds) + 1)
+        self._sum = 0
+        self._count = 0
+
+    def observe(self, value):
+        """ Counts value in its bucket """
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self._sum += value
+        self._count += 1
+
+    def snapshot(self):
+        """
+        Returns a dictionary of the histogram: "buckets", a list of
+        (upper bound, count of values less than or equal to it) pairs
+        ending with ("+Inf", count), "sum" and "count"
+        """
+        buckets = list()
+        total = 0
+        for (bound, count) in zip(self._bounds + ("+Inf",), self._counts):
+            total += count
+            buckets.append((bound, total))
+        return {"buckets": buckets, "sum": self._sum, "count": self._count}
+
+class StatsGroup(object):
+    """
+    Class holding a named group of counters and histograms, safe to update
+    from several threads
+    """
+
+
+    def __init__(self, prefix, counters=(), histograms=()):
+        """
+        prefix is prepended to the names of the statistics, counters is a
+        list of counter names and histograms a list of (name, bounds) tuples
+        """
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = OrderedDict((name, 0) for name in counters)
+        self._histograms = OrderedDict((name, Histogram(bounds))
+                                       for (name, bounds) in histograms)
+
+    def count(self, **counts):
+        """ Adds the counts given to the counters """
+        self._lock.acquire()
+        try:
+            for (name, value) in counts.iteritems():
+                self._counters[name] += value
+        finally:
+            self._lock.release()
+
+    def observe(self, **values):
+        """ Adds each of the values given to its histogram """
+        self._lock.acquire()
+        try:
+            for (name, value) in values.iteritems():
+                self._histograms[name].observe(value)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        Returns a list of (name, value) tuples of the counters followed by
+        the histograms (whose values are dictionaries, see
+        Histogram.snapshot())
+        """
+        self._lock.acquire()
+        try:
+            return ([(self._prefix + name, value) for (name, value) in
+                     self._counters.iteritems()] +
+                    [(self._prefix + name, histogram.snapshot()) for
+                     (name, histogram) in self._histograms.iteritems()])
+        finally:
+            self._lock.release()
+
+def formatText(stats):
+    """
+    Returns the list of (name, value) tuples stats as text, one statistic
+    per line as "name value".  A histogram is listed as a line per bucket,
+    "name_bucket{le="<upper bound>"} <count>", then "name_sum <sum>" and
+    "name_count <count>".
+    """
+    lines = list()
+    for (name, value) in stats:
+        if isinstance(value, dict):
+            for (bound, count) in value["buckets"]:
+                lines.append('%s_bucket{le="%s"} %d' % (name, bound, count))
+            lines.append("%s_sum %s" % (name, value["sum"]))
+            lines.append("%s_count %d" % (name, value["count"]))
+        else:
+            lines.append("%s %s" % (name, value))
+    return "\n".join(lines) + "\n"
@@ -101,7 +101,7 @@ def check_published_manifest(service_dir, db, manifest_name):
     """
 
     # Check if manifest exists in the service's criteria DB.
-    if AIdb.sanitizeSQL(manifest_name) not in AIdb.getManNames(db.getQueue()):
+    if manifest_name not in AIdb.getManNames(db.getQueue()):
         print(_("Error: install service does not contain the specified "
                 "manifest: %s") % manifest_name)
         return False
@@ -123,20 +123,17 @@ def format_value(crit, value):
     Args: crit - the criteria name.
           value - the value to format.
     Returns:
-          Formatted value for (used by set_criteria()) to use in
-          a string to query the install service's DB.
+          Formatted value for (used by set_criteria()) to bind as a
+          parameter of a query of the install service's DB.
     """
-    # For the value "unbounded", we store this as "NULL" in the DB.
+    # For the value "unbounded", we store this as NULL in the DB.
     if value == "unbounded":
-        return "NULL"
+        return None
+    # mac and IPv4 addresses are stored as integers
+    elif crit == "mac" or crit == "ipv4":
+        return AIdb.rangeValue(crit, value)
     else:
-        formatted_val = "'" + AIdb.sanitizeSQL(str(value).upper()) + "'"
-
-        # If its the "mac" criteria, must add a special hex operand
-        if crit == "mac":
-            return "x" + formatted_val
-
-        return formatted_val
+        return str(value).upper()
 
 def set_criteria(criteria, manifest_name, db, append=False):
     """
@@ -148,8 +145,10 @@ def set_criteria(criteria, manifest_name, db, append=False):
     set for the manifest, and use only the criteria specified.
     """
 
-    # Build a list of criteria nvpairs to update
+    # Build a list of criteria nvpairs to update and the values to bind to
+    # their parameters
     nvpairs = list()
+    params = list()
 
     # we need to fill in the criteria or NULLs for each criteria the database
     # supports (so iterate over each criteria)
@@ -175,33 +174,36 @@ def set_criteria(criteria, manifest_name, db, append=False):
 
         # this is a single criteria (not a range)
         elif isinstance(values, basestring):
+            nvpairs.append(crit + "=?")
             # translate "unbounded" to a database NULL
             if values == "unbounded":
-                nvstr = crit + "=NULL"
+                params.append(None)
             else:
                 # use lower case for text strings
-                nvstr = crit + "='" + AIdb.sanitizeSQL(str(values).lower()) \
-                        + "'"
-            nvpairs.append(nvstr)
+                params.append(str(values).lower())
 
         # Else the values are a list this is a range criteria
         else:
             # Set the MIN column for this range criteria
-            nvpairs.append("MIN" + crit + "=" + format_value(crit, values[0]))
+            nvpairs.append("MIN" + crit + "=?")
+            params.append(format_value(crit, values[0]))
 
             # Set the MAX column for this range criteria
-            nvpairs.append("MAX" + crit + "=" + format_value(crit, values[1]))
+            nvpairs.append("MAX" + crit + "=?")
+            params.append(format_value(crit, values[1]))
 
-    query = "UPDATE manifests SET " + ",".join(nvpairs) + \
-            " WHERE name='" + manifest_name + "'"
+    query = "UPDATE manifests SET " + ",".join(nvpairs) + " WHERE name=?"
+    params.append(manifest_name)
 
     # update the DB
-    query = AIdb.DBrequest(query, commit=True)
+    query = AIdb.DBrequest(query, commit=True, params=tuple(params))
     db.getQueue().put(query)
     query.waitAns()
-    # in case there's an error call the response function (which
-    # will print the error)
-    query.getResponse()
+    # report any database error to the user
+    try:
+        query.getResponse()
+    except AIdb.DBError, err:
+        raise SystemExit(_("Error:\tUnable to set criteria:\n%s") % err)
 
 
 if __name__ == '__main__':
@@ -231,8 +233,9 @@ if __name__ == '__main__':
         raise SystemExit("Error: Invalid AI service directory: %s" %
                          service_dir)
 
-    # Open the database
+    # Open the database (upgrading it if it has an older schema version)
     db = AIdb.DB(database, commit=True)
+    db.verifyDBStructure()
 
     # Check to make sure that the manifest whose criteria we're
     # updating exists in the install service.
@@ -263,15 +266,13 @@ if __name__ == '__main__':
 
     # Ensure the criteria we're adding/setting for this manifest doesn't
     # cause a criteria collision in the DB.
-    colliding_criteria = pub_man.find_colliding_criteria(criteria, db,
-                             exclude_manifests=[options.manifest_name])
+    index = pub_man.CollisionIndex(db,
+                                   exclude_manifests=[options.manifest_name])
     # If we're appending criteria pass the manifest name
     if options.criteria_a:
-        pub_man.find_colliding_manifests(criteria, db, colliding_criteria,
-                                         append_manifest=options.manifest_name)
+        index.check_manifest(criteria, append_manifest=options.manifest_name)
     else:
-        pub_man.find_colliding_manifests(criteria, db, colliding_criteria,
-                                         append_manifest=None)
+        index.check_manifest(criteria, append_manifest=None)
 
     # Update the criteria for this manifest.
     if options.criteria_a:
@@ -279,3 +280,6 @@ if __name__ == '__main__':
     else:
         set_criteria(criteria, options.manifest_name, db, append=False)
 
+    # Recompile the criteria index the webserver matches clients against.
+    AIdb.writeCriteriaIndex(db.getQueue(), database)
+
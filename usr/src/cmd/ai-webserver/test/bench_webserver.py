@@ -0,0 +1,463 @@
+#!/usr/bin/python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+# Copyright (c) 2010, Oracle and/or its affiliates. All rights reserved.
+#
+
+'''
+Load generator for the AI webserver, emulating a boot storm.
+
+Builds an install service directory with a synthetic AI.db, starts the
+webserver on it and has many concurrent simulated clients ask it for their
+manifest, as ai_get_manifest does: a GET of /manifest.xml for the criteria
+list followed by a POST of the criteria it asked for (or, with --one-step,
+a single POST of every criteria).  Reports throughput, latency percentiles
+and the time the webserver's DB threads spent running queries (from its
+/stats page), so changes to the database and matching code can be checked
+for regressions.  Each client checks it was served the manifest its
+criteria select; manifests given no mac, ipv4 or mem range can only be told
+apart by arch and platform though, so their clients may be answered
+wrongly.  For example:
+
+    bench_webserver.py -m 5000 -c 100 -n 20 --no-index
+
+Like the unit tests, this runs the webserver from the source tree against
+the modules in the proto area; see usr/src/tools/tests/README.
+'''
+
+import gettext
+import httplib
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+from optparse import OptionParser
+from sqlite3 import dbapi2 as sqlite
+
+import osol_install.auto_install.AI_database as AIdb
+import osol_install.auto_install.manifest_store as store
+
+# the manifests table as shipped by installadm
+MANIFESTS_TABLE = ("CREATE TABLE manifests (name TEXT, instance INTEGER, "
+                   "arch TEXT, MINmac INTEGER, MAXmac INTEGER, "
+                   "MINipv4 INTEGER, MAXipv4 INTEGER, cpu TEXT, "
+                   "platform TEXT, MINnetwork INTEGER, MAXnetwork INTEGER, "
+                   "MINmem INTEGER, MAXmem INTEGER)")
+
+ARCHES = ["i86pc", "sun4u", "sun4v", "sun4us", "sun4c", "sun4d"]
+PLATFORMS = ["i86pc", "sunw,sun-fire-t200", "sunw,sun-blade-1000",
+             "sunw,sun-fire-v240", "sunw,sparc-enterprise-t5220",
+             "sunw,sun-fire-x4150", "sunw,ultra-5_10", "sunw,sun-fire-v890"]
+
+# each manifest is given its own block of addresses and memory sizes;
+# clients which are to miss are given addresses past every block
+MAC_BASE = 0x080020000000
+IPV4_BASE = 0x0A000000
+MEM_BASE = 256
+BLOCK = 256
+
+def parse_options():
+    """
+    Parse and validate options
+    """
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage, description=__doc__.split("\n")[1])
+    parser.add_option("-m", "--manifests", dest="manifests", default=1000,
+                      type="int", help="number of manifests [%default]")
+    parser.add_option("--mac", dest="mac", default=None, type="int",
+                      help="number of manifests with a mac range "
+                      "[all of them]")
+    parser.add_option("--ipv4", dest="ipv4", default=None, type="int",
+                      help="number of manifests with an ipv4 range "
+                      "[half of them]")
+    parser.add_option("--mem", dest="mem", default=None, type="int",
+                      help="number of manifests with a mem range "
+                      "[a quarter of them]")
+    parser.add_option("--arches", dest="arches", default=3, type="int",
+                      help="number of distinct arch values (0 for none) "
+                      "[%default]")
+    parser.add_option("--platforms", dest="platforms", default=4,
+                      type="int", help="number of distinct platform values "
+                      "(0 for none) [%default]")
+    parser.add_option("-c", "--clients", dest="clients", default=50,
+                      type="int", help="number of concurrent clients "
+                      "[%default]")
+    parser.add_option("-n", "--requests", dest="requests", default=20,
+                      type="int", help="manifest requests made by each "
+                      "client [%default]")
+    parser.add_option("--miss", dest="miss", default=0.1, type="float",
+                      help="fraction of requests matching no manifest "
+                      "[%default]")
+    parser.add_option("--one-step", dest="one_step", default=False,
+                      action="store_true", help="POST every criteria "
+                      "without asking for the criteria list first")
+    parser.add_option("--no-index", dest="index", default=True,
+                      action="store_false", help="do not compile the "
+                      "criteria index, so the webserver builds it from AI.db")
+    parser.add_option("-t", "--threads", dest="threads", default=10,
+                      type="int", help="webserver threads [%default]")
+    parser.add_option("-p", "--port", dest="port", default=0, type="int",
+                      help="port to run the webserver on [any free port]")
+    parser.add_option("--webserver", dest="webserver",
+                      default=os.path.join(os.path.dirname(
+                          os.path.abspath(__file__)), os.pardir,
+                          "webserver.py"),
+                      help="webserver to run [%default]")
+    parser.add_option("--seed", dest="seed", default=2010, type="int",
+                      help="random seed [%default]")
+    parser.add_option("-k", "--keep", dest="keep", default=False,
+                      action="store_true", help="keep the service "
+                      "directory built")
+
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error("Unexpected arguments: %s" % args)
+    if options.manifests < 1 or options.clients < 1 or options.requests < 1:
+        parser.error("There must be at least one manifest, client and "
+                     "request")
+    for (name, default) in (("mac", options.manifests),
+                            ("ipv4", options.manifests / 2),
+                            ("mem", options.manifests / 4)):
+        if getattr(options, name) is None:
+            setattr(options, name, default)
+        if not 0 <= getattr(options, name) <= options.manifests:
+            parser.error("--%s must be between 0 and the number of "
+                         "manifests" % name)
+    options.arches = min(max(options.arches, 0), len(ARCHES))
+    options.platforms = min(max(options.platforms, 0), len(PLATFORMS))
+    return options
+
+def manifest_row(options, index):
+    """
+    Returns the manifests table row of manifest index
+    """
+    low = index * BLOCK
+    row = ["bench%d.xml" % index, 0, None, None, None, None, None, None,
+           None, None, None, None, None]
+    if options.arches:
+        row[2] = ARCHES[index % options.arches]
+    if index < options.mac:
+        row[3:5] = [MAC_BASE + low, MAC_BASE + low + BLOCK - 1]
+    if index < options.ipv4:
+        row[5:7] = [IPV4_BASE + low, IPV4_BASE + low + BLOCK - 1]
+    if options.platforms:
+        row[8] = PLATFORMS[index % options.platforms]
+    if index < options.mem:
+        row[11:13] = [MEM_BASE + low, MEM_BASE + low + BLOCK - 1]
+    return row
+
+def build_service(options):
+    """
+    Builds an install service directory holding a synthetic AI.db and the
+    manifests it names.  Returns the directory's path.
+    """
+    service_dir = tempfile.mkdtemp(prefix="ai_bench")
+    data_dir = os.path.join(service_dir, "AI_data")
+    os.mkdir(data_dir)
+    os.mkdir(os.path.join(service_dir, "AI_files"))
+    database = os.path.join(service_dir, "AI.db")
+
+    con = sqlite.connect(database)
+    con.execute(MANIFESTS_TABLE)
+    con.executemany("INSERT INTO manifests VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                    (manifest_row(options, index)
+                     for index in range(options.manifests)))
+    # addresses are stored as integers, as they are from schema version 2
+    con.execute("PRAGMA user_version = %d" % AIdb.INTEGER_ADDRESS_VERSION)
+    con.commit()
+    con.close()
+
+    # bring the database to the current schema (adding the criteria
+    # indexes) just as installadm upgrade-db would
+    db = AIdb.DB(database, commit=True)
+    db.verifyDBStructure()
+    if options.index:
+        AIdb.writeCriteriaIndex(db.getQueue(), database)
+
+    for index in range(options.manifests):
+        store.store_manifest(data_dir, "bench%d.xml" % index,
+                             "<ai_manifest name=\"bench%d\"/>\n" % index)
+    open(os.path.join(data_dir, "default.xml"), "w").write(
+        "<ai_manifest name=\"default\"/>\n")
+    return service_dir
+
+def client_criteria(options, rand):
+    """
+    Returns a tuple of the criteria of a random client and the name of the
+    manifest it should be served
+    """
+    if rand.random() < options.miss:
+        # a client matching none of the manifests
+        index = options.manifests + rand.randint(0, 1000)
+        expected = "default"
+    else:
+        index = rand.randint(0, options.manifests - 1)
+        expected = "bench%d" % index
+    low = index * BLOCK + rand.randint(0, BLOCK - 1)
+    row = manifest_row(options, min(index, options.manifests - 1))
+    network = IPV4_BASE + low
+    criteria = {"arch": row[2] or rand.choice(ARCHES),
+                "cpu": rand.choice(["i386", "sparc"]),
+                "hostname": "client%d" % index,
+                "mac": "%12.12X" % (MAC_BASE + low),
+                "ipv4": "%3.3d%3.3d%3.3d%3.3d" % (network >> 24,
+                        network >> 16 & 0xff, network >> 8 & 0xff,
+                        network & 0xff),
+                "mem": str(MEM_BASE + low),
+                "platform": (row[8] or rand.choice(PLATFORMS)).upper()}
+    criteria["network"] = criteria["ipv4"][:9] + "000"
+    return (criteria, expected)
+
+def http_request(address, method, path, body=None):
+    """
+    Makes a request on a new connection (as ai_get_manifest does).
+    Returns a tuple of the response's status, its body and the request's
+    latency in seconds.
+    """
+    started = time.time()
+    conn = httplib.HTTPConnection(address)
+    try:
+        if method == "POST":
+            conn.request(method, path, body, {"Content-Type":
+                         "application/x-www-form-urlencoded"})
+        else:
+            conn.request(method, path)
+        response = conn.getresponse()
+        content = response.read()
+    finally:
+        conn.close()
+    return (response.status, content, time.time() - started)
+
+def post_data(criteria, version=None):
+    """
+    Returns the body of a POST of criteria to /manifest.xml
+    """
+    body = urllib.urlencode({"postData": ";".join(["%s=%s" % item for item in
+                                                   criteria.iteritems()])})
+    if version is not None:
+        body += "&" + urllib.urlencode({"version": version})
+    return body
+
+class Results(object):
+    """
+    Class gathering the latencies and outcomes of the simulated clients'
+    requests
+    """
+
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {"manifest": [], "GET": [], "POST": []}
+        self.wrong = 0
+        self.errors = 0
+
+    def add(self, kind, latency):
+        """ Records the latency of a request of kind """
+        self._lock.acquire()
+        try:
+            self.latencies[kind].append(latency)
+        finally:
+            self._lock.release()
+
+    def fail(self, wrong=0, errors=0):
+        """ Records wrong answers and failed requests """
+        self._lock.acquire()
+        try:
+            self.wrong += wrong
+            self.errors += errors
+        finally:
+            self._lock.release()
+
+def run_client(options, address, seed, results):
+    """
+    Runs one simulated client, asking for options.requests manifests
+    """
+    rand = random.Random(seed)
+    for request in range(options.requests):
+        (criteria, expected) = client_criteria(options, rand)
+        started = time.time()
+        try:
+            if options.one_step:
+                body = post_data(criteria, "1.0")
+            else:
+                (status, content, latency) = \
+                    http_request(address, "GET", "/manifest.xml")
+                results.add("GET", latency)
+                if status != httplib.OK:
+                    results.fail(errors=1)
+                    continue
+                wanted = re.findall(r'<Criteria Name="([^"]*)"', content)
+                body = post_data(dict([(name, criteria[name]) for name in
+                                       wanted if name in criteria]))
+            (status, content, latency) = \
+                http_request(address, "POST", "/manifest.xml", body)
+            results.add("POST", latency)
+        except (socket.error, httplib.HTTPException):
+            results.fail(errors=1)
+            continue
+        if status != httplib.OK:
+            results.fail(errors=1)
+            continue
+        results.add("manifest", time.time() - started)
+        if ("name=\"%s\"" % expected) not in content:
+            results.fail(wrong=1)
+
+def get_stats(address):
+    """
+    Returns the webserver's /stats counters as a dictionary
+    """
+    (status, content, latency) = http_request(address, "GET", "/stats")
+    stats = dict()
+    if status == httplib.OK:
+        for line in content.splitlines():
+            (name, sep, value) = line.partition(" ")
+            try:
+                stats[name] = float(value)
+            except ValueError:
+                pass
+    return stats
+
+def start_webserver(options, service_dir):
+    """
+    Starts the webserver on service_dir and waits for it to answer.
+    Returns a tuple of the webserver process and its address.
+    """
+    port = options.port
+    if not port:
+        # find a free port to run on
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+    address = "127.0.0.1:%d" % port
+    log = open(os.path.join(service_dir, "webserver.log"), "w")
+    server = subprocess.Popen([sys.executable, options.webserver,
+                               "-p", str(port), "-l", "127.0.0.1",
+                               "-t", str(options.threads), service_dir],
+                              stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise SystemExit("Webserver failed to start; see %s" %
+                             os.path.join(service_dir, "webserver.log"))
+        try:
+            if http_request(address, "GET", "/manifest.xml")[0] == \
+                httplib.OK:
+                return (server, address)
+        except socket.error:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise SystemExit("Webserver did not answer within 60 seconds")
+
+def percentile(latencies, fraction):
+    """
+    Returns the latency (sorted) latencies hold at fraction
+    """
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+def report(options, results, elapsed, before, after):
+    """
+    Prints the benchmark's results
+    """
+    manifests = len(results.latencies["manifest"])
+    requests = len(results.latencies["GET"]) + len(results.latencies["POST"])
+    print "%d manifests (mac %d, ipv4 %d, mem %d), %d clients x %d " \
+          "requests, %s, %s" % (options.manifests, options.mac, options.ipv4,
+          options.mem, options.clients, options.requests,
+          options.one_step and "one step" or "two step",
+          options.index and "criteria index" or "no criteria index")
+    print "elapsed %.2fs: %.1f manifests/s, %.1f HTTP requests/s" % \
+          (elapsed, manifests / elapsed, requests / elapsed)
+    print "failed %d, wrong manifest %d" % (results.errors, results.wrong)
+    print "%-10s %8s %10s %10s %10s %10s" % ("latency", "count", "mean ms",
+                                              "p50 ms", "p95 ms", "p99 ms")
+    for kind in ("manifest", "GET", "POST"):
+        latencies = sorted(results.latencies[kind])
+        if not latencies:
+            continue
+        print "%-10s %8d %10.2f %10.2f %10.2f %10.2f" % (kind,
+              len(latencies), 1000 * sum(latencies) / len(latencies),
+              1000 * percentile(latencies, 0.50),
+              1000 * percentile(latencies, 0.95),
+              1000 * percentile(latencies, 0.99))
+
+    queries = after.get("ai_db_requests", 0) - before.get("ai_db_requests", 0)
+    seconds = after.get("ai_db_seconds", 0) - before.get("ai_db_seconds", 0)
+    print "DB threads: %d queries, %.2fs (%.3f ms/query, %.2f " \
+          "queries/manifest, %.1f%% of the manifest latency)" % (queries,
+          seconds, queries and 1000 * seconds / queries or 0.0,
+          manifests and float(queries) / manifests or 0.0,
+          100 * seconds / (sum(results.latencies["manifest"]) or 1))
+    waits = after.get("ai_db_wait_seconds_count", 0) - \
+        before.get("ai_db_wait_seconds_count", 0)
+    if waits:
+        print "DB queue: %.3f ms mean wait, %.2f mean depth" % (1000 *
+              (after["ai_db_wait_seconds_sum"] -
+               before.get("ai_db_wait_seconds_sum", 0)) / waits,
+              (after["ai_db_queue_depth_sum"] -
+               before.get("ai_db_queue_depth_sum", 0)) / waits)
+
+def main():
+    """
+    Builds the service, starts the webserver and runs the clients against it
+    """
+    gettext.install("ai-test")
+    options = parse_options()
+    service_dir = build_service(options)
+    server = None
+    try:
+        (server, address) = start_webserver(options, service_dir)
+        results = Results()
+        clients = [threading.Thread(target=run_client,
+                                    args=(options, address,
+                                          options.seed + client, results))
+                   for client in range(options.clients)]
+        before = get_stats(address)
+        started = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.time() - started
+        after = get_stats(address)
+        report(options, results, elapsed, before, after)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if options.keep:
+            print "Service directory kept in %s" % service_dir
+        else:
+            shutil.rmtree(service_dir)
+
+if __name__ == '__main__':
+    main()
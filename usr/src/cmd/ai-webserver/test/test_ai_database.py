@@ -30,7 +30,13 @@ must be rebuilt for these tests to pick up any changes in the tested code.
 '''
 
 import gettext
+import os
+import random
+import tempfile
+import threading
+import time
 import unittest
+from sqlite3 import dbapi2 as sqlite
 import osol_install.auto_install.AI_database as AIdb
 
 gettext.install("ai-test")
@@ -55,9 +61,11 @@ class MockQuery(object):
     '''Class for mock query '''
     def __init__(self):
         self.query = None
+        self.params = None
 
-    def __call__(self, query, commit=False):
+    def __call__(self, query, commit=False, params=None):
         self.query = query
+        self.params = params
         return self
 
     def waitAns(self):
@@ -85,6 +93,727 @@ class MockDataFiles(object):
         self.criteria = None
         self.database = MockDataBase()
 
+def create_test_db(rows=()):
+    '''Create an AI.db with the manifests table as shipped by installadm,
+    populated with the given rows. Returns the path to the database.
+    '''
+    (fd, path) = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    con = sqlite.connect(path)
+    con.execute("CREATE TABLE manifests (name TEXT, instance INTEGER, "
+                "arch TEXT, MINmac INTEGER, MAXmac INTEGER, MINipv4 INTEGER, "
+                "MAXipv4 INTEGER, cpu TEXT, platform TEXT, MINnetwork "
+                "INTEGER, MAXnetwork INTEGER, MINmem INTEGER, MAXmem INTEGER)")
+    con.executemany("INSERT INTO manifests VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                    rows)
+    con.commit()
+    con.close()
+    return path
+
+def remove_test_db(path):
+    '''Remove a database created by create_test_db() and its WAL files'''
+    for name in (path, path + "-wal", path + "-shm"):
+        if os.path.exists(name):
+            os.remove(name)
+
+class DBPool(unittest.TestCase):
+    '''Tests for the DB reader pool'''
+
+    def setUp(self):
+        '''unit test set up'''
+        self.path = create_test_db([("a.xml", 0, "i86pc") + (None,) * 10,
+                                    ("b.xml", 0, "sun4v") + (None,) * 10])
+
+    def tearDown(self):
+        '''unit test tear down'''
+        remove_test_db(self.path)
+
+    def test_pool_reads(self):
+        '''Verify many queued reads are all answered by the pool'''
+        db = AIdb.DB(self.path, readers=4)
+        queries = [AIdb.DBrequest("SELECT name FROM manifests WHERE "
+                                  "arch = 'sun4v'") for i in range(50)]
+        for query in queries:
+            db.getQueue().put(query)
+        for query in queries:
+            query.waitAns()
+            self.assertEqual(query.getResponse()[0]['name'], "b.xml")
+
+    def test_pool_wal(self):
+        '''Verify a pooled database is switched to WAL mode'''
+        db = AIdb.DB(self.path, readers=2)
+        query = AIdb.DBrequest("PRAGMA journal_mode")
+        db.getQueue().put(query)
+        query.waitAns()
+        self.assertEqual(query.getResponse()[0][0], "wal")
+
+    def test_pool_writer(self):
+        '''Verify commits go through the writer and are seen by readers'''
+        db = AIdb.DB(self.path, commit=True, readers=3)
+        query = AIdb.DBrequest("DELETE FROM manifests WHERE name = 'a.xml'",
+                               commit=True)
+        db.getQueue().put(query)
+        query.waitAns()
+        self.assertEqual(query.getResponse(), [])
+        self.assertEqual(AIdb.numManifests(db.getQueue()), 1)
+
+    def test_close(self):
+        '''Verify close() runs the requests queued and stops the threads'''
+        threads = threading.activeCount()
+        db = AIdb.DB(self.path, commit=True, readers=2)
+        self.assertEqual(threading.activeCount(), threads + 3)
+        query = AIdb.DBrequest("SELECT name FROM manifests")
+        db.getQueue().put(query)
+        db.close()
+        self.assertTrue(query.isFinished())
+        self.assertEqual(threading.activeCount(), threads)
+
+    def test_pool_read_only(self):
+        '''Verify a pool without a writer refuses commit requests'''
+        db = AIdb.DB(self.path, readers=2)
+        query = AIdb.DBrequest("DELETE FROM manifests", commit=True)
+        db.getQueue().put(query)
+        query.waitAns()
+        self.assertTrue(query.isFinished())
+        self.assertEqual(AIdb.numManifests(db.getQueue()), 2)
+
+    def test_pool_stats(self):
+        '''Verify the pool accounts the requests it runs'''
+        stats = AIdb.DBstats()
+        db = AIdb.DB(self.path, readers=2, stats=stats)
+        db.executeMany(["SELECT name FROM manifests"] * 5 +
+                       ["SELECT nonesuch FROM manifests"])
+        # a request is accounted just after it is answered
+        deadline = time.time() + 5
+        while dict(stats.stats())["ai_db_requests"] < 6 and \
+            time.time() < deadline:
+            time.sleep(0.01)
+        counters = dict(stats.stats())
+        self.assertEqual(counters["ai_db_requests"], 6)
+        self.assertEqual(counters["ai_db_errors"], 1)
+        self.assertEqual(counters["ai_db_wait_seconds"]["count"], 6)
+        self.assertEqual(counters["ai_db_queue_depth"]["count"], 6)
+
+class DBrequestFuture(unittest.TestCase):
+    '''Tests for pipelined DBrequests, callbacks and deadlines'''
+
+    def setUp(self):
+        '''unit test set up'''
+        self.path = create_test_db([("a.xml", 0, "i86pc") + (None,) * 10,
+                                    ("b.xml", 0, "sun4v") + (None,) * 10])
+        self.db = AIdb.DB(self.path, commit=True)
+
+    def tearDown(self):
+        '''unit test tear down'''
+        remove_test_db(self.path)
+
+    def test_execute_many(self):
+        '''Verify executeMany() answers each request in order'''
+        queries = self.db.executeMany(
+            ["SELECT COUNT(*) FROM manifests",
+             AIdb.DBrequest("SELECT name FROM manifests WHERE arch = ?",
+                            params=("sun4v",))])
+        self.assertEqual(queries[0].getResult()[0][0], 2)
+        self.assertEqual(queries[1].getResult()[0]['name'], "b.xml")
+
+    def test_callback(self):
+        '''Verify callbacks are called once the request finishes'''
+        finished = list()
+        query = AIdb.DBrequest("SELECT name FROM manifests",
+                               callback=finished.append)
+        self.db.getQueue().put(query)
+        query.waitAns()
+        self.assertEqual(finished, [query])
+        # a callback added to a finished request is called at once
+        query.addCallback(finished.append)
+        self.assertEqual(finished, [query, query])
+
+    def test_callback_error(self):
+        '''Verify the error of a failed callback is re-raised'''
+        def fail(request):
+            '''callback failing'''
+            raise ValueError("callback failed")
+        finished = list()
+        query = AIdb.DBrequest("SELECT name FROM manifests", callback=fail)
+        query.addCallback(finished.append)
+        self.db.getQueue().put(query)
+        query.waitAns()
+        # later callbacks are still called
+        self.assertEqual(finished, [query])
+        self.assertRaises(ValueError, query.getResponse)
+        self.assertRaises(ValueError, query.getResult)
+
+    def test_deadline(self):
+        '''Verify a request past its deadline is not run'''
+        query = AIdb.DBrequest("DELETE FROM manifests", commit=True,
+                               timeout=0.01)
+        time.sleep(0.05)
+        self.db.getQueue().put(query)
+        self.assertRaises(AIdb.DBError, query.getResult)
+        self.assertEqual(AIdb.numManifests(self.db.getQueue()), 2)
+
+    def test_timeout(self):
+        '''Verify an unanswered request times out'''
+        query = AIdb.DBrequest("SELECT name FROM manifests", timeout=0.1)
+        self.assertFalse(query.waitAns())
+        self.assertRaises(AIdb.DBTimeout, query.getResult)
+
+    def test_commit_error(self):
+        '''Verify a failed commit raises a DBError'''
+        query = AIdb.DBrequest("DELETE FROM nosuchtable", commit=True)
+        self.db.getQueue().put(query)
+        query.waitAns()
+        self.assertRaises(AIdb.DBError, query.getResponse)
+
+    def test_transaction(self):
+        '''Verify a DBtransaction commits its reads and writes together'''
+        def copy_arch(cursor):
+            '''transaction adding an instance of a.xml'''
+            cursor.execute("SELECT COUNT(*) FROM manifests WHERE name = ?",
+                           ("a.xml",))
+            instance = cursor.fetchone()[0]
+            cursor.execute("INSERT INTO manifests (name, instance, arch) "
+                           "VALUES (?, ?, ?)", ("a.xml", instance, "sparc"))
+            return [instance]
+        query = AIdb.DBtransaction(copy_arch)
+        self.db.getQueue().put(query)
+        self.assertEqual(query.getResult(), [1])
+        self.assertEqual(AIdb.numInstances("a.xml", self.db.getQueue()), 2)
+
+    def test_transaction_rollback(self):
+        '''Verify a failed DBtransaction is rolled back and re-raised'''
+        def delete_all(cursor):
+            '''transaction failing after a write'''
+            cursor.execute("DELETE FROM manifests")
+            raise SystemExit("collision")
+        query = AIdb.DBtransaction(delete_all)
+        self.db.getQueue().put(query)
+        self.assertRaises(SystemExit, query.getResult)
+        self.assertEqual(AIdb.numManifests(self.db.getQueue()), 2)
+        # the DB thread carries on
+        query = AIdb.DBrequest("DELETE FROM manifests WHERE name = 'b.xml'",
+                               commit=True)
+        self.db.getQueue().put(query)
+        query.getResult()
+        self.assertEqual(AIdb.numManifests(self.db.getQueue()), 1)
+
+    def test_batch(self):
+        '''Verify a DBbatch inserts every row'''
+        query = AIdb.DBbatch("INSERT INTO manifests (name, instance, arch) "
+                             "VALUES(?, ?, ?)",
+                             [("c%d.xml" % i, 0, "i86pc") for i in range(20)])
+        self.db.getQueue().put(query)
+        self.assertEqual(query.getResult(), [])
+        self.assertEqual(AIdb.numManifests(self.db.getQueue()), 22)
+
+    def test_batch_rollback(self):
+        '''Verify a failed DBbatch inserts no rows'''
+        query = AIdb.DBbatch("INSERT INTO manifests (name, instance, arch) "
+                             "VALUES(?, ?, ?)",
+                             [("c.xml", 0, "i86pc"), ("d.xml", 0)])
+        self.db.getQueue().put(query)
+        self.assertRaises(AIdb.DBError, query.getResult)
+        self.assertEqual(AIdb.numManifests(self.db.getQueue()), 2)
+
+def find_manifest_iterative(criteria, db):
+    '''Reference implementation of findManifest() which narrows the
+    candidate manifests with one query per criteria column (as the AI
+    webserver originally did)
+    '''
+    if len(criteria) == 0:
+        return 0
+
+    query_str = "SELECT name FROM manifests WHERE "
+    params = list()
+    for crit in AIdb.getCriteria(db.getQueue(), strip=False):
+        query_str1 = query_str
+        try:
+            if crit.startswith("MIN"):
+                query_str1 += crit + " <= ?"
+                value = AIdb.rangeValue(crit,
+                    criteria[crit.replace('MIN', '', 1)])
+            elif crit.startswith("MAX"):
+                query_str1 += crit + " >= ?"
+                value = AIdb.rangeValue(crit,
+                    criteria[crit.replace('MAX', '', 1)])
+            else:
+                query_str1 += crit + ' = LOWER(?)'
+                value = criteria[crit]
+        except KeyError:
+            return 0
+        query = AIdb.DBrequest(query_str1, params=params + [value])
+        db.getQueue().put(query)
+        query.waitAns()
+        if query.getResponse() is None:
+            return 0
+        if len(query.getResponse()) >= 1:
+            query_str = query_str1 + " AND "
+            params.append(value)
+        else:
+            query_str += crit + " IS NULL AND "
+    query = AIdb.DBrequest(query_str[:-5], params=params)
+    db.getQueue().put(query)
+    query.waitAns()
+    if len(query.getResponse()) == 1:
+        return query.getResponse()[0]['name']
+    return len(query.getResponse())
+
+class CountingQueue(object):
+    '''Class wrapping a DB queue to count the requests put on it'''
+    def __init__(self, queue):
+        self.queue = queue
+        self.puts = 0
+
+    def put(self, query):
+        self.puts += 1
+        self.queue.put(query)
+
+    def getMetadata(self):
+        return self.queue.getMetadata()
+
+class DBmetadata(unittest.TestCase):
+    '''Tests for the DBmetadata cache'''
+
+    def setUp(self):
+        '''unit test set up'''
+        self.path = create_test_db([("a.xml", 0, "i86pc") + (None,) * 10])
+        self.db = AIdb.DB(self.path, commit=True)
+        self.queue = CountingQueue(self.db.getQueue())
+
+    def tearDown(self):
+        '''unit test tear down'''
+        remove_test_db(self.path)
+
+    def test_cached(self):
+        '''Verify criteria are only read from the database once'''
+        self.assertEqual(list(AIdb.getCriteria(self.queue)), ["arch"])
+        puts = self.queue.puts
+        self.assertEqual(list(AIdb.getCriteria(self.queue)), ["arch"])
+        self.assertEqual(len(list(AIdb.getCriteria(self.queue,
+            onlyUsed=False, strip=False))), 11)
+        self.assertTrue(AIdb.isRangeCriteria(self.queue, "mem"))
+        self.assertFalse(AIdb.isRangeCriteria(self.queue, "arch"))
+        self.assertEqual(self.queue.puts, puts)
+
+    def test_invalidated_on_commit(self):
+        '''Verify a commit invalidates the cached criteria'''
+        self.assertEqual(list(AIdb.getCriteria(self.queue)), ["arch"])
+        query = AIdb.DBrequest("UPDATE manifests SET MINmem = 512",
+                               commit=True)
+        self.queue.put(query)
+        query.waitAns()
+        self.assertEqual(list(AIdb.getCriteria(self.queue)), ["arch", "mem"])
+        self.assertEqual(list(AIdb.getCriteria(self.queue, strip=False)),
+                         ["arch", "MINmem"])
+
+    def test_invalidated_on_change(self):
+        '''Verify a change by another process invalidates the cache'''
+        self.assertEqual(list(AIdb.getCriteria(self.queue)), ["arch"])
+        con = sqlite.connect(self.path)
+        con.execute("INSERT INTO manifests (name, instance, cpu) "
+                    "VALUES ('b.xml', 0, 'sparc')")
+        con.commit()
+        con.close()
+        # ensure the database stamp changes on coarse grained file systems
+        os.utime(self.path, (0, 0))
+        self.assertEqual(list(AIdb.getCriteria(self.queue)), ["arch", "cpu"])
+
+class getManifestTable(unittest.TestCase):
+    '''Tests for getManifestTable and getManNames'''
+
+    def setUp(self):
+        '''unit test set up'''
+        self.path = create_test_db(
+            [("b.xml", 1, "sun4v") + (None,) * 10,
+             ("a.xml", 0, "i86pc", 0x080027510CC7, None) + (None,) * 8,
+             ("b.xml", 0, "sun4u") + (None,) * 10] +
+            [("c%03d.xml" % i, 0, "i86pc") + (None,) * 10
+             for i in range(600)])
+        self.db = AIdb.DB(self.path)
+
+    def tearDown(self):
+        '''unit test tear down'''
+        remove_test_db(self.path)
+
+    def test_man_names(self):
+        '''Verify all manifest names are provided'''
+        names = list(AIdb.getManNames(self.db.getQueue()))
+        self.assertEqual(len(names), 602)
+        self.assertEqual(sorted(names)[:3], ["a.xml", "b.xml", "c000.xml"])
+
+    def test_table(self):
+        '''Verify manifests, instances and criteria are provided'''
+        table = list(AIdb.getManifestTable(self.db.getQueue(),
+                                           humanOutput=True))
+        self.assertEqual(len(table), 602)
+        (name, instances) = table[0]
+        self.assertEqual(name, "a.xml")
+        self.assertEqual(instances[0].keys(), ["arch", "MINmac"])
+        self.assertEqual(instances[0]["MINmac"], "080027510CC7")
+        (name, instances) = table[1]
+        self.assertEqual(name, "b.xml")
+        self.assertEqual([crit["arch"] for crit in instances],
+                         ["sun4u", "sun4v"])
+
+    def test_table_criteria(self):
+        '''Verify the table agrees with getManifestCriteria()'''
+        for name, instances in AIdb.getManifestTable(self.db.getQueue(),
+                                                     onlyUsed=False):
+            self.assertEqual(len(instances),
+                             AIdb.numInstances(name, self.db.getQueue()))
+            for instance, criteria in enumerate(instances):
+                row = AIdb.getManifestCriteria(name, instance,
+                                               self.db.getQueue(),
+                                               onlyUsed=False)
+                self.assertEqual(criteria.items(), zip(row.keys(), row))
+            if name == "c010.xml":
+                break
+
+class upgradeDB(unittest.TestCase):
+    '''Tests for the schema version and upgradeDB'''
+
+    def setUp(self):
+        '''unit test set up'''
+        self.path = create_test_db(
+            [("a.xml", 0, "i86pc") + (None,) * 8 + (512, 2048)])
+
+    def tearDown(self):
+        '''unit test tear down'''
+        remove_test_db(self.path)
+
+    def indexes(self):
+        '''Return the names of the indexes on the manifests table'''
+        con = sqlite.connect(self.path)
+        names = [row[0] for row in con.execute("SELECT name FROM "
+                 "sqlite_master WHERE type = 'index' AND "
+                 "tbl_name = 'manifests'")]
+        con.close()
+        return sorted(names)
+
+    def test_upgrade(self):
+        '''Verify a committable DB is upgraded by verifyDBStructure'''
+        db = AIdb.DB(self.path, commit=True)
+        self.assertEqual(AIdb.getSchemaVersion(db.getQueue()), 0)
+        db.verifyDBStructure()
+        self.assertEqual(AIdb.getSchemaVersion(db.getQueue()),
+                         AIdb.SCHEMA_VERSION)
+        self.assertEqual(self.indexes(),
+                         ["manifests_arch", "manifests_cpu", "manifests_ipv4",
+                          "manifests_mac", "manifests_mem", "manifests_name",
+                          "manifests_network", "manifests_platform"])
+        # a current database is left alone
+        self.assertEqual(AIdb.upgradeDB(db.getQueue()), AIdb.SCHEMA_VERSION)
+        self.assertEqual(len(self.indexes()), 8)
+        self.assertEqual(AIdb.findManifest({"arch": "i86pc", "mem": "1024"},
+                                           db), "a.xml")
+
+    def test_read_only(self):
+        '''Verify a read-only DB upgrades a database it can not read'''
+        db = AIdb.DB(self.path, readers=2)
+        threads = threading.activeCount()
+        db.verifyDBStructure()
+        # the DB thread upgrading the database was stopped
+        self.assertEqual(threading.activeCount(), threads)
+        self.assertEqual(AIdb.getSchemaVersion(db.getQueue()),
+                         AIdb.SCHEMA_VERSION)
+        self.assertEqual(len(self.indexes()), 8)
+        self.assertEqual(AIdb.findManifest({"arch": "i86pc", "mem": "1024"},
+                                           db), "a.xml")
+
+    def test_read_only_refused(self):
+        '''Verify a read-only DB is refused if it can not be upgraded'''
+        def failUpgrade(queue):
+            '''upgradeDB() of a database which may not be written'''
+            raise SystemExit("attempt to write a readonly database")
+        upgradeDB = AIdb.upgradeDB
+        AIdb.upgradeDB = failUpgrade
+        try:
+            db = AIdb.DB(self.path)
+            self.assertRaises(SystemExit, db.verifyDBStructure)
+        finally:
+            AIdb.upgradeDB = upgradeDB
+        self.assertEqual(AIdb.getSchemaVersion(db.getQueue()), 0)
+
+    def test_convert_addresses(self):
+        '''Verify mac and IPv4 addresses are converted to integers'''
+        remove_test_db(self.path)
+        self.path = create_test_db(
+            [("a.xml", 0, None, buffer("\x08\x00\x27\x51\x0c\xc7"),
+              buffer("\x08\x00\x27\x51\x0c\xff"), 10000030100,
+              None) + (None,) * 6,
+             ("b.xml", 0, "i86pc", None, None, 172020025012,
+              172020025012) + (None,) * 6])
+        db = AIdb.DB(self.path, commit=True)
+        db.verifyDBStructure()
+        self.assertEqual(AIdb.getSchemaVersion(db.getQueue()),
+                         AIdb.SCHEMA_VERSION)
+        table = dict(AIdb.getManifestTable(db.getQueue()))
+        self.assertEqual(table["a.xml"][0].values(),
+                         [None, 0x080027510CC7, 0x080027510CFF, 0x0A001E64,
+                          None])
+        self.assertEqual(table["b.xml"][0]["MINipv4"], 0xAC14190C)
+        self.assertEqual(AIdb.formatValue("MINipv4",
+                                          table["b.xml"][0]["MINipv4"]),
+                         "172.20.25.12")
+        self.assertEqual(AIdb.findManifest({"arch": "sparc",
+                                            "mac": "080027510CD0",
+                                            "ipv4": "010000030100"}, db),
+                         "a.xml")
+
+class boundParameters(unittest.TestCase):
+    '''Tests for queries binding their values as parameters'''
+
+    def setUp(self):
+        '''unit test set up'''
+        # a manifest named after a column and one with quotes in its name
+        self.path = create_test_db(
+            [("arch", 0, "i86pc") + (None,) * 10,
+             ("o'neil \"2\".xml", 0, "sun4v") + (None,) * 10,
+             ("o'neil \"2\".xml", 1, "sun4u") + (None,) * 10])
+        self.db = AIdb.DB(self.path)
+
+    def tearDown(self):
+        '''unit test tear down'''
+        remove_test_db(self.path)
+
+    def test_num_instances(self):
+        '''Verify names are compared as values not SQL'''
+        queue = self.db.getQueue()
+        self.assertEqual(AIdb.numInstances("arch", queue), 1)
+        self.assertEqual(AIdb.numInstances("o'neil \"2\".xml", queue), 2)
+        self.assertEqual(AIdb.numInstances("i86pc", queue), 0)
+
+    def test_manifest_criteria(self):
+        '''Verify the criteria of a quoted manifest name are found'''
+        row = AIdb.getManifestCriteria("o'neil \"2\".xml", 1,
+                                       self.db.getQueue())
+        self.assertEqual(row["arch"], "sun4u")
+
+    def test_exclude(self):
+        '''Verify excluded manifests are not returned'''
+        rows = AIdb.getSpecificCriteria(self.db.getQueue(), "arch",
+                                        excludeManifests=["o'neil \"2\".xml"])
+        self.assertEqual([row[0] for row in rows], ["i86pc"])
+
+    def test_special_characters(self):
+        '''Verify values are matched as given, SQL characters and all'''
+        remove_test_db(self.path)
+        self.path = create_test_db(
+            [("a,b.xml", 0, None, None, None, None, None, None,
+              "sunw,sun-fire-t200") + (None,) * 4,
+             ("c.xml", 0, None, None, None, None, None, None,
+              "sunwsun-fire-t200") + (None,) * 4])
+        self.db = AIdb.DB(self.path)
+        criteria = {"platform": "SUNW,Sun-Fire-T200"}
+        self.assertEqual(AIdb.criteriaValue("platform", criteria),
+                         "SUNW,Sun-Fire-T200")
+        self.assertEqual(AIdb.findManifest(criteria, self.db), "a,b.xml")
+        index = AIdb.getCriteriaIndex(self.db.getQueue())
+        self.assertEqual(index.findManifest(criteria), "a,b.xml")
+
+class findManifest(unittest.TestCase):
+    '''Tests for findManifest'''
+
+    ARCHES = ["i86pc", "sun4u", "sun4v"]
+    CPUS = ["i386", "sparc"]
+    PLATFORMS = ["i86pc", "sunw,sun-fire-t200", "sunw,sun-blade-1000"]
+
+    def setUp(self):
+        '''unit test set up'''
+        self.random = random.Random(2010)
+        self.path = None
+
+    def tearDown(self):
+        '''unit test tear down'''
+        if self.path is not None:
+            remove_test_db(self.path)
+
+    def random_range(self, low, high, fmt=None):
+        '''Return a random (MIN, MAX) database pair, NULL or unbounded'''
+        choice = self.random.randint(0, 5)
+        if choice > 3:
+            return (None, None)
+        bounds = sorted([self.random.randint(low, high),
+                         self.random.randint(low, high)])
+        if choice == 1:
+            bounds[0] = None
+        elif choice == 2:
+            bounds[1] = None
+        if fmt is not None:
+            bounds = [bound is not None and fmt(bound) or None
+                      for bound in bounds]
+        return tuple(bounds)
+
+    def random_value(self, values):
+        '''Return a random value from values or NULL'''
+        return self.random.choice(values + [None] * len(values))
+
+    def random_row(self, name):
+        '''Return a random manifests table row'''
+        return ((name, 0, self.random_value(self.ARCHES)) +
+                self.random_range(0x080027000000, 0x080027000010) +
+                self.random_range(0x0A000200, 0x0A00020F) +
+                (self.random_value(self.CPUS),
+                 self.random_value(self.PLATFORMS)) +
+                self.random_range(10000002000, 10000002003) +
+                self.random_range(256, 4096))
+
+    def random_client(self):
+        '''Return random client criteria'''
+        return {"arch": self.random.choice(self.ARCHES),
+                "mac": "%12.12X" % self.random.randint(0x080027000000,
+                                                       0x080027000010),
+                "ipv4": "%12.12d" % self.random.randint(10000002000,
+                                                        10000002015),
+                "cpu": self.random.choice(self.CPUS),
+                "platform": self.random.choice(self.PLATFORMS).upper(),
+                "network": "%12.12d" % self.random.randint(10000002000,
+                                                           10000002003),
+                "mem": str(self.random.randint(256, 4096))}
+
+    def test_no_criteria(self):
+        '''Verify no criteria provides no manifest'''
+        self.path = create_test_db()
+        db = AIdb.DB(self.path)
+        self.assertEqual(AIdb.findManifest({}, db), 0)
+
+    def test_single_match(self):
+        '''Verify a manifest is found by value and range criteria'''
+        self.path = create_test_db([
+            ("a.xml", 0, "sun4v") + (None,) * 8 + (1024, None),
+            ("b.xml", 0, "sun4v") + (None,) * 8 + (None, 1023),
+            ("c.xml", 0, "i86pc") + (None,) * 10])
+        db = AIdb.DB(self.path)
+        self.assertEqual(AIdb.findManifest({"arch": "SUN4V", "mem": "2048"},
+                                           db), "a.xml")
+        self.assertEqual(AIdb.findManifest({"arch": "sun4v", "mem": "512"},
+                                           db), "b.xml")
+        self.assertEqual(AIdb.findManifest({"arch": "i86pc", "mem": "512"},
+                                           db), "c.xml")
+
+    def test_missing_criteria(self):
+        '''Verify a client not providing a used criteria gets no manifest'''
+        self.path = create_test_db([("a.xml", 0, "sun4v") + (None,) * 10])
+        db = AIdb.DB(self.path)
+        self.assertEqual(AIdb.findManifest({"mem": "2048"}, db), 0)
+
+    def test_bad_criteria(self):
+        '''Verify malformed client values get no manifest'''
+        self.path = create_test_db([
+            ("a.xml", 0, None, 0x080027000000, None) + (None,) * 6 +
+            (1024, None)])
+        db = AIdb.DB(self.path)
+        self.assertEqual(AIdb.findManifest({"mac": "080027000", "mem": "1"},
+                                           db), 0)
+        self.assertEqual(AIdb.findManifest({"mac": "080027000000",
+                                            "mem": "lots"}, db), 0)
+
+    def random_rows(self):
+        '''Return a random manifests table'''
+        rows = [self.random_row("%d.xml" % i)
+                for i in range(self.random.randint(1, 30))]
+        # include some indeterminate (duplicated) criteria sets too
+        rows += [("dup" + row[0],) + row[1:]
+                 for row in self.random.sample(rows, len(rows) / 5)]
+        return rows
+
+    def test_index(self):
+        '''Verify CriteriaIndex answers as findManifest() does'''
+        self.path = create_test_db([
+            ("a.xml", 0, "sun4v") + (None,) * 8 + (1024, None),
+            ("b.xml", 0, "sun4v") + (None,) * 8 + (None, 1023),
+            ("c.xml", 0, "i86pc") + (None,) * 10])
+        index = AIdb.getCriteriaIndex(AIdb.DB(self.path).getQueue())
+        self.assertEqual(index.findManifest({"arch": "SUN4V", "mem": "2048"}),
+                         "a.xml")
+        self.assertEqual(index.findManifest({"arch": "sun4v", "mem": "512"}),
+                         "b.xml")
+        self.assertEqual(index.findManifest({"arch": "i86pc", "mem": "512"}),
+                         "c.xml")
+        self.assertEqual(index.findManifest({"arch": "i86pc"}), 0)
+        self.assertEqual(index.findManifest({"arch": "i86pc", "mem": "x"}), 0)
+        self.assertEqual(index.findManifest({}), 0)
+
+    def test_index_randomized_equivalence(self):
+        '''Verify CriteriaIndex agrees with findManifest()'''
+        for table in range(10):
+            self.path = create_test_db(self.random_rows())
+            db = AIdb.DB(self.path)
+            index = AIdb.getCriteriaIndex(db.getQueue())
+            for client in range(20):
+                criteria = self.random_client()
+                self.assertEqual(index.findManifest(criteria),
+                                 AIdb.findManifest(criteria, db))
+            remove_test_db(self.path)
+            self.path = None
+
+    def test_index_file(self):
+        '''Verify a CriteriaIndex read back from its file agrees'''
+        self.path = create_test_db(self.random_rows())
+        db = AIdb.DB(self.path)
+        AIdb.writeCriteriaIndex(db.getQueue(), self.path)
+        index_file = os.path.join(os.path.dirname(self.path),
+                                  AIdb.INDEX_FILE)
+        try:
+            index = AIdb.CriteriaIndex.load(index_file)
+            # the index records the database it was compiled from
+            self.assertEqual(index.getGeneration(),
+                             AIdb.getDBStamp(self.path))
+            self.assertEqual(index.getCriteria(),
+                             list(AIdb.getCriteria(db.getQueue(),
+                                                   strip=True)))
+            for client in range(50):
+                criteria = self.random_client()
+                self.assertEqual(index.findManifest(criteria),
+                                 AIdb.findManifest(criteria, db))
+            # a file which is not an index is refused
+            open(index_file, "wb").write("AI criteria index 0\n")
+            self.assertRaises(ValueError, AIdb.CriteriaIndex.load, index_file)
+            open(index_file, "wb").write(AIdb.INDEX_MAGIC + " %d\n" %
+                                         AIdb.INDEX_VERSION)
+            self.assertRaises(ValueError, AIdb.CriteriaIndex.load, index_file)
+        finally:
+            os.remove(index_file)
+
+    def test_index_generation(self):
+        '''Verify a CriteriaIndex is told apart from a changed database'''
+        self.path = create_test_db(self.random_rows())
+        # the webserver's readers put the database in WAL mode
+        reader = AIdb.DB(self.path, readers=2)
+        self.assertTrue(AIdb.getCriteria(reader.getQueue()))
+        db = AIdb.DB(self.path, commit=True)
+        AIdb.writeCriteriaIndex(db.getQueue(), self.path)
+        index_file = os.path.join(os.path.dirname(self.path),
+                                  AIdb.INDEX_FILE)
+        try:
+            generation = AIdb.CriteriaIndex.load(index_file).getGeneration()
+            # the write-ahead log was emptied, so the database being closed
+            # (removing the log) does not change its stamp
+            self.assertEqual(generation[1], None)
+            self.assertEqual(generation, AIdb.getDBStamp(self.path))
+            con = sqlite.connect(self.path)
+            con.execute("INSERT INTO manifests (name, instance, arch) "
+                        "VALUES ('new.xml', 0, 'sparc')")
+            con.commit()
+            con.close()
+            self.assertNotEqual(generation, AIdb.getDBStamp(self.path))
+        finally:
+            os.remove(index_file)
+
+    def test_randomized_equivalence(self):
+        '''Verify findManifest() agrees with iterative narrowing'''
+        for table in range(10):
+            rows = self.random_rows()
+            self.path = create_test_db(rows)
+            db = AIdb.DB(self.path)
+            for client in range(20):
+                criteria = self.random_client()
+                self.assertEqual(AIdb.findManifest(criteria, db),
+                                 find_manifest_iterative(criteria, db),
+                                 "%s with %s" % (criteria, rows))
+            remove_test_db(self.path)
+            self.path = None
+
 class getSpecificCriteria(unittest.TestCase):
     '''Tests for getSpecificCriteria'''
 
@@ -116,8 +845,9 @@ class getSpecificCriteria(unittest.TestCase):
         queue = self.files.database.getQueue()
         AIdb.getSpecificCriteria(queue, criteria, excludeManifests=["suexml"])
         expect_query = "SELECT arch FROM manifests WHERE arch IS NOT NULL " + \
-                       "AND name IS NOT 'suexml'"
+                       "AND name IS NOT ?"
         self.assertEquals(expect_query, self.mockquery.query)
+        self.assertEquals(("suexml",), self.mockquery.params)
 
     def test_MINipv4(self):
         '''Verify single MIN query string '''
@@ -153,7 +883,7 @@ class getSpecificCriteria(unittest.TestCase):
         criteria2 = "MAXmac"
         queue = self.files.database.getQueue()
         AIdb.getSpecificCriteria(queue, criteria, criteria2=criteria2)
-        expect_query = "SELECT HEX(MINmac), HEX(MAXmac) FROM manifests " + \
+        expect_query = "SELECT MINmac, MAXmac FROM manifests " + \
                        "WHERE (MINmac IS NOT NULL OR MAXmac IS NOT NULL)"
         self.assertEquals(expect_query, self.mockquery.query)
 
@@ -230,6 +960,14 @@ class formatValue(unittest.TestCase):
         for k, bits in enumerate(fmt.split(':')):
             self.assertEqual(bits, self.mac[k*2:(k*2)+2])
 
+    def test_address_formatValue(self):
+        '''Ensure that stored integer addresses are formatted alike'''
+        self.assertEqual(AIdb.formatValue('MAXmac', 0x080027510CC7),
+                         AIdb.formatValue('MAXmac', self.mac))
+        self.assertEqual(AIdb.formatValue('MAXipv4', 0x0A00020F),
+                         AIdb.formatValue('MAXipv4', self.ipv4))
+        self.assertEqual(AIdb.formatValue('MAXipv4', 0x0A00020F), "10.0.2.15")
+
     def test_mem_formatValue(self):
         '''Ensure that memory criteria is formatted appropriately'''
         fmt = AIdb.formatValue('MINmem', self.mem)
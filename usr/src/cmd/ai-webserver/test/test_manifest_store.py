@@ -0,0 +1,109 @@
+#!/usr/bin/python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+# Copyright (c) 2010, Oracle and/or its affiliates. All rights reserved.
+#
+
+'''
+To run these tests, see the instructions in usr/src/tools/tests/README.
+Remember that since the proto area is used for the PYTHONPATH, the gate
+must be rebuilt for these tests to pick up any changes in the tested code.
+
+'''
+
+import gettext
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+import osol_install.auto_install.manifest_store as store
+
+
+gettext.install("ai-test")
+
+class StoreManifest(unittest.TestCase):
+    '''Tests for the content-addressed manifest store'''
+
+    def setUp(self):
+        '''unit test set up'''
+        self.data_dir = tempfile.mkdtemp()
+        self.content = "<ai_manifest name=\"a\"/>\n" * 100
+
+    def tearDown(self):
+        '''unit test tear down'''
+        shutil.rmtree(self.data_dir)
+
+    def stored(self):
+        '''Return the names of the files in the store'''
+        return sorted(os.listdir(os.path.join(self.data_dir,
+                                              store.STORE_DIR)))
+
+    def test_store(self):
+        '''Verify a manifest is stored by hash with a compressed copy'''
+        digest = store.store_manifest(self.data_dir, "a.xml", self.content)
+        self.assertEqual(digest, hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(store.manifest_hash(self.data_dir, "a.xml"), digest)
+        self.assertEqual(open(os.path.join(self.data_dir, "a.xml")).read(),
+                         self.content)
+        compressed = gzip.open(store.gzip_path(self.data_dir, digest))
+        self.assertEqual(compressed.read(), self.content)
+        compressed.close()
+        self.assertEqual(self.stored(), [digest, digest + store.GZIP_SUFFIX])
+        self.assertEqual(os.stat(os.path.join(self.data_dir,
+                                              "a.xml")).st_mode & 0777, 0600)
+
+    def test_shared(self):
+        '''Verify identical manifests share one stored copy'''
+        digest = store.store_manifest(self.data_dir, "a.xml", self.content)
+        self.assertEqual(store.store_manifest(self.data_dir, "b.xml",
+                                              self.content), digest)
+        self.assertEqual(len(self.stored()), 2)
+        store.remove_manifest(self.data_dir, "a.xml")
+        self.assertFalse(os.path.exists(os.path.join(self.data_dir,
+                                                     "a.xml")))
+        self.assertEqual(len(self.stored()), 2)
+        store.remove_manifest(self.data_dir, "b.xml")
+        self.assertEqual(self.stored(), [])
+
+    def test_replace(self):
+        '''Verify replacing a manifest drops its unused stored copy'''
+        store.store_manifest(self.data_dir, "a.xml", self.content)
+        digest = store.store_manifest(self.data_dir, "a.xml", "<b/>\n")
+        self.assertEqual(self.stored(), [digest, digest + store.GZIP_SUFFIX])
+        self.assertEqual(open(os.path.join(self.data_dir, "a.xml")).read(),
+                         "<b/>\n")
+
+    def test_plain_file(self):
+        '''Verify a plain manifest file has no hash and can be removed'''
+        path = os.path.join(self.data_dir, "default.xml")
+        open(path, "w").write(self.content)
+        self.assertEqual(store.manifest_hash(self.data_dir, "default.xml"),
+                         None)
+        store.remove_manifest(self.data_dir, "default.xml")
+        self.assertFalse(os.path.exists(path))
+        self.assertRaises(OSError, store.remove_manifest, self.data_dir,
+                          "default.xml")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -30,6 +30,9 @@ must be rebuilt for these tests to pick up any changes in the tested code.
 '''
 
 import gettext
+import os
+import random
+import shutil
 import tempfile
 import unittest
 import publish_manifest as publish_manifest
@@ -58,21 +61,6 @@ class MockDataFiles(object):
         self.criteria = None
         self.database = MockDataBase()
 
-class MockQuery(object):
-    '''Class for mock query '''
-    def __init__(self):
-        self.query = None
-
-    def __call__(self, query, commit=False):
-        self.query = query
-        return self
-
-    def waitAns(self):
-        return
-
-    def getResponse(self):
-        return
-
 class MockQueue(object):
     '''Class for mock database '''
     def __init__(self):
@@ -89,15 +77,27 @@ class MockDataBase(object):
     def getQueue(self):
         return self.queue
 
-class MockGetManifestCriteria(object):
-    '''Class for mock getCriteria '''
+class MockGetManifestTable(object):
+    '''Class for mock getManifestTable '''
     def __init__(self):
-        self.criteria = {"arch": "sparc", 
-                         "MINmem": None, "MAXmem": None, "MINipv4": None,
-                         "MAXipv4":None, "MINmac": None, "MAXmac": None}
+        self.table = [("published.xml",
+                       [{"arch": "sparc", "MINmem": None, "MAXmem": None,
+                         "MINipv4": None, "MAXipv4": None, "MINmac": "",
+                         "MAXmac": ""}])]
+
+    def __call__(self, queue, humanOutput=False, onlyUsed=True):
+        return iter(self.table)
 
-    def __call__(self, name, instance, queue, humanOutput=False, onlyUsed=True):
-        return self.criteria
+class MockBatchEntry(object):
+    '''Class for mock DataFiles of a batch entry'''
+    def __init__(self, name, criteria):
+        self.manifest_name = name
+        self.criteria = MockCriteria(criteria)
+
+class MockCriteria(dict):
+    '''Class for mock Criteria (None for criteria not given)'''
+    def __getitem__(self, key):
+        return self.get(key)
 
 class MockAIservice(object):
     '''Class for mock AIservice'''
@@ -235,22 +235,61 @@ class CriteriaToDict(unittest.TestCase):
         self.assertEquals(len(cri_dict), 0)
         self.assertTrue(isinstance(cri_dict, dict))
 
-class FindCollidingManifests(unittest.TestCase):
-    '''Tests for find_colliding_manifests'''
+class ReadBatch(unittest.TestCase):
+    '''Tests for read_batch'''
 
     def setUp(self):
-        '''unit test set up
+        '''unit test set up'''
+        self.batch_dir = tempfile.mkdtemp()
+        for name in ["a.xml", "a.criteria.xml", "b.xml", "notes.txt"]:
+            open(os.path.join(self.batch_dir, name), "w").close()
 
-        '''
-        self.aidb_DBrequest = AIdb.DBrequest
+    def tearDown(self):
+        '''unit test tear down'''
+        shutil.rmtree(self.batch_dir)
+
+    def test_directory(self):
+        '''Ensure manifests are paired with their criteria files'''
+        batch = publish_manifest.read_batch(self.batch_dir)
+        self.assertEquals(batch,
+            [(os.path.join(self.batch_dir, "a.xml"),
+              os.path.join(self.batch_dir, "a.criteria.xml")),
+             (os.path.join(self.batch_dir, "b.xml"), None)])
+
+    def test_list_file(self):
+        '''Ensure a list file is read relative to its directory'''
+        list_file = os.path.join(self.batch_dir, "batch.lst")
+        batch = open(list_file, "w")
+        batch.write("# comment\n\nb.xml\na.xml a.criteria.xml\n")
+        batch.close()
+        self.assertEquals(publish_manifest.read_batch(list_file),
+            [(os.path.join(self.batch_dir, "b.xml"), None),
+             (os.path.join(self.batch_dir, "a.xml"),
+              os.path.join(self.batch_dir, "a.criteria.xml"))])
+
+    def test_missing_file(self):
+        '''Ensure a list file naming a missing manifest is caught'''
+        list_file = os.path.join(self.batch_dir, "batch.lst")
+        batch = open(list_file, "w")
+        batch.write("c.xml\n")
+        batch.close()
+        self.assertRaises(ValueError, publish_manifest.read_batch, list_file)
+
+    def test_empty(self):
+        '''Ensure an empty batch is caught'''
+        empty_dir = os.path.join(self.batch_dir, "empty")
+        os.mkdir(empty_dir)
+        self.assertRaises(ValueError, publish_manifest.read_batch, empty_dir)
+
+class CheckBatchCollisions(unittest.TestCase):
+    '''Tests for check_batch_collisions'''
+
+    def setUp(self):
+        '''unit test set up'''
         self.aidb_getCriteria = AIdb.getCriteria
-        self.aidb_getManifestCriteria = AIdb.getManifestCriteria
-        self.mockquery = MockQuery()
-        self.mockgetCriteria = MockGetCriteria()
-        self.mockgetManifestCriteria = MockGetManifestCriteria()
-        AIdb.DBrequest = self.mockquery
-        AIdb.getCriteria = self.mockgetCriteria
-        AIdb.getManifestCriteria = self.mockgetManifestCriteria
+        self.aidb_getManifestTable = AIdb.getManifestTable
+        AIdb.getCriteria = MockGetCriteria()
+        AIdb.getManifestTable = MockGetManifestTable()
         self.files = MockDataFiles()
 
     def tearDown(self):
@@ -258,19 +297,147 @@ class FindCollidingManifests(unittest.TestCase):
         Functions originally saved in setUp are restored to their
         original values.
         '''
-        AIdb.DBrequest = self.aidb_DBrequest
         AIdb.getCriteria = self.aidb_getCriteria
-        AIdb.getManifestCriteria = self.aidb_getManifestCriteria
+        AIdb.getManifestTable = self.aidb_getManifestTable
+
+    def check(self, entries):
+        '''Check entries against the published manifests as publish_batch
+        does'''
+        queue = self.files.database.getQueue()
+        index = publish_manifest.CollisionIndex.from_table(
+            list(AIdb.getCriteria(queue, onlyUsed=False, strip=False)),
+            AIdb.getManifestTable(queue, humanOutput=True, onlyUsed=False))
+        return publish_manifest.check_batch_collisions(entries, index)
+
+    def test_no_collisions(self):
+        '''Ensure divergent manifests are accepted'''
+        entries = [MockBatchEntry("a.xml", {"arch": "i86pc",
+                                            "mem": ["1024", "2048"]}),
+                   MockBatchEntry("b.xml", {"arch": "i86pc",
+                                            "mem": ["4096", "unbounded"]})]
+        man_insts = self.check(entries)
+        self.assertEquals(sorted(man_insts.values()),
+                          [("a.xml", 0), ("b.xml", 0)])
+
+    def test_database_collision(self):
+        '''Ensure a manifest with published criteria is caught'''
+        entries = [MockBatchEntry("a.xml", {"arch": "sparc"})]
+        self.assertRaises(SystemExit, self.check, entries)
+
+    def test_batch_collision(self):
+        '''Ensure overlapping ranges within the batch are caught'''
+        entries = [MockBatchEntry("a.xml", {"mem": ["1024", "4096"]}),
+                   MockBatchEntry("b.xml", {"mem": ["2048", "unbounded"]})]
+        self.assertRaises(SystemExit, self.check, entries)
+
+    def test_invalid_range(self):
+        '''Ensure a reversed range is caught'''
+        entries = [MockBatchEntry("a.xml", {"mem": ["4096", "1024"]})]
+        self.assertRaises(SystemExit, self.check, entries)
+
+class ManifestValues(unittest.TestCase):
+    '''Tests for manifest_values'''
 
+    def setUp(self):
+        '''unit test set up'''
+        self.aidb_getCriteria = AIdb.getCriteria
+        AIdb.getCriteria = MockGetCriteria()
 
-    def test_find_colliding_with_append(self):
-        '''Ensure collsions found with append'''
-        criteria={'arch': 'sparc', 'mem': None, 'ipv4': None, 'mac': None}
-        collisions = {(u'nosuchmanifest.xml', 0): 'MINipv4,MAXipv4,'}
-        self.assertRaises(SystemExit,
-                          publish_manifest.find_colliding_manifests,
-                          criteria, self.files.database, collisions,
-                          append_manifest="appendmanifest")
+    def tearDown(self):
+        '''unit test tear down
+        Functions originally saved in setUp are restored to their
+        original values.
+        '''
+        AIdb.getCriteria = self.aidb_getCriteria
+
+    def test_special_characters(self):
+        '''Ensure names and values are stored as given'''
+        files = MockBatchEntry("a,b(1).xml", {"arch": "SUNW,x;y",
+                                              "mem": ["1024", "unbounded"]})
+        files.database = MockDataBase()
+        self.assertEquals(publish_manifest.manifest_values(files, 2),
+                          ["a,b(1).xml", 2, "1024", None, None, None, None,
+                           None, "sunw,x;y"])
+
+class IntervalIndex(unittest.TestCase):
+    '''Tests for IntervalIndex'''
+
+    def test_overlapping(self):
+        '''Ensure the overlapping intervals are found'''
+        rand = random.Random(2010)
+        for size in [0, 1, 2, 7, 64, 100]:
+            intervals = list()
+            for item in range(size):
+                low = rand.randint(0, 1000)
+                intervals.append((low, low + rand.randint(0, 100), item))
+            index = publish_manifest.IntervalIndex(intervals)
+            for i in range(50):
+                low = rand.randint(0, 1100)
+                high = low + rand.randint(0, 50)
+                expect = [item for (ilow, ihigh, item) in intervals
+                          if ilow <= high and ihigh >= low]
+                self.assertEquals(sorted(index.overlapping(low, high)),
+                                  expect)
+
+class CollisionIndex(unittest.TestCase):
+    '''Tests for CollisionIndex'''
+
+    def setUp(self):
+        '''unit test set up'''
+        self.aidb_getCriteria = AIdb.getCriteria
+        self.aidb_getManifestTable = AIdb.getManifestTable
+        AIdb.getCriteria = MockGetCriteria()
+        AIdb.getManifestTable = MockGetManifestTable()
+        AIdb.getManifestTable.table.append(
+            ("ranged.xml",
+             [{"arch": None, "MINmem": 1024, "MAXmem": 2048,
+               "MINipv4": None, "MAXipv4": None, "MINmac": "000000000010",
+               "MAXmac": ""}]))
+        self.files = MockDataFiles()
+
+    def tearDown(self):
+        '''unit test tear down
+        Functions originally saved in setUp are restored to their
+        original values.
+        '''
+        AIdb.getCriteria = self.aidb_getCriteria
+        AIdb.getManifestTable = self.aidb_getManifestTable
+
+    def test_find_colliding_criteria(self):
+        '''Ensure colliding criteria are reported per manifest'''
+        index = publish_manifest.CollisionIndex(self.files.database)
+        criteria = MockCriteria({"arch": "sparc",
+                                 "mem": ["2048", "unbounded"]})
+        self.assertEquals(index.find_colliding_criteria(criteria),
+                          {("published.xml", 0): "arch,",
+                           ("ranged.xml", 0): "MINmem,MAXmem,"})
+
+    def test_range_collision(self):
+        '''Ensure an overlapping, different range is caught'''
+        index = publish_manifest.CollisionIndex(self.files.database)
+        criteria = MockCriteria({"mem": ["2048", "unbounded"],
+                                 "mac": ["000000000010", "unbounded"]})
+        self.assertRaises(SystemExit, index.check_manifest, criteria)
+
+    def test_divergent(self):
+        '''Ensure a manifest differing from its collisions is accepted'''
+        index = publish_manifest.CollisionIndex(self.files.database)
+        criteria = MockCriteria({"arch": "sparc", "mem": ["4096", "8192"]})
+        index.check_manifest(criteria)
+
+    def test_excluded(self):
+        '''Ensure excluded manifests are not collided with'''
+        index = publish_manifest.CollisionIndex(self.files.database,
+            exclude_manifests=["published.xml"])
+        index.check_manifest(MockCriteria({"arch": "sparc"}))
+
+    def test_append(self):
+        '''Ensure appended criteria are checked with the published ones'''
+        index = publish_manifest.CollisionIndex(self.files.database,
+            exclude_manifests=["ranged.xml"])
+        criteria = MockCriteria({"arch": "sparc"})
+        self.assertRaises(SystemExit, index.check_manifest, criteria)
+        index.check_manifest(criteria, append_manifest="ranged.xml")
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+# Copyright (c) 2010, Oracle and/or its affiliates. All rights reserved.
+#
+
+'''
+To run these tests, see the instructions in usr/src/tools/tests/README.
+Remember that since the proto area is used for the PYTHONPATH, the gate
+must be rebuilt for these tests to pick up any changes in the tested code.
+
+'''
+
+import gettext
+import unittest
+import osol_install.auto_install.server_stats as server_stats
+
+
+gettext.install("ai-test")
+
+class StatsGroup(unittest.TestCase):
+    '''Tests for server statistics'''
+
+    def setUp(self):
+        '''unit test set up'''
+        self.group = server_stats.StatsGroup("test_", counters=("hits",),
+                                             histograms=(("depth",
+                                                          (1, 4)),))
+
+    def test_counters(self):
+        '''Verify counters add up'''
+        self.group.count(hits=2)
+        self.group.count(hits=3)
+        self.assertEqual(self.group.stats()[0], ("test_hits", 5))
+
+    def test_histogram(self):
+        '''Verify histogram buckets are cumulative'''
+        for value in (0, 1, 2, 4, 9):
+            self.group.observe(depth=value)
+        self.assertEqual(self.group.stats()[1],
+                         ("test_depth", {"buckets": [(1, 2), (4, 4),
+                                                     ("+Inf", 5)],
+                                         "sum": 16, "count": 5}))
+
+    def test_format_text(self):
+        '''Verify the text listing of counters and histograms'''
+        self.group.count(hits=1)
+        self.group.observe(depth=3)
+        self.assertEqual(server_stats.formatText(self.group.stats()),
+                         'test_hits 1\n'
+                         'test_depth_bucket{le="1"} 0\n'
+                         'test_depth_bucket{le="4"} 1\n'
+                         'test_depth_bucket{le="+Inf"} 1\n'
+                         'test_depth_sum 3\n'
+                         'test_depth_count 1\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -58,9 +58,11 @@ class MockQuery(object):
     '''Class for mock query '''
     def __init__(self):
         self.query = None
+        self.params = None
 
-    def __call__(self, query, commit=False):
+    def __call__(self, query, commit=False, params=None):
         self.query = query
+        self.params = params
         return self
 
     def waitAns(self):
@@ -139,10 +141,22 @@ class SetCriteria(unittest.TestCase):
         criteria.setdefault("ipv4")
         criteria.setdefault("mac")
         set_criteria.set_criteria(criteria, "myxml", self.files.database)
-        expect_query = "UPDATE manifests SET arch='i86pc',MINmem=NULL," + \
-                       "MAXmem='4096',MINipv4=NULL,MAXipv4=NULL,MINmac=NULL," +\
-                       "MAXmac=NULL WHERE name='myxml'"
+        expect_query = "UPDATE manifests SET arch=?,MINmem=?," + \
+                       "MAXmem=?,MINipv4=NULL,MAXipv4=NULL,MINmac=NULL," +\
+                       "MAXmac=NULL WHERE name=?"
         self.assertEquals(expect_query, self.mockquery.query)
+        self.assertEquals(("i86pc", None, "4096", "myxml"),
+                          self.mockquery.params)
+
+    def test_special_characters(self):
+        '''Ensure values and names are bound as given'''
+        criteria = {"arch": "SUNW,x(1);%"}
+        criteria.setdefault("mem")
+        criteria.setdefault("ipv4")
+        criteria.setdefault("mac")
+        set_criteria.set_criteria(criteria, "a,b.xml", self.files.database)
+        self.assertEquals(("sunw,x(1);%", "a,b.xml"),
+                          self.mockquery.params)
 
     def test_unbounded_max(self):
         '''Ensure set_criteria max query constructed properly '''
@@ -150,22 +164,25 @@ class SetCriteria(unittest.TestCase):
         criteria.setdefault("ipv4")
         criteria.setdefault("mac")
         set_criteria.set_criteria(criteria, "myxml", self.files.database)
-        expect_query = "UPDATE manifests SET arch='i86pc',MINmem='1024'," + \
-                       "MAXmem=NULL,MINipv4=NULL,MAXipv4=NULL,MINmac=NULL," + \
-                       "MAXmac=NULL WHERE name='myxml'"
+        expect_query = "UPDATE manifests SET arch=?,MINmem=?," + \
+                       "MAXmem=?,MINipv4=NULL,MAXipv4=NULL,MINmac=NULL," + \
+                       "MAXmac=NULL WHERE name=?"
         self.assertEquals(expect_query, self.mockquery.query)
+        self.assertEquals(("i86pc", "1024", None, "myxml"),
+                          self.mockquery.params)
 
     def test_range(self):
         '''Ensure set_criteria max query constructed properly '''
-        criteria = {"arch": "i86pc", "ipv4": ["10.0.30.100", "10.0.50.400"]}
-        criteria.setdefault("mac")
+        criteria = {"arch": "i86pc", "ipv4": ["010000030100", "10.0.50.200"],
+                    "mac": ["080027510CC7", "unbounded"]}
         criteria.setdefault("mem")
         set_criteria.set_criteria(criteria, "myxml", self.files.database)
-        expect_query = "UPDATE manifests SET arch='i86pc',MINmem=NULL," + \
-                       "MAXmem=NULL,MINipv4='10.0.30.100'," + \
-                       "MAXipv4='10.0.50.400',MINmac=NULL,MAXmac=NULL " + \
-                       "WHERE name='myxml'"
+        expect_query = "UPDATE manifests SET arch=?,MINmem=NULL," + \
+                       "MAXmem=NULL,MINipv4=?,MAXipv4=?,MINmac=?," + \
+                       "MAXmac=? WHERE name=?"
         self.assertEquals(expect_query, self.mockquery.query)
+        self.assertEquals(("i86pc", 167779940, 167785160, 8796752645319,
+                           None, "myxml"), self.mockquery.params)
 
     def test_append_unbounded_min(self):
         '''Ensure set_criteria append min query constructed properly '''
@@ -174,9 +191,11 @@ class SetCriteria(unittest.TestCase):
         criteria.setdefault("mac")
         set_criteria.set_criteria(criteria, "myxml", self.files.database,
                                   append=True)
-        expect_query = "UPDATE manifests SET arch='i86pc',MINmem=NULL," \
-                       "MAXmem='4096' WHERE name='myxml'"
+        expect_query = "UPDATE manifests SET arch=?,MINmem=?," \
+                       "MAXmem=? WHERE name=?"
         self.assertEquals(expect_query, self.mockquery.query)
+        self.assertEquals(("i86pc", None, "4096", "myxml"),
+                          self.mockquery.params)
 
     def test_append_unbounded_max(self):
         '''Ensure set_criteria append max query constructed properly '''
@@ -185,20 +204,24 @@ class SetCriteria(unittest.TestCase):
         criteria.setdefault("mac")
         set_criteria.set_criteria(criteria, "myxml", self.files.database,
                                   append=True)
-        expect_query = "UPDATE manifests SET arch='i86pc',MINmem='2048'," \
-                       "MAXmem=NULL WHERE name='myxml'"
+        expect_query = "UPDATE manifests SET arch=?,MINmem=?," \
+                       "MAXmem=? WHERE name=?"
         self.assertEquals(expect_query, self.mockquery.query)
+        self.assertEquals(("i86pc", "2048", None, "myxml"),
+                          self.mockquery.params)
 
     def test_append_range(self):
         '''Ensure set_criteria append range query constructed properly '''
-        criteria = {"arch": "i86pc", "ipv4": ["10.0.10.10", "10.0.10.300"]}
+        criteria = {"arch": "i86pc", "ipv4": ["10.0.10.10", "10.0.10.30"]}
         criteria.setdefault("mem")
         criteria.setdefault("mac")
         set_criteria.set_criteria(criteria, "myxml", self.files.database,
                                   append=True)
-        expect_query = "UPDATE manifests SET arch='i86pc',MINipv4=" + \
-                       "'10.0.10.10',MAXipv4='10.0.10.300' WHERE name='myxml'"
+        expect_query = "UPDATE manifests SET arch=?,MINipv4=?," + \
+                       "MAXipv4=? WHERE name=?"
         self.assertEquals(expect_query, self.mockquery.query)
+        self.assertEquals(("i86pc", 167774730, 167774750, "myxml"),
+                          self.mockquery.params)
 
 class CheckPublishedManifest(unittest.TestCase):
     '''Tests for check_published_manifest'''
@@ -0,0 +1,113 @@
+#!/usr/bin/python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+# Copyright (c) 2010, Oracle and/or its affiliates. All rights reserved.
+
+"""
+AI upgrade-db
+"""
+
+import gettext
+import os.path
+from optparse import OptionParser
+
+import osol_install.auto_install.AI_database as AIdb
+import osol_install.libaiscf as smf
+
+def parse_options(cmd_options=None):
+    """
+    Parse and validate options
+    Args: Optional cmd_options, used for unit testing. Otherwise, cmd line
+          options handled by OptionParser
+    Returns: the options object
+    """
+
+    usage = _("usage: %prog -n service_name")
+
+    parser = OptionParser(usage=usage, prog="upgrade-db")
+    parser.add_option("-n",  dest="service_name",
+                      default=None, help=_("Specify name of install "
+                      "service."))
+
+    # Get the parsed options using parse_args().  We know we don't have
+    # args, so check to make sure there are none.
+    options, args = parser.parse_args(cmd_options)
+    if len(args):
+        parser.error(_("Unexpected arguments: %s" % args))
+
+    # Check that we have the install service's name
+    if options.service_name is None:
+        parser.error(_("Missing one or more required options."))
+
+    return options
+
+def upgrade_db(db):
+    """
+    Verifies the install service's database and upgrades it to the current
+    schema version, adding the criteria indexes it lacks and
+    converting its mac and IPv4 criteria to integers.
+    Args: db - db object of install service to upgrade.
+    Returns: tuple of the schema version before and after the upgrade
+    Raises: SystemExit if the database is malformed or can not be upgraded
+    """
+    version = AIdb.getSchemaVersion(db.getQueue())
+    # verifyDBStructure() upgrades an older database in place
+    db.verifyDBStructure()
+    return (version, AIdb.getSchemaVersion(db.getQueue()))
+
+
+if __name__ == '__main__':
+    gettext.install("ai", "/usr/lib/locale")
+
+    options = parse_options()
+
+    # Get the SMF service object for the install service specified.
+    try:
+        svc = smf.AIservice(smf.AISCF(FMRI="system/install/server"),
+                            options.service_name)
+    except KeyError:
+        raise SystemExit(_("Error: Failed to find service %s") %
+                         options.service_name)
+
+    # Get the install service's data directory and database path
+    try:
+        port = svc['txt_record'].rsplit(':')[-1]
+    except KeyError:
+        raise SystemExit(_("SMF data for service %s is corrupt.\n") %
+                         options.service_name)
+    service_dir = os.path.abspath("/var/ai/" + port)
+    database = os.path.join(service_dir, "AI.db")
+
+    # Check that the service directory and database exist
+    if not (os.path.isdir(service_dir) and os.path.exists(database)):
+        raise SystemExit("Error: Invalid AI service directory: %s" %
+                         service_dir)
+
+    db = AIdb.DB(database, commit=True)
+    (old_version, new_version) = upgrade_db(db)
+    # (re)compile the criteria index the webserver matches clients against
+    AIdb.writeCriteriaIndex(db.getQueue(), database)
+    if old_version == new_version:
+        print(_("Database for service %s is at schema version %d") %
+              (options.service_name, new_version))
+    else:
+        print(_("Upgraded database for service %s from schema version %d "
+                "to %d") % (options.service_name, old_version, new_version))
@@ -32,34 +32,55 @@ import os
 import sys
 import re
 import gettext
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate
 from optparse import OptionParser
 
 import cherrypy
+from cherrypy.lib import cptools
 from cherrypy.lib.static import serve_file
+from cherrypy.process import plugins
 import lxml.etree
 from lxml.html import builder as E
 
 import osol_install.auto_install.AI_database as AIdb
+import osol_install.auto_install.manifest_store as store
+import osol_install.auto_install.server_stats as server_stats
+import osol_install.libaiscf as smf
 
 def parse_options():
     """
     Parse and validate options
     """
 
-    usage = _("usage: %prog [options] A/I_data_directory")
+    usage = _("usage: %prog [options] A/I_data_directory\n"
+              "       %prog [options] -a")
     parser = OptionParser(usage=usage)
+    parser.add_option("-a", "--all-services", dest="all_services",
+                      default=False, action="store_true",
+                      help=_("serve every enabled install service, each on "
+                             "its own port as well as by name on the "
+                             "server's port"))
     parser.add_option("-p", "--port", dest="port", default=8080,
                       metavar="port", type="int", nargs=1,
                       help=_("provide port to start server on"))
     parser.add_option("-t", "--threads", dest="thread", default=10,
                       metavar="thread count", type="int", nargs=1,
-                      help=_("provide the number of threads to run"))
+                      help=_("provide the number of threads to run (shared "
+                             "by all install services)"))
     parser.add_option("-l", "--listen", dest="listen", default="0.0.0.0",
                       metavar="ipaddress", type="string", nargs=1,
                       help=_("provide the interface to listen on"))
     parser.add_option("-d", "--debug", dest="debug", default=False,
                       action="store_true",
                       help=_("provide server tracebacks"))
+    parser.add_option("--no-stats", dest="stats", default=True,
+                      action="store_false",
+                      help=_("do not time requests for /stats"))
 
     (options, args) = parser.parse_args()
     # check to see the listen directive is a valid IPv4 or IPv6 address
@@ -69,42 +90,320 @@ def parse_options():
                   options.listen)):
         parser.print_help()
         sys.exit(1)
-    elif len(args) != 1:
+    elif options.all_services and len(args) == 0:
+        return (options, None)
+    elif len(args) != 1 or options.all_services:
         parser.print_help()
         sys.exit(1)
 
     return (options, args[0])
 
+def acceptsGzip():
+    """
+    Returns True if the client accepts gzip content-coding in its response
+    """
+    for encoding in cherrypy.request.headers.elements('Accept-Encoding'):
+        if encoding.value in ("gzip", "x-gzip", "*") and encoding.qvalue > 0:
+            return True
+    return False
+
+def serveManifest(data_dir, name):
+    """
+    Serves the manifest published under name in the AI_data directory given.
+    A manifest in the manifest store is served with a strong ETag of its
+    hash (so clients holding the current manifest get a 304 (Not Modified)
+    response instead) and gzip compressed to clients accepting that.
+    """
+    path = os.path.abspath(os.path.join(data_dir, name))
+    digest = store.manifest_hash(data_dir, name)
+    if digest is not None:
+        headers = cherrypy.response.headers
+        headers['Vary'] = "Accept-Encoding"
+        gzip_path = store.gzip_path(data_dir, digest)
+        if gzip_path is not None and acceptsGzip():
+            # the compressed copy is a different entity so needs its own tag
+            path = gzip_path
+            digest += store.GZIP_SUFFIX
+            headers['Content-Encoding'] = "gzip"
+        headers['ETag'] = '"%s"' % digest
+        if cherrypy.request.method in ("GET", "HEAD"):
+            cptools.validate_etags()
+    return serve_file(path, "application/x-download", "attachment",
+                      name=os.path.basename(name))
+
+# version of the criteria negotiation advertised in the CriteriaList;
+# from 1.0 a client may POST every criteria it knows (passing its version)
+# without first asking for the list, criteria the service does not use
+# being ignored
+CRITERIA_LIST_VERSION = "1.0"
+
+# bytes read from a file under /ai-files at a time
+FILE_CHUNK_SIZE = 256 * 1024
+
+# directory holding the data directory (named by port) of each install
+# service, and the seconds between checks for install services enabled or
+# disabled when serving all of them (-a)
+SERVICES_DIR = "/var/ai"
+SERVICE_POLL_INTERVAL = 10
+
+def requestedRange(size, etag, last_modified):
+    """
+    Returns the (start, stop) byte range of a file of size bytes the
+    request asks for, None for the whole file or an empty tuple if the
+    range can not be satisfied.  Only single byte ranges are served; a
+    request for several ranges, or whose If-Range does not match the file's
+    ETag or Last-Modified, gets the whole file, as does a request whose
+    range is invalid.
+    """
+    headers = cherrypy.request.headers
+    ranges = headers.get('Range')
+    if not ranges or headers.get('If-Range', etag) not in (etag,
+                                                          last_modified):
+        return None
+    (unit, sep, spec) = ranges.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    (start, sep, stop) = spec.strip().partition("-")
+    try:
+        if not start:
+            # a suffix range: the last stop bytes
+            start = max(size - int(stop), 0)
+            stop = size
+        else:
+            start = int(start)
+            if stop:
+                stop = int(stop) + 1
+                # a range ending before it starts is invalid (and so is
+                # ignored) rather than unsatisfiable
+                if stop <= start:
+                    return None
+                stop = min(stop, size)
+            else:
+                stop = size
+    except ValueError:
+        return None
+    if start >= stop:
+        return ()
+    return (start, stop)
+
+def fileGenerator(stats, fileobj, start, stop, started):
+    """
+    Yields the bytes from start to stop of the file object fileobj (opened
+    for this request alone, and closed once done) in chunks, counting the
+    bytes and time taken to serve them with the StatsGroup stats (if any)
+    """
+    offset = start
+    try:
+        fileobj.seek(start)
+        while offset < stop:
+            data = fileobj.read(min(FILE_CHUNK_SIZE, stop - offset))
+            if not data:
+                # the file was truncated under us
+                break
+            offset += len(data)
+            yield data
+    finally:
+        fileobj.close()
+        if stats is not None:
+            stats.count(bytes=offset - start,
+                        seconds=time.time() - started)
+
+def fileStamp(path):
+    """
+    Returns a value which changes whenever the file path is modified, or
+    None if there is no such file
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
 class staticPages:
     """
     Class containing the HTML for the static pages
     """
 
-    def __init__(self, data_loc):
+    def __init__(self, data_loc, readers=1, stats=True):
         self.base_dir = data_loc
-        if os.path.exists(os.path.join(self.base_dir, 'AI.db')):
-            self.AISQL = AIdb.DB(os.path.join(self.base_dir, 'AI.db'))
-        else:
+        if not os.path.exists(os.path.join(self.base_dir, 'AI.db')):
             raise SystemExit(_("Error:\tNo AI.db database"))
-        self.AISQL.verifyDBStructure()
+        # AI.db is only opened once needed (see getDB()); clients are
+        # matched against the criteria index compiled next to it when there
+        # is one
+        self._readers = readers
+        self._db_lock = threading.Lock()
+        self.AISQL = None
+        # where requests spend their time, for /stats (None if disabled)
+        self.dbStats = None
+        self.stats = None
+        if stats:
+            self.dbStats = AIdb.DBstats()
+            self.stats = server_stats.StatsGroup("ai_pages_",
+                counters=("manifest_requests", "default_manifests",
+                          "indeterminate_manifests", "page_requests",
+                          "page_renders"),
+                histograms=(("manifest_seconds",
+                             server_stats.SECONDS_BUCKETS),
+                            ("match_seconds", server_stats.SECONDS_BUCKETS),
+                            ("serve_seconds", server_stats.SECONDS_BUCKETS),
+                            ("render_seconds", server_stats.SECONDS_BUCKETS)))
+        # in-memory index of the manifests table used to answer clients,
+        # reloaded whenever the compiled index or AI.db changes (and rebuilt
+        # from AI.db if there is no compiled index of its current contents)
+        self._index = None
+        self._index_stamp = None
+        self._bad_index_stamp = None
+        self._index_lock = threading.Lock()
+        # rendered pages, keyed by page name holding tuples of (stamp of
+        # what they depend on, ETag, Last-Modified, page)
+        self._pages = dict()
+        # load (or build) the index now so a broken service fails to start
+        self.getIndex()
+
+    def getDB(self):
+        """
+        Returns the DB object for AI.db, opening and verifying it first if
+        this is the first use of the database
+        """
+        if self.AISQL is None:
+            self._db_lock.acquire()
+            try:
+                if self.AISQL is None:
+                    # use a DB connection per server thread so that client
+                    # requests do not wait behind one another for the
+                    # database
+                    db = AIdb.DB(os.path.join(self.base_dir, 'AI.db'),
+                                 readers=self._readers, stats=self.dbStats)
+                    db.verifyDBStructure()
+                    cherrypy.log(_("Serving AI.db schema version %d") %
+                                 AIdb.getSchemaVersion(db.getQueue()))
+                    self.AISQL = db
+            finally:
+                self._db_lock.release()
+        return self.AISQL
+
+    def close(self):
+        """
+        Stops the DB threads of AI.db, if it has been opened, once the
+        requests already queued have run
+        """
+        self._db_lock.acquire()
+        try:
+            if self.AISQL is not None:
+                self.AISQL.close()
+                self.AISQL = None
+        finally:
+            self._db_lock.release()
+
+    def getIndexStamp(self):
+        """
+        Returns a value which changes whenever the index getIndex() returns
+        needs reloading: the compiled index file's stamp followed by AI.db's
+        stamp
+        """
+        return (fileStamp(os.path.join(self.base_dir, AIdb.INDEX_FILE)),) + \
+            AIdb.getDBStamp(os.path.join(self.base_dir, 'AI.db'))
+
+    def getIndex(self):
+        """
+        Returns the criteria index of AI.db, reloading the compiled index
+        (see AIdb.writeCriteriaIndex()) first if it or the database has
+        changed since it was loaded.  Unless the compiled index is usable
+        and was compiled from the database as it is now, one is built from
+        the database instead.
+        """
+        stamp = self.getIndexStamp()
+        if stamp != self._index_stamp:
+            self._index_lock.acquire()
+            try:
+                # another thread may have reloaded the index while we waited
+                if stamp != self._index_stamp:
+                    # take the stamp before reading the index so a change
+                    # made while loading causes another reload; publish
+                    # the new index in one assignment so requests in flight
+                    # keep a consistent view
+                    stamp = self.getIndexStamp()
+                    index = None
+                    if stamp[0] is not None and \
+                        stamp[0] != self._bad_index_stamp:
+                        index_file = os.path.join(self.base_dir,
+                                                  AIdb.INDEX_FILE)
+                        try:
+                            index = AIdb.CriteriaIndex.load(index_file)
+                        except (IOError, ValueError), err:
+                            cherrypy.log(_("Ignoring criteria index: %s") %
+                                         err)
+                        else:
+                            if index.getGeneration() != stamp[1:]:
+                                cherrypy.log(_("Ignoring criteria index %s "
+                                               "compiled from an earlier "
+                                               "AI.db") % index_file)
+                                index = None
+                        if index is None:
+                            self._bad_index_stamp = stamp[0]
+                    if index is None:
+                        index = AIdb.getCriteriaIndex(self.getDB().\
+                            getQueue(), stamp[1:])
+                    (self._index, self._index_stamp) = (index, stamp)
+            finally:
+                self._index_lock.release()
+        return self._index
+
+    def cachedPage(self, name, render, stamp=None):
+        """
+        Returns the page name as rendered by render(), rendering it only if
+        stamp (by default AI.db's stamp) has changed since it was last
+        rendered.  The page is served with an ETag and a Last-Modified
+        header, so clients holding the current page get a 304 (Not Modified)
+        response instead.
+        """
+        if stamp is None:
+            stamp = AIdb.getDBStamp(os.path.join(self.base_dir, 'AI.db'))
+        page = self._pages.get(name)
+        if self.stats is not None:
+            self.stats.count(page_requests=1)
+        if page is None or page[0] != stamp:
+            if self.stats is not None:
+                started = time.time()
+                body = render()
+                self.stats.count(page_renders=1)
+                self.stats.observe(render_seconds=time.time() - started)
+            else:
+                body = render()
+            last_modified = max([mtime for (mtime, size, inode) in
+                                 filter(None, stamp)] or [None])
+            page = (stamp, '"%s"' % hashlib.md5(body).hexdigest(),
+                    formatdate(last_modified, usegmt=True), body)
+            self._pages[name] = page
+        cherrypy.response.headers['ETag'] = page[1]
+        cherrypy.response.headers['Last-Modified'] = page[2]
+        # raise a 304 if the client's copy is current
+        cptools.validate_since()
+        cptools.validate_etags()
+        return page[3]
 
     @cherrypy.expose
     def index(self):
         """ The server's main page """
+        return self.cachedPage("index", self.renderIndex)
+
+    def renderIndex(self):
+        """ Render the server's main page """
 
         # generate the list of criteria for the criteria table header
         criteriaHeader = E.TR()
-        for crit in AIdb.getCriteria(self.AISQL.getQueue(), strip=False):
+        for crit in AIdb.getCriteria(self.getDB().getQueue(), strip=False):
             criteriaHeader.append(E.TH(crit))
 
         # generate the manifest rows for the criteria table body
-        names = AIdb.getManNames(self.AISQL.getQueue())
+        manifests = AIdb.getManifestTable(self.getDB().getQueue(),
+                                          onlyUsed=True, humanOutput=True)
         tableBody = E.TR()
-        for manifest in names:
+        for manifest, instances in manifests:
 
             # iterate through each manifest (and instance)
-            for instance in range(0,
-                    AIdb.numInstances(manifest, self.AISQL.getQueue())):
+            for instance, critPairs in enumerate(instances):
 
                 tableBody.append(E.TR())
                 # print the manifest name only once (key off instance 0)
@@ -112,18 +411,11 @@ class staticPages:
                     tableBody.append(
                         E.TD(E.A(manifest,
                                  href="/manifests/" + manifest,
-                                 rowspan=str(AIdb.numInstances(manifest,
-                                    self.AISQL.getQueue())))
+                                 rowspan=str(len(instances)))
                             )
                     )
                 else:
                     tableBody.append(E.TD())
-                critPairs = AIdb.getManifestCriteria(manifest, instance,
-                                                     self.AISQL.getQueue(),
-                                                     onlyUsed=True,
-                                                     humanOutput=True)
-                # critPairs is an SQLite3 row object which doesn't support
-                # iteritems(), etc.
                 for crit in critPairs.keys():
                     formatted_val = AIdb.formatValue(crit, critPairs[crit])
                     # if we do not get back a valid value ensure a hyphen is
@@ -143,7 +435,7 @@ class staticPages:
                                            href="/manifests/default.xml")),
                                   E.TD(lxml.etree.Entity("nbsp"),
                                        colspan=str(max(len(list(
-                                       AIdb.getCriteria(self.AISQL.getQueue(),
+                                       AIdb.getCriteria(self.getDB().getQueue(),
                                        strip=False))), 1)),
                                        align="center")
                              )
@@ -164,7 +456,7 @@ class staticPages:
                                            E.TH(_("Manifest"), rowspan="2"),
                                            E.TH(_("Criteria List"),
                                                 colspan=str(max(len(list(
-                                                AIdb.getCriteria(self.AISQL.\
+                                                AIdb.getCriteria(self.getDB().\
                                                 getQueue(),
                                                 strip=False))), 1)))
                                       ),
@@ -172,6 +464,9 @@ class staticPages:
                                       tableBody,
                                       border="1", align="center"
                               ),
+                              E.P(_("Database schema version: %d") %
+                                  AIdb.getSchemaVersion(self.getDB().\
+                                  getQueue()))
                        )
                 )
         return lxml.etree.tostring(web_page, pretty_print=True)
@@ -206,8 +501,7 @@ class staticPages:
                                        "manufacturer=sun microsystems")
                               ),
                               E.H1(_("Criteria:")),
-                              E.P(str(list(AIdb.getCriteria(
-                                  self.AISQL.getQueue(), strip=True)))),
+                              E.P(str(self.getIndex().getCriteria())),
                               E.FORM(E.INPUT(type="text", name="postData"),
                                      E.INPUT(type="submit"),
                                      action="manifest.xml",
@@ -218,12 +512,17 @@ class staticPages:
         return lxml.etree.tostring(web_page, pretty_print=True)
 
     @cherrypy.expose
-    def manifest_xml(self, postData=None):
+    def manifest_xml(self, postData=None, version=None):
         """
         This is manifest.xml the special object to list needed criteria
-        or return a manifest given a set of criteria
+        or return a manifest given a set of criteria.  Clients which pass
+        a version (see CRITERIA_LIST_VERSION) post every criteria they know
+        in one request; servers predating it refuse the unexpected
+        parameter, so such clients fall back to asking for the list first.
         """
         if postData is not None:
+            if self.stats is not None:
+                started = time.time()
             criteria = {}
 
             # process each key/value pair of the POST data
@@ -238,7 +537,12 @@ class staticPages:
                     criteria[key] = value
                 except (ValueError, NameError, TypeError, KeyError):
                     criteria = {}
-            manifest = AIdb.findManifest(criteria, self.AISQL)
+            if self.stats is not None:
+                matching = time.time()
+                manifest = self.getIndex().findManifest(criteria)
+                self.stats.observe(match_seconds=time.time() - matching)
+            else:
+                manifest = self.getIndex().findManifest(criteria)
             # check if findManifest() returned a number and one larger than 0
             # (means we got multiple manifests back -- an error)
             if str(manifest).isdigit() and manifest > 0:
@@ -253,42 +557,90 @@ class staticPages:
                                       str(manifest))
                            )
                     )
+                if self.stats is not None:
+                    self.stats.count(indeterminate_manifests=1)
                 return lxml.etree.tostring(web_page, pretty_print=True)
 
             # check if findManifest() returned a number equal to 0
             # (means we got no manifests back -- thus we serve the default)
             elif manifest == 0:
                 manifest = "default.xml"
+                if self.stats is not None:
+                    self.stats.count(default_manifests=1)
 
             # else findManifest() returned the name of the manifest to serve
             # (or it is now set to default.xml)
+            if self.stats is not None:
+                serving = time.time()
             try:
-                return serve_file(os.path.abspath(
-                        os.path.join(self.base_dir, os.path.join("AI_data",
-                        manifest))), "application/x-download", "attachment")
+                return serveManifest(os.path.join(self.base_dir, "AI_data"),
+                                     manifest)
             except OSError:
                 raise cherrypy.NotFound("/manifests/" + str(manifest))
+            finally:
+                # serving times the setting up of the manifest's response;
+                # its body is sent once the handler returns
+                if self.stats is not None:
+                    finished = time.time()
+                    self.stats.count(manifest_requests=1)
+                    self.stats.observe(serve_seconds=finished - serving,
+                                       manifest_seconds=finished - started)
 
         # this URI is not being requested using a POST method
         # return criteria list for AI-client to know what needs querried
         else:
             # <CriteriaList>
-            #       <Version Number="0.5">
+            #       <Version Number="1.0">
             #       <Criteria Name="MEM">
             #       <Criteria Name="arch">
             # ...
             # </CriteriaList>
 
             cherrypy.response.headers['Content-Type'] = "text/xml"
-            XML = lxml.etree.Element("CriteriaList")
-            version_value = lxml.etree.Element("Version")
-            version_value.attrib["Number"] = "0.5"
-            XML.append(version_value)
-            for crit in AIdb.getCriteria(self.AISQL.getQueue(), strip=True):
-                tag = lxml.etree.Element("Criteria")
-                tag.attrib["Name"] = crit
-                XML.append(tag)
-            return lxml.etree.tostring(XML, pretty_print=True)
+            # the criteria list comes from the criteria index
+            self.getIndex()
+            return self.cachedPage("CriteriaList", self.renderCriteriaList,
+                                   self._index_stamp)
+
+    def renderCriteriaList(self):
+        """
+        Render the criteria list for AI-clients to know what needs querried
+        """
+        XML = lxml.etree.Element("CriteriaList")
+        version_value = lxml.etree.Element("Version")
+        version_value.attrib["Number"] = CRITERIA_LIST_VERSION
+        XML.append(version_value)
+        for crit in self.getIndex().getCriteria():
+            tag = lxml.etree.Element("Criteria")
+            tag.attrib["Name"] = crit
+            XML.append(tag)
+        return lxml.etree.tostring(XML, pretty_print=True)
+
+class Stats:
+    """
+    Class provides the /stats path of the server, listing the server's
+    counters and histograms as text, one per line as "name value" (see
+    server_stats.formatText()), or as a JSON object with ?format=json
+    """
+
+    def __init__(self, sources):
+        """
+        sources is a list of objects whose stats() method returns a list of
+        (name, value) tuples
+        """
+        self.sources = sources
+
+    @cherrypy.expose
+    def index(self, format="text"):
+        """ List the statistics of each source """
+        stats = list()
+        for source in self.sources:
+            stats.extend(source.stats())
+        if format == "json":
+            cherrypy.response.headers['Content-Type'] = "application/json"
+            return json.dumps(OrderedDict(stats), indent=1) + "\n"
+        cherrypy.response.headers['Content-Type'] = "text/plain"
+        return server_stats.formatText(stats)
 
 class Manifests:
     """
@@ -311,9 +663,7 @@ class Manifests:
         """
         Special path to serve anything (under /manifests/<path>)
         """
-        return serve_file(os.path.abspath(os.path.join(self.base_dir,
-                          "AI_data", path)), "application/x-download",
-                          "attachment")
+        return serveManifest(os.path.join(self.base_dir, "AI_data"), path)
 
 
 class AIFiles:
@@ -322,8 +672,14 @@ class AIFiles:
     """
 
 
-    def __init__(self, data_loc):
+    def __init__(self, data_loc, stats=True):
         self.base_dir = data_loc
+        # throughput of serving files, for /stats (None if disabled)
+        self.stats = None
+        if stats:
+            self.stats = server_stats.StatsGroup("ai_files_",
+                counters=("requests", "partial_requests", "not_modified",
+                          "bytes", "seconds"))
 
     @cherrypy.expose
     def index(self):
@@ -336,24 +692,292 @@ class AIFiles:
     @cherrypy.expose
     def default(self, path=None):
         """
-        Special path to serve anything (under /AI_files/<path>)
+        Special path to serve anything (under /AI_files/<path>).  Each
+        request reads the file through a file object of its own, so
+        downloads of the same file do not wait on one another, and Range
+        (and If-Range) requests are answered so interrupted downloads can
+        resume.
+        """
+        if self.stats is not None:
+            started = time.time()
+        else:
+            started = None
+        file_path = os.path.abspath(os.path.join(self.base_dir,
+                                    os.path.join("AI_files", path)))
+        if not os.path.isfile(file_path):
+            raise cherrypy.NotFound()
+        try:
+            fileobj = open(file_path, "rb")
+        except IOError:
+            raise cherrypy.NotFound()
+        # describe the file opened, even if it has since been replaced
+        stat = os.fstat(fileobj.fileno())
+        if self.stats is not None:
+            self.stats.count(requests=1)
+
+        # the file is closed by fileGenerator() once served, or here if
+        # no body is served from it
+        etag = '"%x-%x-%x"' % (stat.st_ino, stat.st_size,
+                               int(stat.st_mtime))
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+        response = cherrypy.response
+        response.headers['Content-Type'] = "application/x-download"
+        response.headers['Content-Disposition'] = \
+            'attachment; filename="%s"' % os.path.basename(file_path)
+        response.headers['Accept-Ranges'] = "bytes"
+        response.headers['ETag'] = etag
+        response.headers['Last-Modified'] = last_modified
+        # raise a 304 if the client's copy is current
+        try:
+            cptools.validate_since()
+            cptools.validate_etags()
+        except cherrypy.HTTPRedirect:
+            fileobj.close()
+            if self.stats is not None:
+                self.stats.count(not_modified=1)
+            raise
+        except cherrypy.HTTPError:
+            fileobj.close()
+            raise
+
+        byte_range = requestedRange(stat.st_size, etag, last_modified)
+        if byte_range == ():
+            fileobj.close()
+            response.status = 416
+            response.headers['Content-Range'] = "bytes */%d" % stat.st_size
+            response.headers['Content-Length'] = 0
+            return ""
+        elif byte_range is None:
+            byte_range = (0, stat.st_size)
+        else:
+            if self.stats is not None:
+                self.stats.count(partial_requests=1)
+            response.status = 206
+            response.headers['Content-Range'] = "bytes %d-%d/%d" % \
+                (byte_range[0], byte_range[1] - 1, stat.st_size)
+        response.headers['Content-Length'] = byte_range[1] - byte_range[0]
+        response.stream = True
+        return fileGenerator(self.stats, fileobj, byte_range[0],
+                             byte_range[1], started)
+
+class ServiceRouter(object):
+    """
+    WSGI application serving the install services of a webserver serving
+    all of them (-a).  A request is answered by the install service
+    listening on the port it arrived on, so clients see no difference from
+    a webserver of their own; otherwise (on the webserver's own port) by
+    the install service named by the first label of the request's Host
+    (i.e. http://<service>.<server>:<port>/).
+    """
+
+    def __init__(self):
+        # cherrypy Trees of the install services by port and by name
+        # (replaced as a whole whenever install services are added or
+        # dropped, as requests are routed meanwhile)
+        self.ports = dict()
+        self.names = dict()
+
+    def __call__(self, environ, start_response):
+        tree = self.ports.get(environ.get("SERVER_PORT"))
+        if tree is None:
+            host = environ.get("HTTP_HOST", "").split(":")[0]
+            tree = self.names.get(host.split(".")[0])
+        if tree is None:
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return [_("No install service at this address") + "\n"]
+        return tree(environ, start_response)
+
+class SharedRequests(object):
+    """
+    Stands in for the thread pool of an HTTP server, handing the
+    connections it accepts to the thread pool of another server instead.
+    The pool is started and stopped by the server owning it.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def start(self):
+        """ The pool is started by the server owning it """
+        pass
+
+    def stop(self, timeout=5):
+        """ The pool is stopped by the server owning it """
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+class AllServices(plugins.SimplePlugin):
+    """
+    Engine plugin keeping the ServiceRouter router serving every install
+    service enabled in SMF.  Install services enabled since are mounted,
+    and listened for on their own port, and those disabled or deleted since
+    are dropped when the engine starts, every SERVICE_POLL_INTERVAL seconds
+    and on a graceful restart (SIGUSR1).  The listeners hand the
+    connections they accept to the thread pool of the main cherrypy server,
+    so all install services share its threads, while each keeps its own
+    AI.db connections and criteria index (its staticPages).
+    """
+
+    def __init__(self, bus, router, options):
+        plugins.SimplePlugin.__init__(self, bus)
+        self.router = router
+        self.options = options
+        # the (Tree, staticPages, listening Server or None) of each install
+        # service served, keyed by its (name, port)
+        self.services = dict()
+        self._lock = threading.Lock()
+        self.monitor = plugins.Monitor(bus, self.update,
+                                       SERVICE_POLL_INTERVAL)
+
+    def subscribe(self):
+        plugins.SimplePlugin.subscribe(self)
+        self.monitor.subscribe()
+
+    def start(self):
+        """ Serves the enabled install services once the server is up """
+        self.update()
+    # after the main server has started (and so has its thread pool)
+    start.priority = 80
+
+    def graceful(self):
+        """ Rereads the install services enabled """
+        self.update()
+
+    def stop(self):
+        """ Stops serving every install service """
+        self._lock.acquire()
+        try:
+            dropped = self.services.values()
+            self.services = dict()
+            self.route()
+            self.drop(dropped)
+        finally:
+            self._lock.release()
+
+    def update(self):
+        """
+        Serves the install services enabled in SMF now, and stops serving
+        any others.  An install service which can not be served is logged,
+        and tried again on the next update.
+        """
+        self._lock.acquire()
+        try:
+            try:
+                enabled = set(enabledServices())
+            except (Exception, SystemExit), err:
+                cherrypy.log(_("Unable to read the install services: %s") %
+                             err)
+                return
+            dropped = [self.services.pop(service) for service in
+                       set(self.services) - enabled]
+            for service in sorted(enabled - set(self.services)):
+                self.add(service)
+            self.route()
+            self.drop(dropped)
+        finally:
+            self._lock.release()
+
+    def add(self, (name, port)):
+        """
+        Mounts the install service name on a Tree of its own, listening for
+        it on port (unless that is the main server's port)
         """
-        return serve_file(os.path.abspath(os.path.join(self.base_dir,
-                          os.path.join("AI_files", path))),
-                          "application/x-download",
-                          "attachment")
+        tree = cherrypy._cptree.Tree()
+        try:
+            pages = mountService(tree, os.path.join(SERVICES_DIR, str(port)),
+                                 self.options)
+        except (Exception, SystemExit), err:
+            cherrypy.log(_("Not serving %s: %s") % (name, err))
+            return
+        listener = None
+        if port != self.options.port:
+            listener = cherrypy._cpserver.Server()
+            listener.socket_host = self.options.listen
+            listener.socket_port = port
+            (listener.httpserver, listener.bind_addr) = \
+                listener.httpserver_from_self()
+            listener.httpserver.requests = \
+                SharedRequests(cherrypy.server.httpserver.requests)
+            try:
+                listener.start()
+            except (Exception, SystemExit), err:
+                cherrypy.log(_("Not serving %s on port %d: %s") %
+                             (name, port, err))
+                pages.close()
+                return
+        cherrypy.log(_("Serving %s on port %d") % (name, port))
+        self.services[(name, port)] = (tree, pages, listener)
+
+    def route(self):
+        """ Points the router at the install services served """
+        self.router.ports = dict([(str(port), tree) for ((name, port),
+            (tree, pages, listener)) in self.services.iteritems()])
+        self.router.names = dict([(name, tree) for ((name, port),
+            (tree, pages, listener)) in self.services.iteritems()])
+
+    def drop(self, services):
+        """
+        Stops listening for, and closes the AI.db of, each of the
+        (Tree, staticPages, listening Server) of services, once no longer
+        routed to
+        """
+        for (tree, pages, listener) in services:
+            if listener is not None:
+                listener.stop()
+            pages.close()
+
+def enabledServices():
+    """
+    Returns a list of the (name, port) of each install service enabled in
+    SMF
+    """
+    services = list()
+    for (name, svc) in \
+        smf.AISCF(FMRI="system/install/server").services.iteritems():
+        try:
+            if svc['status'] != "on":
+                continue
+            # txt_record is of the form "aiwebserver=example:46503"
+            port = int(svc['txt_record'].rsplit(':')[-1])
+        except (KeyError, ValueError):
+            continue
+        services.append((name, port))
+    return services
+
+def mountService(tree, data_loc, options):
+    """
+    Mounts the pages of the install service in data_loc on the cherrypy
+    Tree tree.  Returns the service's staticPages.
+    """
+    conf = {"/": {}}
+    pages = staticPages(data_loc, options.thread, options.stats)
+    tree.mount(pages, config=conf)
+    tree.mount(Manifests(data_loc), script_name="/manifests", config=conf)
+    ai_files = AIFiles(data_loc, options.stats)
+    tree.mount(ai_files, script_name="/ai-files", config=conf)
+    # serve /stats itself rather than redirecting to /stats/
+    tree.mount(Stats(filter(None, [pages.stats, pages.dbStats,
+                                   ai_files.stats])),
+               script_name="/stats",
+               config={"/": {"tools.trailing_slash.on": False}})
+    return pages
 
 if __name__ == '__main__':
     gettext.install("ai", "/usr/lib/locale")
     (OPTIONS, DATA_LOC) = parse_options()
-    CONF = { "/": { } }
-    ROOT = cherrypy.tree.mount(staticPages(DATA_LOC))
-    cherrypy.tree.mount(Manifests(DATA_LOC), script_name="/manifests",
-                        config=CONF)
-    cherrypy.tree.mount(AIFiles(DATA_LOC), script_name="/ai-files",
-                        config=CONF)
+    if OPTIONS.all_services:
+        ROUTER = ServiceRouter()
+        cherrypy.tree.graft(ROUTER)
+        AllServices(cherrypy.engine, ROUTER, OPTIONS).subscribe()
+    else:
+        mountService(cherrypy.tree, DATA_LOC, OPTIONS)
     cherrypy.config.update({"request.show_tracebacks": OPTIONS.debug,
                             "server.socket_host": OPTIONS.listen,
                             "server.socket_port": OPTIONS.port,
                             "server.thread_pool": OPTIONS.thread})
-    cherrypy.quickstart(ROOT, config=CONF)
+    if hasattr(cherrypy.engine, "signal_handler"):
+        cherrypy.engine.signal_handler.subscribe()
+    cherrypy.engine.start()
+    cherrypy.engine.block()
@@ -32,11 +32,17 @@ import sys
 import time
 
 import getopt
+import hashlib
 import httplib
+import os
+import Queue
 import re
 import socket
 from subprocess import Popen, PIPE
+import tempfile
+import threading
 import traceback
+import zlib
 
 #
 # AILog class - provides logging capabilities for
@@ -61,6 +67,9 @@ class AILog:
         self.dbg_lvl_current = debuglevel
         self.fh_log = None
 
+        # serializes messages posted by concurrent threads
+        self.lock = threading.Lock()
+
         # list of prefixes displayed for particular logging levels
         self.log_prefix = {AILog.AI_DBGLVL_EMERG: "!",
             AILog.AI_DBGLVL_ERR: "E", AILog.AI_DBGLVL_WARN: "W",
@@ -109,12 +118,16 @@ class AILog:
         else:
             log_msg += msg_format % msg_args
 
-        # post message to console
-        print log_msg
+        self.lock.acquire()
+        try:
+            # post message to console
+            print log_msg
 
-        # post message to file
-        if self.fh_log is not None:
-            self.fh_log.write(log_msg + '\n')
+            # post message to file
+            if self.fh_log is not None:
+                self.fh_log.write(log_msg + '\n')
+        finally:
+            self.lock.release()
 
         return
 
@@ -333,9 +346,22 @@ class AICriteriaNetworkInterface(AICriteria):
     ifconfig_iface_info = None
     network_iface_initialized = False
 
+    # serializes probes of criteria derived from network interface
+    lock = threading.Lock()
+
     def __init__(self):
         AICriteria.__init__(self)
 
+        AICriteriaNetworkInterface.lock.acquire()
+        try:
+            self.probe()
+        finally:
+            AICriteriaNetworkInterface.lock.release()
+
+    def probe(self):
+        """ obtain information about network interface
+        """
+
         # initialize class variables only once
         if AICriteriaNetworkInterface.network_iface_initialized:
             return
@@ -457,12 +483,26 @@ class AICriteriaIP(AICriteriaNetworkInterface):
     client_ip_string = None
     client_ip_initialized = False
 
+    # serializes probes of criteria derived from IP address
+    lock = threading.Lock()
+
     def __init__(self):
         AICriteriaNetworkInterface.__init__(self)
 
+        AICriteriaIP.lock.acquire()
+        try:
+            self.probe_ip()
+        finally:
+            AICriteriaIP.lock.release()
+
+        AICriteria.__init__(self, AICriteriaIP.client_ip_string)
+
+    def probe_ip(self):
+        """ obtain client IP address
+        """
+
         # initialize class variables only once
         if AICriteriaIP.client_ip_initialized:
-            AICriteria.__init__(self, AICriteriaIP.client_ip_string)
             return
 
         AICriteriaIP.client_ip_initialized = True
@@ -484,8 +524,6 @@ class AICriteriaIP(AICriteriaNetworkInterface):
                           "Client IP address: %s",
                           AICriteriaIP.client_ip_string)
 
-        AICriteria.__init__(self, AICriteriaIP.client_ip_string)
-
 class AICriteriaNetwork(AICriteriaIP):
     """ Class: AICriteriaNetwork class - class for obtaining/manipulating
         information about client network address
@@ -544,6 +582,10 @@ class AICriteriaNetwork(AICriteriaIP):
 #
 # It also contains short informative description of the criteria
 #
+# Criteria are only obtained when asked for by ai_probe_criteria(),
+# which creates instances of classes of several criteria at once,
+# each in its own thread.
+#
 # Use following steps if support for new criteria is required:
 # [1] Define name of criteria (like 'MEM'), create new class
 #     which inherits AICriteria and implements method for
@@ -562,7 +604,100 @@ AI_CRITERIA_SUPPORTED = {
     'network': (AICriteriaNetwork, "Client network address"),
     'platform': (AICriteriaPlatform, "Client platform")
 }
+
+#
+# criteria obtained so far (instances of classes in AI_CRITERIA_SUPPORTED
+# by criteria name), so that each of them is probed only once
+#
+AI_CRITERIA_PROBED = {}
+AI_CRITERIA_PROBE_LOCKS = dict([(key, threading.Lock()) for key in
+                                AI_CRITERIA_SUPPORTED.keys()])
 	
+#
+# version of the criteria negotiation this client speaks; AI services
+# advertising this version (or later) in their criteria list accept all
+# criteria known to the client in a single POST, ignoring those they don't
+# use, so the criteria list need not be asked for first
+#
+AI_CRITERIA_VERSION = "1.0"
+
+#
+# default time (in seconds) to wait for AI service webserver to accept
+# connection or to send data, before the attempt is given up
+#
+AI_HTTP_TIMEOUT = 30
+
+# default time (in seconds) to wait for connection to be established
+AI_HTTP_CONNECT_TIMEOUT = 10
+
+# bytes read from AI service webserver at a time
+AI_HTTP_CHUNK_SIZE = 64 * 1024
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def ai_probe_criterion(key):
+    """		Description: Obtains criteria, unless already obtained
+
+		Parameters:
+		    key - name of criteria in AI_CRITERIA_SUPPORTED
+    """
+
+    AI_CRITERIA_PROBE_LOCKS[key].acquire()
+    try:
+        if AI_CRITERIA_PROBED.has_key(key):
+            return
+
+        try:
+            ai_crit = AI_CRITERIA_SUPPORTED[key][0]()
+        except StandardError, err:
+            AIGM_LOG.post(AILog.AI_DBGLVL_ERR,
+                          "Couldn't obtain %s criteria: %s", key, err)
+            ai_crit = AICriteria()
+
+        if ai_crit.is_known():
+            AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
+                          " %s=%s, '%s'", key, ai_crit.get(),
+                          AI_CRITERIA_SUPPORTED[key][1])
+
+        AI_CRITERIA_PROBED[key] = ai_crit
+    finally:
+        AI_CRITERIA_PROBE_LOCKS[key].release()
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def ai_probe_criteria(keys):
+    """		Description: Obtains given criteria, those not obtained yet
+		             at the same time
+
+		Parameters:
+		    keys - names of criteria, those client doesn't support
+		           are ignored
+
+		Returns:
+		    dictionary of criteria name-value pairs client can supply
+    """
+
+    threads = []
+    for key in keys:
+        if not AI_CRITERIA_SUPPORTED.has_key(key) or \
+            AI_CRITERIA_PROBED.has_key(key):
+            continue
+
+        thread = threading.Thread(target=ai_probe_criterion, args=(key,))
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    ai_criteria_known = {}
+    for key in keys:
+        if AI_CRITERIA_PROBED.has_key(key) and \
+            AI_CRITERIA_PROBED[key].is_known():
+            ai_criteria_known[key] = AI_CRITERIA_PROBED[key].get()
+
+    return ai_criteria_known
+
+
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 def usage():
     """ Print usage message and exit
@@ -570,12 +705,220 @@ def usage():
     
     print >> sys.stderr, ("Usage:\n" \
                           "    ai_get_manifest -s service_list -o destination"\
-                          " [-d debug_level] [-l] [-h]")
+                          " [-t timeout] [-c] [-d debug_level] [-l] [-h]")
     sys.exit(1)
 
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-def ai_get_http_file(address, file_path, method, * nv_pairs):
+class AIHTTPClient:
+    """ Class: AIHTTPClient - HTTP client keeping connection to each web
+        server open between requests, so that all requests sent to the
+        same server share one connection
+    """
+
+    def __init__(self):
+        # idle connections by address of web server
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def connect(self, address, timeout, connect_timeout):
+        """ Metod:    connect
+
+		    Description:
+		        Takes idle connection to web server, or connects to it
+		        if there is none
+
+		    Parameters:
+		        address - address of web server to connect
+		        timeout - max time to wait for data from web server
+		        connect_timeout - max time to wait for connection
+
+		    Returns:
+		        connection
+		        True..connection was used before, False..new connection
+        """
+
+        self.lock.acquire()
+        try:
+            http_conn = self.connections.pop(address, None)
+        finally:
+            self.lock.release()
+
+        if http_conn is not None:
+            http_conn.sock.settimeout(timeout)
+            return http_conn, True
+
+        http_conn = httplib.HTTPConnection(address,
+                                           timeout=min(timeout,
+                                                       connect_timeout))
+        http_conn.connect()
+        http_conn.sock.settimeout(timeout)
+        return http_conn, False
+
+    def release(self, address, http_conn):
+        """ Metod:    release
+
+		    Description:
+		        Keeps connection to web server open for next request
+        """
+
+        self.lock.acquire()
+        try:
+            if not self.connections.has_key(address):
+                self.connections[address] = http_conn
+                return
+        finally:
+            self.lock.release()
+
+        http_conn.close()
+
+    def close(self):
+        """ Metod:    close
+
+		    Description:
+		        Closes all idle connections
+        """
+
+        self.lock.acquire()
+        try:
+            for http_conn in self.connections.values():
+                http_conn.close()
+            self.connections.clear()
+        finally:
+            self.lock.release()
+
+    def request(self, address, method, file_path, body=None, headers=None,
+                dest_file=None, timeout=AI_HTTP_TIMEOUT,
+                connect_timeout=AI_HTTP_CONNECT_TIMEOUT):
+        """ Metod:    request
+
+		    Description:
+		        Sends request to web server and reads response to it,
+		        uncompressing gzip compressed one
+
+		    Parameters:
+		        address - address of web server to connect
+		        method - 'POST' or 'GET'
+		        file_path - path to file
+		        body - data to be sent with request
+		        headers - dictionary of HTTP headers of request
+		        dest_file - file to write response to as it is read,
+		                    if it is successful (status 200)
+		        timeout - max time to wait for data from web server
+		        connect_timeout - max time to wait for connection
+
+		    Returns:
+		        response, unless it was written to dest_file
+		        HTTP Response status code
+		        SHA-1 checksum of (uncompressed) response
+
+		    Raises:
+		        httplib.HTTPException, socket.error or zlib.error
+		        if request fails
+        """
+
+        if headers is None:
+            headers = {}
+
+        while True:
+            http_conn, reused = self.connect(address, timeout,
+                                             connect_timeout)
+            try:
+                http_conn.request(method, file_path, body, headers)
+                http_response = http_conn.getresponse()
+                break
+            except socket.timeout:
+                http_conn.close()
+                raise
+            except (httplib.HTTPException, socket.error):
+                http_conn.close()
+                #
+                # web server closes connections idle for too long,
+                # so retry with new one
+                #
+                if not reused:
+                    raise
+
+        try:
+            url_content, checksum = self.read(http_response, dest_file)
+        except StandardError:
+            http_conn.close()
+            raise
+
+        if http_response.will_close:
+            http_conn.close()
+        else:
+            self.release(address, http_conn)
+
+        return url_content, http_response.status, checksum
+
+    def read(self, http_response, dest_file=None):
+        """ Metod:    read
+
+		    Description:
+		        Reads response of web server, uncompressing it if it
+		        is gzip compressed
+
+		    Parameters:
+		        http_response - httplib.HTTPResponse to read
+		        dest_file - file to write response to, if it is
+		                    successful (status 200)
+
+		    Returns:
+		        response, unless it was written to dest_file
+		        SHA-1 checksum of (uncompressed) response
+        """
+
+        if dest_file is None or http_response.status != httplib.OK:
+            url_content = []
+            write = url_content.append
+        else:
+            url_content = None
+            write = dest_file.write
+
+        # the web server sends stored manifests gzip compressed as we accept it
+        if http_response.getheader("Content-Encoding") == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            decompressor = None
+
+        checksum = hashlib.sha1()
+        received = 0
+        while True:
+            data = http_response.read(AI_HTTP_CHUNK_SIZE)
+            if not data:
+                break
+            received += len(data)
+
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            checksum.update(data)
+            write(data)
+
+        if decompressor is not None:
+            data = decompressor.flush()
+            checksum.update(data)
+            write(data)
+
+        # connection closed before whole response was sent
+        length = http_response.getheader("Content-Length")
+        if length is not None and received != int(length):
+            raise httplib.IncompleteRead("", int(length) - received)
+
+        if url_content is not None:
+            url_content = "".join(url_content)
+
+        return url_content, checksum.hexdigest()
+
+#
+# connections to AI service webservers shared by all requests
+#
+AI_HTTP_CLIENT = AIHTTPClient()
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def ai_get_http_file(address, file_path, method, nv_pairs=None,
+                     version=None, timeout=AI_HTTP_TIMEOUT, dest_file=None):
     """		Description: Downloads file from url using HTTP protocol
 
 		Parameters:
@@ -584,52 +927,70 @@ def ai_get_http_file(address, file_path, method, * nv_pairs):
 		    method - 'POST' or 'GET'
 		    nv_pairs - dictionary containing name-value pairs to be sent
 		               to the server using 'POST' method
+		    version - criteria negotiation version to be sent along
+		              with nv_pairs, if any
+		    timeout - max time to wait for data from web server
+		    dest_file - file to write file to as it is downloaded,
+		                instead of returning it
 
 		Returns:
-		    file
+		    file, None if it was written to dest_file
 		    return code: >= 100 - HTTP Response status code
 		                 -1 - Connection to web server failed
 	"""
 
-    # try to connect to the provided web server
-    http_conn = httplib.HTTPConnection(address)
-
-    # turn on debug mode in order to track HTTP connection
-    # http_conn.set_debuglevel(1)
-    try:
-        if (method == "POST"):
-            post_data = "postData="
-            for key in nv_pairs[0].keys():
-                post_data += "%s=%s;" % (key, nv_pairs[0][key])
+    post_data = None
+    http_headers = {"Accept-Encoding": "gzip"}
+    if (method == "POST"):
+        post_data = "postData="
+        for key in nv_pairs.keys():
+            post_data += "%s=%s;" % (key, nv_pairs[key])
 
-            # remove trailing ';' and replace all ';' with "%3B",
-            # so that the data is correctly passed to AI web server
-            post_data = post_data.rstrip(';').replace(";", "%3B")
+        # remove trailing ';' and replace all ';' with "%3B",
+        # so that the data is correctly passed to AI web server
+        post_data = post_data.rstrip(';').replace(";", "%3B")
+        if version is not None:
+            post_data += "&version=%s" % version
 
-            AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
-                          "%s", post_data)
+        AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
+                      "%s", post_data)
 
-            http_headers = {"Content-Type":
-                "application/x-www-form-urlencoded"}
+        http_headers["Content-Type"] = "application/x-www-form-urlencoded"
 
-            http_conn.request("POST", file_path, post_data, http_headers)
-        else:
-            http_conn.request("GET", file_path)
+    # send the request over connection to the web server kept open
+    try:
+        url_content, http_status, checksum = \
+            AI_HTTP_CLIENT.request(address, method, file_path, post_data,
+                                   http_headers, dest_file, timeout)
 
     except httplib.InvalidURL:
         AIGM_LOG.post(AILog.AI_DBGLVL_ERR,
                       "%s is not valid URL", address)
         return None, -1
 
+    except socket.timeout:
+        AIGM_LOG.post(AILog.AI_DBGLVL_ERR,
+                      "Connection to %s timed out", address)
+        return None, -1
+
+    except zlib.error:
+        AIGM_LOG.post(AILog.AI_DBGLVL_ERR,
+                      "Corrupt compressed response from %s", address)
+        return None, -1
+
+    except httplib.IncompleteRead:
+        AIGM_LOG.post(AILog.AI_DBGLVL_ERR,
+                      "Incomplete response from %s", address)
+        return None, -1
+
     except StandardError:
         AIGM_LOG.post(AILog.AI_DBGLVL_ERR,
                       "Connection to %s refused", address)
         return None, -1
 
-    http_response = http_conn.getresponse()
-    url_content = http_response.read()
-    http_status = http_response.status
-    http_conn.close()
+    AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
+                  "%s %s%s: status %d, SHA-1 %s", method, address,
+                  file_path, http_status, checksum)
 
     return url_content, http_status
 
@@ -659,6 +1020,295 @@ def ai_get_requested_criteria_list(xml_file):
     return crit_required, 0
 
 
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def ai_version_tuple(version):
+    """		Description: Converts version string (like "1.0") to tuple
+		             of integers, so versions can be compared
+
+		Parameters:
+		    version - version string
+
+		Returns:
+		    version as a tuple of integers, (0,) if it is malformed
+    """
+
+    try:
+        return tuple([int(part) for part in version.split('.')])
+    except ValueError:
+        return (0,)
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def ai_get_criteria_list_version(xml_file):
+    """		Description: Version of criteria negotiation advertised in
+		             given criteria list XML file
+
+		Parameters:
+		    xml_file - XML file with criteria
+
+		Returns:
+		    version as a tuple of integers, (0,) if none is advertised
+    """
+
+    version = re.search(r"<Version Number=\"([^\"]*)\"", xml_file)
+    if version is None:
+        return (0,)
+    return ai_version_tuple(version.group(1))
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def ai_get_service_manifest(ai_service, timeout=AI_HTTP_TIMEOUT,
+                            dest_file=None):
+    """		Description: Asks AI service for manifest matching client
+
+		Parameters:
+		    ai_service - address of AI service webserver
+		    timeout - max time to wait for data from web server
+		    dest_file - file to write manifest to as it is downloaded,
+		                instead of returning it
+
+		Returns:
+		    manifest, None if it was written to dest_file
+		    return code: >= 100 - HTTP Response status code
+		                 -1 - Connection to web server failed
+    """
+
+    #
+    # [1] Post all criteria client knows at once. A service speaking
+    #     version AI_CRITERIA_VERSION of the negotiation ignores those it
+    #     doesn't use, older ones refuse the request.
+    #
+    ai_criteria_known = ai_probe_criteria(AI_CRITERIA_SUPPORTED.keys())
+
+    AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
+                  "Sending all known criteria, asking for manifest:")
+    AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
+                  " HTTP POST %s %s", ai_criteria_known, ai_service)
+
+    ai_manifest, post_ret = ai_get_http_file(ai_service, "/manifest.xml",
+                                             "POST", ai_criteria_known,
+                                             AI_CRITERIA_VERSION, timeout,
+                                             dest_file)
+    if post_ret == httplib.OK or post_ret == -1:
+        return ai_manifest, post_ret
+
+    AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
+                  "%s AI service didn't provide manifest for all known "
+                  "criteria, ret=%d", ai_service, post_ret)
+
+    #
+    # [2] Fall back to asking for list of criteria server is interested in
+    #     GET <service>/manifest.xml
+    #
+    AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
+                  "Asking for criteria list:")
+    AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
+                  " HTTP GET %s/manifest.xml", ai_service)
+
+    xml_criteria, ret = ai_get_http_file(ai_service,
+                                         "/manifest.xml", "GET",
+                                         timeout=timeout)
+
+    if ret != httplib.OK:
+        AIGM_LOG.post(AILog.AI_DBGLVL_ERR,
+                      "Couldn't obtain criteria list from %s, ret=%d",
+                      ai_service, ret)
+        return None, ret
+
+    #
+    # A service advertising the version client speaks understood the first
+    # request, so its answer stands
+    #
+    if ai_get_criteria_list_version(xml_criteria) >= \
+        ai_version_tuple(AI_CRITERIA_VERSION):
+        return ai_manifest, post_ret
+
+    #
+    # Extract list of required criteria from XML file provided
+    # format of XML file is not validated, information is being
+    # extracted in simple way. This is just interim solution
+    # todo: Switch to DC XML validator - bug 12494
+    #
+    # The format of file for November is following (it might become
+    # more complex and will be docummented in design spec):
+    #
+    # <CriteriaList>
+    #	<Version Number="0.5">
+    # 	<Criteria Name="MEM">
+    #	<Criteria Name="arch">
+    # ...
+    # </CriteriaList>
+    #
+    criteria_required, ret = \
+        ai_get_requested_criteria_list(xml_criteria)
+
+    # Fill in dictionary with criteria name-value pairs
+    ai_crit_response = ai_probe_criteria(criteria_required)
+
+    AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
+                  "List of criteria to be sent:")
+    for cr_key in ai_crit_response.keys():
+        AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
+                      " %s=%s", cr_key, ai_crit_response[cr_key])
+
+    #
+    # [3] Return criteria as a list of name,value pairs
+    #     POST "postData=cr_name1=cr_value1;cr_name2=cr_value2"
+    #     <service>/manifest.xml
+    #
+    AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
+                  "Sending list of criteria, asking for manifest:")
+    AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
+                  " HTTP POST %s %s", ai_crit_response, ai_service)
+
+    return ai_get_http_file(ai_service, "/manifest.xml", "POST",
+                            ai_crit_response, timeout=timeout,
+                            dest_file=dest_file)
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def ai_read_service_list(service_list):
+    """		Description: Reads list of AI services to contact
+
+		Parameters:
+		    service_list - file listing AI services, one per line
+		                   in format <address>:<port> [<priority>]
+
+		Returns:
+		    list of AI service addresses ordered by priority (lower
+		    first, 0 if not given), then by order in the file
+		    return code: 0 - Success, -1 - Failure
+    """
+
+    try:
+        service_list_fh = open(service_list, 'r')
+    except IOError:
+        AIGM_LOG.post(AILog.AI_DBGLVL_ERR,
+                      "Couldn't open %s file", service_list)
+        return None, -1
+
+    ai_services = []
+    for line in service_list_fh.readlines():
+        fields = line.split()
+        if not fields:
+            continue
+
+        priority = 0
+        if len(fields) > 1:
+            try:
+                priority = int(fields[1])
+            except ValueError:
+                AIGM_LOG.post(AILog.AI_DBGLVL_WARN,
+                              "Invalid priority of %s AI service: %s",
+                              fields[0], fields[1])
+
+        ai_services.append((priority, len(ai_services), fields[0]))
+
+    service_list_fh.close()
+
+    ai_services.sort()
+    return [ai_service for (priority, index, ai_service) in ai_services], 0
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def ai_save_service_manifest(ai_service, fh_manifest,
+                             timeout=AI_HTTP_TIMEOUT):
+    """		Description: Asks AI service for manifest matching client,
+		             saving it as it is downloaded
+
+		Parameters:
+		    ai_service - address of AI service webserver
+		    fh_manifest - file to save manifest to, closed when done
+		    timeout - max time to wait for data from web server
+
+		Returns:
+		    return code: >= 100 - HTTP Response status code
+		                 -1 - Connection to web server failed
+    """
+
+    start = time.time()
+    try:
+        ret = ai_get_service_manifest(ai_service, timeout, fh_manifest)[1]
+    finally:
+        fh_manifest.close()
+
+    AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
+                  "%s AI service answered in %.3f s, ret=%d",
+                  ai_service, time.time() - start, ret)
+
+    if ret != httplib.OK:
+        AIGM_LOG.post(AILog.AI_DBGLVL_WARN,
+                      "%s AI service didn't provide valid manifest, " \
+                      "ret=%d", ai_service, ret)
+
+    return ret
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def ai_race_service_manifests(ai_services, manifest_files,
+                              timeout=AI_HTTP_TIMEOUT):
+    """		Description: Asks all AI services for manifest matching
+		             client at the same time. Manifest provided by
+		             a service is taken as soon as all services
+		             listed before it failed to provide one, so the
+		             service chosen doesn't depend on which of them
+		             answered first.
+
+		Parameters:
+		    ai_services - addresses of AI service webservers,
+		                  in order of preference
+		    manifest_files - files to save manifests provided by
+		                     each of ai_services to, closed when done
+		    timeout - max time to wait for data from web server
+
+		Returns:
+		    index of AI service which provided manifest, None if
+		    none did
+		    return code: >= 100 - HTTP Response status code
+		                 -1 - Connection to web server failed
+    """
+
+    answers = Queue.Queue()
+
+    def ai_ask_service(index):
+        """ Asks one AI service for manifest, posting answer to queue
+        """
+        try:
+            ret = ai_save_service_manifest(ai_services[index],
+                                           manifest_files[index], timeout)
+        except StandardError, err:
+            AIGM_LOG.post(AILog.AI_DBGLVL_ERR,
+                          "Asking %s AI service for manifest failed: %s",
+                          ai_services[index], err)
+            ret = -1
+
+        answers.put((index, ret))
+
+    for index in range(len(ai_services)):
+        # don't let services which are slow to answer hold client up
+        thread = threading.Thread(target=ai_ask_service, args=(index,))
+        thread.setDaemon(True)
+        thread.start()
+
+    results = [None] * len(ai_services)
+    ret = -1
+    for answer in range(len(ai_services)):
+        (index, ret) = answers.get()
+        results[index] = ret
+
+        #
+        # Take the manifest of the first service in the list which
+        # provided one, once all services before it have answered
+        #
+        for index in range(len(ai_services)):
+            if results[index] is None:
+                break
+            if results[index] == httplib.OK:
+                return index, httplib.OK
+
+    return None, ret
+
+
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 def parse_cli(cli_opts_args):
     """ main application
@@ -670,7 +1320,7 @@ def parse_cli(cli_opts_args):
     opts_args = cli_opts_args[1:]
 
     try:
-        opts = getopt.getopt(opts_args, "s:o:d:lh")[0]
+        opts = getopt.getopt(opts_args, "s:o:t:d:clh")[0]
     except getopt.GetoptError:
         AIGM_LOG.post(AILog.AI_DBGLVL_ERR,
                       "Invalid options or arguments provided")
@@ -679,12 +1329,18 @@ def parse_cli(cli_opts_args):
     service_list = "/tmp/service_list"
     manifest_file = "/tmp/manifest.xml"
     list_criteria_only = False
+    http_timeout = AI_HTTP_TIMEOUT
+    race_services = False
 
     for option, argument in opts:
         if option == "-s":
             service_list = argument
         elif option == "-o":
             manifest_file = argument
+        elif option == "-t":
+            http_timeout = int(argument)
+        elif option == "-c":
+            race_services = True
         elif option == "-d":
             AIGM_LOG.set_debug_level(int(argument))
         elif option == "-l":
@@ -698,24 +1354,12 @@ def parse_cli(cli_opts_args):
     AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
                   "Manifest file: " + manifest_file)
 
-    ai_criteria_known = {}
-
-    # Obtain all available information about client
-    for key in AI_CRITERIA_SUPPORTED.keys():
-        ai_crit = AI_CRITERIA_SUPPORTED[key][0]()
-        if ai_crit.is_known():
-            ai_criteria_known[key] = ai_crit.get()
-
-    # List all criteria which client can understand and provide
-    AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
-                  "Client can supply following criteria")
-    for key in ai_criteria_known.keys():
+    # if "-l" option was provided, obtain all criteria, list them and exit
+    if list_criteria_only:
         AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
-                      " %s=%s, '%s'", key, ai_criteria_known[key],
-                      AI_CRITERIA_SUPPORTED[key][1])
+                      "Client can supply following criteria")
+        ai_criteria_known = ai_probe_criteria(AI_CRITERIA_SUPPORTED.keys())
 
-    # if "-l" option was provided, list known criteria and exit
-    if list_criteria_only:
         print "Client can supply following criteria"
         print "------------------------------------"
         index = 0
@@ -730,125 +1374,112 @@ def parse_cli(cli_opts_args):
     # Go through the list of services.
     # Contact each of them and try to obtain valid manifest by
     # following handshake using HTTP protocol:
-    # [1] Ask for list of criteria server is interested in
+    # [1] Return all criteria client knows as a list of name,value pairs
+    #     POST "postData=cr_name1=cr_value1;cr_name2=cr_value2&version=1.0"
+    #     <service>/manifest.xml
+    # [2] If service predates that, ask for list of criteria it is
+    #     interested in
     #     GET <service>/manifest. xml
-    # [2] Return criteria as a list of name,value pairs
+    # [3] and return those criteria
     #     POST "postData=cr_name1=cr_value1;cr_name2=cr_value2"
     #     <service>/manifest.xml
-    # [3] If valid manifest is not returned, continue with next
+    # [4] If valid manifest is not returned, continue with next
     #     service
+    # [5] With "-c" option, ask all services at once (see
+    #     ai_race_service_manifests())
     #
 
     AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
                   "Starting to contact AI services provided by %s",
                   service_list)
 
-    ai_manifest_obtained = False
+    ai_services, ret = ai_read_service_list(service_list)
+    if ret != 0:
+        return 2
+
+    #
+    # Manifest of each service is saved to temporary file next to
+    # manifest file as it is downloaded, the one chosen then replaces
+    # manifest file.
+    #
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    manifest_paths = []
+    manifest_files = []
     try:
-        service_list_fh = open(service_list, 'r')
-    except IOError:
+        for ai_service in ai_services:
+            (fd, path) = tempfile.mkstemp(prefix=".manifest",
+                                          dir=manifest_dir)
+            manifest_paths.append(path)
+            manifest_files.append(os.fdopen(fd, 'w'))
+    except (IOError, OSError):
         AIGM_LOG.post(AILog.AI_DBGLVL_ERR,
-                      "Couldn't open %s file", service_list)
+                      "Couldn't create temporary file in %s", manifest_dir)
+        for index in range(len(manifest_paths)):
+            if index < len(manifest_files):
+                manifest_files[index].close()
+            os.unlink(manifest_paths[index])
         return 2
 
-    for ai_service in service_list_fh.readlines():
-        ai_service = ai_service.strip()
-        AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
-                      "AI service: %s", ai_service)
-
-        AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
-                      "Asking for criteria list:")
-        AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
-                      " HTTP GET %s/manifest.xml", ai_service)
-
-        xml_criteria, ret = ai_get_http_file(ai_service,
-                                             "/manifest.xml", "GET")
-
-        if ret != httplib.OK:
-            AIGM_LOG.post(AILog.AI_DBGLVL_ERR,
-                          "Couldn't obtain criteria list from %s, ret=%d",
-                          ai_service, ret)
-            continue
-
-        #
-        # Extract list of required criteria from XML file provided
-        # format of XML file is not validated, information is being
-        # extracted in simple way. This is just interim solution
-        # todo: Switch to DC XML validator - bug 12494
-        #
-        # The format of file for November is following (it might become
-        # more complex and will be docummented in design spec):
-        #
-        # <CriteriaList>
-        #	<Version Number="0.5">
-        # 	<Criteria Name="MEM">
-        #	<Criteria Name="arch">
-        # ...
-        # </CriteriaList>
-        #
-        criteria_required, ret = \
-            ai_get_requested_criteria_list(xml_criteria)
-
-        # Fill in dictionary with criteria name-value pairs
-        AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
-                      "List of criteria to be sent:")
-
-        ai_crit_response = {}
-        for i in range(len(criteria_required)):
-            cr_key = criteria_required[i]
-            if ai_criteria_known.has_key(cr_key) \
-                and ai_criteria_known[cr_key] != None:
-                ai_crit_response[cr_key] = ai_criteria_known[cr_key]
+    chosen = None
+    try:
+        if race_services:
+            chosen, ret = ai_race_service_manifests(ai_services,
+                                                    manifest_files,
+                                                    http_timeout)
+        else:
+            for index in range(len(ai_services)):
                 AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
-                              " %s=%s", cr_key, ai_crit_response[cr_key])
+                              "AI service: %s", ai_services[index])
 
-        # Send back filled in list of criteria to server
-        AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
-                      "Sending list of criteria, asking for manifest:")
-        AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
-                      " HTTP POST %s %s", ai_crit_response, ai_service)
-
-        ai_manifest, ret = ai_get_http_file(ai_service,
-                                            "/manifest.xml", "POST",
-                                            ai_crit_response)
-
-        #
-        # If valid manifest was provided, it is not necessary
-        # to connect next AI service,
-        #
-        if ret == httplib.OK:
+                #
+                # If valid manifest was provided, it is not necessary
+                # to connect next AI service,
+                #
+                ret = ai_save_service_manifest(ai_services[index],
+                                               manifest_files[index],
+                                               http_timeout)
+                if ret == httplib.OK:
+                    chosen = index
+                    break
+
+        if chosen is not None:
             AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
                           "%s AI service provided valid manifest",
-                          ai_service)
-            ai_manifest_obtained = True
-            break
-        else:
-            AIGM_LOG.post(AILog.AI_DBGLVL_WARN,
-                          "%s AI service didn't provide valid manifest, " \
-                          "ret=%d", ai_service, ret)
+                          ai_services[chosen])
 
-    service_list_fh.close()
+            # Save the manifest
+            AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
+                          "Saving manifest to %s", manifest_file)
+
+            os.chmod(manifest_paths[chosen], 0644)
+            os.rename(manifest_paths[chosen], manifest_file)
 
-    if not ai_manifest_obtained:
+    except OSError:
         AIGM_LOG.post(AILog.AI_DBGLVL_ERR,
-                      "None of contacted AI services provided valid manifest")
+                      "Couldn't save obtained manifest to %s",
+                      manifest_file)
+        chosen = None
         return 2
 
-    # Save the manifest
-    AIGM_LOG.post(AILog.AI_DBGLVL_INFO,
-                  "Saving manifest to %s", manifest_file)
+    finally:
+        AI_HTTP_CLIENT.close()
 
-    try:
-        fh_manifest = open(manifest_file, 'w')
-    except IOError:
+        #
+        # Manifests being downloaded from services not chosen are
+        # discarded. Services still being raced close their files
+        # themselves.
+        #
+        for index in range(len(manifest_paths)):
+            if not race_services:
+                manifest_files[index].close()
+            if index != chosen:
+                os.unlink(manifest_paths[index])
+
+    if chosen is None:
         AIGM_LOG.post(AILog.AI_DBGLVL_ERR,
-                      "Couldn't open %s for saving obtained manifest",
-                      manifest_file)
+                      "None of contacted AI services provided valid manifest")
         return 2
 
-    fh_manifest.write(ai_manifest)
-    fh_manifest.close()
-
     return 0
 
 
@@ -29,11 +29,14 @@
 
 import sys
 
+import errno
 import getopt
 import os
 import re
+import select
 import signal
 from subprocess import Popen, PIPE
+import time
 import traceback
 from osol_install.auto_install.ai_get_manifest import AILog
 
@@ -71,38 +74,21 @@ class AIService:
         self.svc_info = self.svc_txt_rec = None
 
         #
-        # ID of process running dns-sd(1M) command. It will be used by
-        # os.kill() to terminate the process.
+        # dns-sd(1M) process looking up the service, output read from
+        # it so far which doesn't make up a whole line yet and time
+        # the look up was started at
         #
+        self.popen = None
+        self.partial_line = ""
+        self.start_time = None
 
-        self.pid = -1
+        # seconds it took the service to respond, once found
+        self.response_time = None
 
-        #
-        # Flag which indicates that timer expired for running dns-sd(1M)
-        #
-
-        self.timeout_expired = False
+        # state of parsing output of dns-sd(1M)
+        self.svc_info_found = self.svc_txt_rec_found = False
 
         return
-	
-    def _svc_lookup_timeout_handler(self, signum, frame):
-        """     Description:
-		    Handles raising of SIGALRM signal - kill the process
-		    with ID saved in SD_PID by sending SIGTERM signal
-
-		    Parameters:
-		        signum - number of signal
-			frame - current stack frame
-
-		    Returns:
-        """
-
-        if self.pid >= 0:
-            os.kill(self.pid, signal.SIGTERM)
-
-        # set the flag and disable the alarm
-        self.timeout_expired = True
-        signal.alarm(0)
 
     def get_found(self):
         """    Returns:
@@ -120,14 +106,31 @@ class AIService:
 		"""
         return self.svc_txt_rec
 
-    def lookup(self):
-        """ Metod:    lookup
+    def get_address(self):
+        """ Metod:    get_address
 
 		    Description:
-		        Tries to look up service instance
+		        Extracts location of the service from value of
+		        'aiwebserver' name-value pair of its TXT record
 
 		    Returns:
-		        0..service found, -1..service not found
+		        (address, port) tuple
+
+		"""
+        svc_address = self.svc_txt_rec.strip().split('aiwebserver=', 1)[1]
+        svc_address = svc_address.split(',')[0]
+        return tuple(svc_address.split(':'))
+
+    def start(self):
+        """ Metod:    start
+
+		    Description:
+		        Spawns dns-sd(1M) process looking up the service
+		        instance. Its output is to be handed to feed()
+		        and the process terminated by stop().
+
+		    Returns:
+		        0..process started, -1..process couldn't be started
 
 	"""
 
@@ -137,6 +140,9 @@ class AIService:
         #
         self.svc_info = self.svc_txt_rec = None
         self.found = False
+        self.response_time = None
+        self.partial_line = ""
+        self.svc_info_found = self.svc_txt_rec_found = False
 
         # dns-sd(1M) is used for look up the service
         cmd = "/usr/bin/dns-sd -L %s %s %s" % (self.name,
@@ -147,13 +153,8 @@ class AIService:
 
         cmd_args = cmd.split()
 
-        #
-        # spawn new process which will take care of looking up
-        # the service. If the service is not found within specified
-        # time, raise the SIGALRM signal and kill the process
-        #
         try:
-            cmd_popen = Popen(cmd_args, stdout=PIPE, stderr=PIPE)
+            self.popen = Popen(cmd_args, stdout=PIPE, stderr=PIPE)
 
         except OSError:
             AISD_LOG.post(AILog.AI_DBGLVL_ERR,
@@ -167,133 +168,213 @@ class AIService:
 
             return -1
 
-        #
-        # save ID of new process - os.kill() will use it later
-        # to terminate the process
-        #
-        self.pid = cmd_popen.pid
+        self.start_time = time.time()
         AISD_LOG.post(AILog.AI_DBGLVL_INFO,
-                      "dns-sd pid: %d", self.pid)
-	
-        signal.signal(signal.SIGALRM, self._svc_lookup_timeout_handler)
+                      "dns-sd pid: %d", self.popen.pid)
 
-        # activate timeout
-        self.timeout_expired = False
-        signal.alarm(self.timeout)
+        return 0
 
-        #
-        # Save file descriptors for stdout, stderr
-        # from dns-sd for later purposes
-        #
-        cmd_stdout_fd = cmd_popen.stdout
-        cmd_stderr = None
+    def feed(self, data):
+        """ Metod:    feed
+
+		    Description:
+		        Processes output read from dns-sd(1M) until
+		        the service is found
 
-        svc_info = svc_txt_rec = None
-        svc_info_found = svc_txt_rec_found = False
+		    Parameters:
+		        data - output read from dns-sd(1M)
 
-        #
-        # process output from dns-sd(1M) until either service
-        # is found or timeout expires
-        #
-        while cmd_popen.poll() is None and not self.timeout_expired:
-            try:
-                # read main service info - wait for the line
-                # containing service name
-                line = cmd_stdout_fd.readline().strip()
+		    Returns:
+		        True..service found, False..service not found yet
 
-                # search for exact match of given service name
-                svc = line.split()
-                if len(svc) > 1 and re.search("^%s." % self.name,
-                                              svc[1].strip()):
+	"""
+        if self.found:
+            return True
 
-                    AISD_LOG.post(AILog.AI_DBGLVL_INFO,
-                                  " Svc: %s", line)
+        lines = (self.partial_line + data).split("\n")
+        self.partial_line = lines.pop()
 
-                    svc_info_found = True
-                    svc_info = line
-                    svc_txt_rec_found = False
-                    continue
+        for line in lines:
+            line = line.strip()
 
-                #
-                # read and verify TXT records -
-                # following format is expected:
-                #
-                # aiwebserver=<address>:<port>
-                #
-                if re.search(r"^aiwebserver=", line):
-                    AISD_LOG.post(AILog.AI_DBGLVL_INFO,
-                                  " TXT: %s", line)
-                    svc_txt_rec = line
-                    svc_txt_rec_found = True
-                else:
-                    svc_info_found = \
-                        svc_txt_rec_found = False
-
-                #
-                # Abort look up process, if service was found
-                #
-
-                if svc_info_found and svc_txt_rec_found:
-                    AISD_LOG.post(AILog.AI_DBGLVL_INFO,
-                                  " %s service found", self.name)
-                    break
+            # search for exact match of given service name
+            svc = line.split()
+            if len(svc) > 1 and re.search("^%s." % self.name,
+                                          svc[1].strip()):
 
+                AISD_LOG.post(AILog.AI_DBGLVL_INFO,
+                              " Svc: %s", line)
+
+                self.svc_info_found = True
+                self.svc_info = line
+                self.svc_txt_rec_found = False
+                continue
+
+            #
+            # read and verify TXT records -
+            # following format is expected:
             #
-            # IOError exception is raised when the process
-            # is terminated during I/O operation. This will
-            # happen if service can't be found, since in this case
-            # we would be waiting in cmd_stdout_fd.readline()
+            # aiwebserver=<address>:<port>
             #
-            except IOError:
-                # wait for process to finish
-                cmd_stderr = cmd_popen.communicate()[1]
+            if re.search(r"^aiwebserver=", line):
+                AISD_LOG.post(AILog.AI_DBGLVL_INFO,
+                              " TXT: %s", line)
+                self.svc_txt_rec = line
+                self.svc_txt_rec_found = True
+            else:
+                self.svc_info_found = \
+                    self.svc_txt_rec_found = False
 
-                if self.timeout_expired:
-                    AISD_LOG.post(AILog.AI_DBGLVL_INFO,
-                                  "Timeout expired, dns-sd (pid=%d)" \
-                                  " terminated", self.pid)
+            #
+            # Stop processing the output, if service was found
+            #
+
+            if self.svc_info_found and self.svc_txt_rec_found:
+                self.found = True
+                self.response_time = time.time() - self.start_time
+
+                AISD_LOG.post(AILog.AI_DBGLVL_INFO,
+                              "Valid service found in %.3f s:\n svc: %s\n"
+                              " TXT: %s", self.response_time,
+                              self.svc_info, self.svc_txt_rec)
+                return True
 
-                else:
-                    AISD_LOG.post(AILog.AI_DBGLVL_WARN,
-                                  "IOError raised for unknown reason")
+        return False
 
-        # disable alarm
-        signal.alarm(0)
+    def stop(self):
+        """ Metod:    stop
+
+		    Description:
+		        Terminates dns-sd(1M) process looking up
+		        the service, if it is still running
+
+		"""
+        if self.popen is None:
+            return
 
         #
         # if the process didn't finish yet, it is either
         # still running or in the phase of finishing its job.
+        # If process is running, terminate it
         #
-        if cmd_popen.poll() is None:
-            # If process is running, terminate it
-            if not self.timeout_expired:
-                AISD_LOG.post(AILog.AI_DBGLVL_INFO,
-                              "dns-sd (pid=%d) is running, will be " \
-                              "terminated", self.pid)
+        if self.popen.poll() is None:
+            AISD_LOG.post(AILog.AI_DBGLVL_INFO,
+                          "dns-sd (pid=%d) is running, will be " \
+                          "terminated", self.popen.pid)
+            try:
+                os.kill(self.popen.pid, signal.SIGTERM)
+            except OSError:
+                pass
 
-                os.kill(self.pid, signal.SIGTERM)
+        # wait for process to finish
+        cmd_stderr = self.popen.communicate()[1]
 
-        if cmd_popen.poll() is not None:
-            AISD_LOG.post(AILog.AI_DBGLVL_INFO,
-                          "dns-sd return code: %d", cmd_popen.returncode)
+        AISD_LOG.post(AILog.AI_DBGLVL_INFO,
+                      "dns-sd return code: %d", self.popen.returncode)
 
         # capture output of stderr for debugging purposes
         if cmd_stderr:
             AISD_LOG.post(AILog.AI_DBGLVL_WARN,
                           " stderr: %s", cmd_stderr)
 
-        if svc_info_found and svc_txt_rec_found:
-            AISD_LOG.post(AILog.AI_DBGLVL_INFO,
-                          "Valid service found:\n svc: %s\n TXT: %s",
-                          svc_info, svc_txt_rec)
+        self.popen = None
+
+    def lookup(self):
+        """ Metod:    lookup
 
-            self.found = True
-            self.svc_info = svc_info
-            self.svc_txt_rec = svc_txt_rec
+		    Description:
+		        Tries to look up service instance
+
+		    Returns:
+		        0..service found, -1..service not found
+
+	"""
+        if lookup_services([self], self.timeout):
             return 0
 
         return -1
 
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+def lookup_services(service_list, timeout):
+    """ Description:
+		    Looks up all given service instances concurrently,
+		    giving up on those not found when timeout expires.
+		    Services are given in order of preference: returns
+		    as soon as a service is found and no service preferred
+		    to it is still being looked up, so a less preferred
+		    service answering first is only used if the preferred
+		    ones are not found before timeout expires.
+
+		    Parameters:
+		        service_list - list of AIService instances, most
+		                       preferred first
+		        timeout - max time to look up the services
+
+		    Returns:
+		        list of services found, in order of preference
+    """
+    deadline = time.time() + timeout
+
+    # services being looked up, by file descriptor of dns-sd(1M) output
+    lookups = {}
+
+    try:
+        for service in service_list:
+            AISD_LOG.post(AILog.AI_DBGLVL_INFO,
+                          "Service to look up: %s.%s.%s", service.name,
+                          AIService.type, service.domain)
+
+            if service.start() == 0:
+                lookups[service.popen.stdout.fileno()] = service
+
+        #
+        # process output from dns-sd(1M) processes until the most
+        # preferred service still to be waited for is found or
+        # timeout expires
+        #
+        while lookups:
+            # most preferred service not given up on yet
+            preferred = [service for service in service_list
+                         if service.get_found() or
+                         service in lookups.values()][0]
+            if preferred.get_found():
+                break
+
+            wait = deadline - time.time()
+            if wait <= 0:
+                AISD_LOG.post(AILog.AI_DBGLVL_INFO,
+                              "Timeout expired, dns-sd processes "
+                              "will be terminated")
+                break
+
+            try:
+                readable = select.select(lookups.keys(), [], [], wait)[0]
+            except select.error, err:
+                if err[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd in readable:
+                service = lookups[fd]
+                data = os.read(fd, 4096)
+
+                # dns-sd(1M) finished without finding the service
+                if not data:
+                    del lookups[fd]
+                    continue
+
+                if service.feed(data):
+                    AISD_LOG.post(AILog.AI_DBGLVL_INFO,
+                                  " %s service found", service.name)
+                    del lookups[fd]
+
+    finally:
+        for service in service_list:
+            service.stop()
+
+    return [service for service in service_list if service.get_found()]
+
 	
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 def usage():
@@ -357,7 +438,7 @@ def parse_cli(cli_opts_args):
 
     #
     # if service name was specified, add it to the list
-    # of services to be looked up
+    # of services to be looked up, ahead of the default service
     #
     if service_name:
         service_list.append(AIService(service_name,
@@ -366,39 +447,17 @@ def parse_cli(cli_opts_args):
     # add default service
     service_list.append(AIService('_default', service_lookup_timeout))
 
-    # Go through the list of services and try to look up them
-    for i in range(len(service_list)):
-        svc_instance = "%s.%s.%s" % (service_list[i].name,
-                                     AIService.type, service_list[i].domain)
-
-        AISD_LOG.post(AILog.AI_DBGLVL_INFO,
-                      "Service to look up: %s", svc_instance)
-
-        # look up the service
-        ret = service_list[i].lookup()
-        if ret == 0:
-            svc_found_index = i
-            break
+    #
+    # Look up all the services at once; the default service is
+    # only waited for if the named one isn't found
+    #
+    services_found = lookup_services(service_list, service_lookup_timeout)
 
-    if ret == -1:
+    if not services_found:
         AISD_LOG.post(AILog.AI_DBGLVL_ERR,
                       "No valid AI service found")
         return 2
 
-    #
-    # parse information captured from dns-sd in order
-    # to obtain source of service (address and port)
-    # extract value from 'aiwebserver' name-value pair
-    #
-    svc_address = service_list[svc_found_index].get_txt_rec()
-    svc_address = svc_address.strip().split('aiwebserver=', 1)[1]
-    svc_address = svc_address.split(',')[0]
-    (svc_address, svc_port) = svc_address.split(':')
-
-    AISD_LOG.post(AILog.AI_DBGLVL_INFO,
-                  "%s can be reached at: %s:%s", svc_instance,
-                  svc_address, svc_port)
-
     # write the information to the given location
     AISD_LOG.post(AILog.AI_DBGLVL_INFO,
                   "Storing service list into %s", service_file)
@@ -410,7 +469,22 @@ def parse_cli(cli_opts_args):
                       "Couldn't open %s for saving service list", service_file)
         return 2
 
-    fh_svc_list.write("%s:%s\n" % (svc_address, svc_port))
+    #
+    # parse information captured from dns-sd in order
+    # to obtain source of service (address and port),
+    # listing the named service first
+    #
+    for service in services_found:
+        (svc_address, svc_port) = service.get_address()
+
+        AISD_LOG.post(AILog.AI_DBGLVL_INFO,
+                      "%s.%s.%s can be reached at: %s:%s (responded in "
+                      "%.3f s)", service.name, AIService.type,
+                      service.domain, svc_address, svc_port,
+                      service.response_time)
+
+        fh_svc_list.write("%s:%s\n" % (svc_address, svc_port))
+
     fh_svc_list.close()
 
     return 0
@@ -393,19 +393,18 @@ def remove_files(service, removeImageBool):
             sys.stderr.write(str(e) + "\n")
             return
         # look for filesystem in /etc/vfstab
-        try:
-            # calculate index for mount point
-            idx = vfstabObj.fields.MOUNT_POINT.index(boot_archive)
-            try:
-                # remove line containing boot archive (updates /etc/vfstab)
-                del(vfstabObj.fields.MOUNT_POINT[idx])
-            except IOError, e:
-                sys.stderr.write(str(e) + "\n")
+        rows = vfstabObj.find(MOUNT_POINT=boot_archive)
         # boot archive was not found in /etc/vfstab
-        except (ValueError, IndexError):
+        if not rows:
             sys.stderr.write (_("Boot archive (%s) for service %s " +
                               "not in vfstab.\n") %
                               (boot_archive, service.serviceName))
+            return
+        try:
+            # remove lines containing boot archive (updates /etc/vfstab)
+            vfstabObj.delete(*rows)
+        except (IOError, ValueError), e:
+            sys.stderr.write(str(e) + "\n")
         return
 
     def removeTFTPBootFiles(service):
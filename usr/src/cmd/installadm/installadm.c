@@ -49,7 +49,7 @@ static cmdfunc_t do_create_service, do_delete_service;
 static cmdfunc_t do_list, do_enable, do_disable;
 static cmdfunc_t do_create_client, do_delete_client;
 static cmdfunc_t do_add_manifest, do_delete_manifest;
-static cmdfunc_t do_set_criteria, do_help;
+static cmdfunc_t do_set_criteria, do_upgrade_db, do_help;
 static void do_opterr(int, int, const char *);
 static char *progname;
 static void smf_service_enable_attempt(char *);
@@ -81,7 +81,7 @@ static cmd_t	cmds[] = {
 	    PRIV_REQD							},
 
 	{ "list",	do_list,
-	    "\tlist\t[-n <svcname>] [-c] [-m]",
+	    "\tlist\t[-n <svcname>] [-c] [-m [-p]]",
 	    "list",
 	    PRIV_NOT_REQD						},
 
@@ -108,7 +108,8 @@ static cmd_t	cmds[] = {
 
 	{ "add-manifest",	do_add_manifest,
 	    "\tadd-manifest\t-m <manifest> -n <svcname>\n"
-	    "\t\t\t[-c <criteria=value|range> ... | -C <criteria.xml>]",
+	    "\t\t\t[-c <criteria=value|range> ... | -C <criteria.xml>]\n"
+	    "\tadd-manifest\t-b <directory|listfile> -n <svcname>",
 	    "add",
 	    PRIV_REQD							},
 
@@ -123,6 +124,11 @@ static cmd_t	cmds[] = {
 	    "set-criteria",
 	    PRIV_REQD							},
 
+	{ "upgrade-db",	do_upgrade_db,
+	    "\tupgrade-db\t-n <svcname>",
+	    "upgrade-db",
+	    PRIV_REQD							},
+
 	{ "help",	do_help,
 	    "\thelp\t[<subcommand>]",
 	    "help",
@@ -1346,6 +1352,34 @@ do_set_criteria(int argc, char *argv[], scfutilhandle_t *handle,
 	return (INSTALLADM_SUCCESS);
 }
 
+/*
+ * do_upgrade_db:
+ * Upgrade the database of an A/I service to the current schema version.
+ * Pass all command line options to upgrade_db
+ */
+static int
+do_upgrade_db(int argc, char *argv[], scfutilhandle_t *handle,
+		const char *use)
+{
+	int		ret;
+
+	ret = call_script(UPGRADE_DB_SCRIPT, argc-1, &argv[1]);
+
+	/*
+	 * Ensure we return an error if ret != 0.
+	 * If WEXITSTATUS(ret) == 1 then Python handled the error,
+	 * do not print a new error.
+	 */
+	if (ret != 0) {
+		if (WEXITSTATUS(ret) == 1) {
+			return (INSTALLADM_FAILURE);
+		}
+		(void) fprintf(stderr, MSG_SUBCOMMAND_FAILED, argv[0]);
+		return (INSTALLADM_FAILURE);
+	}
+	return (INSTALLADM_SUCCESS);
+}
+
 static int
 do_help(int argc, char *argv[], scfutilhandle_t *handle, const char *use)
 {
@@ -36,6 +36,8 @@ import gettext
 import time
 import StringIO
 import copy
+import contextlib
+import tempfile
 
 #
 # General classes below
@@ -360,11 +362,24 @@ class DBBase(dict):
     (i.e. 'device', 'fsckDev', etc.) but object.fields.FIELD2,
     object.fields.FIELD1, etc. A list of fields is available through
     object.fields(). This allows the implementation to evolve, if necessary.
+
+    Each field is indexed by value, so testing for a value
+    ("/dev/dsk/c0t0d0s0" in dbbase_obj['DEVICE']) or finding the records
+    holding it (dbbase_obj.find(DEVICE="/dev/dsk/c0t0d0s0")) does not scan
+    the field. Records are returned as row objects (see _Row) which can be
+    removed with dbbase_obj.delete(row, ...) and new records added with
+    dbbase_obj.append(record, ...); the edits made within a
+    "with dbbase_obj.batch():" block are written back in one atomic rewrite
+    of the file when the block ends.
     """
 
     # field variables (modify this in child classes)
     #_FIELD = "field"
 
+    # seconds for which the data loaded is used without checking the file's
+    # mtime again (the mtime is only kept to the second anyway)
+    _STAT_INTERVAL = 1
+
     # the attribute accessor names (all capital variables of the class with
     # their leading underscore stripped) should be stored for building a list
     # of field names
@@ -377,10 +392,10 @@ class DBBase(dict):
     def __init__(self, **kwargs):
         """
         Open file and read it in. Will throw exceptions when errors are
-        encountered. Expected arguments of a string for a StringIO backed store
-        or file_name and mode for a file backed store; e.g.:
+        encountered. Expected arguments of data (a string) for a StringIO
+        backed store or file_name and mode for a file backed store; e.g.:
         file_foo = DBBase(file_name="/etc/vfstab", mode="w")
-        string_foo = DBBase(big_string_of_databasy-ness)
+        string_foo = DBBase(data=big_string_of_databasy-ness)
         """
         # run the generic dict() init first
         super(DBBase, self).__init__()
@@ -392,9 +407,21 @@ class DBBase(dict):
                                   kwargs.setdefault('mode', 'r'))
         # if not, this must be a string for StringIO
         else:
-            self.file_obj = StringIO_(kwargs)
+            self.file_obj = StringIO_(kwargs.get('data', ''))
         # mtime holds the file_obj's last read mtime
         self.mtime = None
+        # time at which the file_obj's mtime was last checked
+        self._checked = None
+        # edits made within a batch() yet to be written back (None when not
+        # in a batch)
+        self._batch = None
+        # the lines of the file last read, its records (a _Row per record),
+        # per field indexes of value to record numbers and the _Results
+        # handed out for the data
+        self._lines = []
+        self._rows = []
+        self._index = {}
+        self._results = {}
 
         # build a dictionary for the full text headers and the objects
         # representing them (e.g. headers = \
@@ -410,44 +437,108 @@ class DBBase(dict):
 
     def _load_data(self):
         """
-        Read file from beginning and load data into fields, one record per row
+        Ensure the data loaded is up to date with the file. Within a batch of
+        edits, or within _STAT_INTERVAL seconds of the file's mtime last
+        being checked, the data already loaded is used as is.
         """
-        # see if the file has updated since last read (attempt at caching)
-        if self.mtime == self.file_obj.last_update:
+        if self.mtime is not None and (self._batch is not None or
+            time.time() - self._checked < self._STAT_INTERVAL):
             return
+        self._reload()
 
-        # clear all keys as we'll be repopulating (if we have populated before)
-        super(DBBase, self).clear()
+    def _reload(self, force=False):
+        """
+        Read file from beginning and load data into fields, one record per
+        row, if the file has updated since last read (or always if force is
+        set, as the mtime is only kept to the second and so can miss an
+        update made within the same second as the last read)
+        """
+        # see if the file has updated since last read (attempt at caching);
+        # a file replaced by another instance's rewrite has always updated
+        self._checked = time.time()
+        if self._reopen():
+            force = True
+        if not force and self.mtime == self.file_obj.last_update:
+            return
 
         # update the file mtime to keep track (NOTE: there is a potential change
-        # between when we store this mtime and do the readline_all() below)
+        # between when we store this mtime and do the read_all() below)
         self.mtime = self.file_obj.last_update
 
-        # store the intermediate split fields
-        fields = []
+        # keep every line (comments included) so the file can be rewritten
+        lines = self.file_obj.read_all().split("\n")
+        # drop the empty "line" after the file's last newline
+        if lines and not lines[-1]:
+            lines.pop()
+        self._parse(lines)
+
+    def _reopen(self):
+        """
+        Reopen the file if it has been replaced since it was opened (as
+        _rewrite() does in another instance or process), since the file
+        object still reads the replaced file.
+        Returns: True if the file was reopened
+        """
+        if not isinstance(self.file_obj, File_):
+            return False
+        file_name = self.file_obj.file_name
+        try:
+            file_stat = os.stat(file_name)
+        except OSError:
+            # leave errors to be raised reading the file
+            return False
+        open_stat = os.fstat(self.file_obj.fileno())
+        if (file_stat.st_dev, file_stat.st_ino) == \
+            (open_stat.st_dev, open_stat.st_ino):
+            return False
+        # keep the access the file was opened with (a file opened for
+        # writing is reopened read/write as _rewrite() does, so that it is
+        # not truncated)
+        if "r" in self.file_obj.mode and "+" not in self.file_obj.mode:
+            mode = "r"
+        else:
+            mode = "r+"
+        self.file_obj.close()
+        self.file_obj = File_(file_name, mode)
+        return True
+
+    def _parse(self, lines):
+        """
+        Load the records of lines into fields, one record per row, and index
+        each field by value
+        """
+        # clear all keys as we'll be repopulating (if we have populated before)
+        super(DBBase, self).clear()
 
-        # now produce a list of lists for each field:
-        # [[field1] [field2] [field3]]
+        self._lines = lines
+        self._rows = []
+        self._index = dict([(header, {}) for header in self._headers])
+        self._results = {}
 
-        # split the file into a list of lists of fields
-        # (ensure we don't split on white space on trailing field so limit the
-        # number of splits to the number of headers (well, headers minus one,
-        # since 2 fields eq. 1 split))
-        fields = [line.split(None, len(self.headers)-1) for line in
-            self.file_obj.readlines_all(  skip_comments=True,
-                                        remove_newlines=True,
-                                        skip_blanklines=True)
-            if len(line.split(None, len(self.headers)-1)) == len(self.headers)]
+        # now produce a list for each field: [[field1] [field2] [field3]]
+        columns = [[] for header in self._headers]
+        for (line_number, line) in enumerate(lines):
+            # skip comments and blank lines
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            # split the line into its fields (ensure we don't split on white
+            # space on trailing field so limit the number of splits to the
+            # number of headers (well, headers minus one, since 2 fields eq. 1
+            # split))
+            values = line.split(None, len(self._headers) - 1)
+            if len(values) != len(self._headers):
+                continue
+            row = self._Row(self, len(self._rows), line_number, values)
+            for (header, value, column) in \
+                zip(self._headers, values, columns):
+                column.append(value)
+                self._index[header].setdefault(value, []).append(row.number)
+            self._rows.append(row)
 
         # build a dict with each header a key to a list
         # built of each row from the file
-        super(DBBase, self).update(
-            dict(
-            # use _headers which is a list with the correct order
-                zip(self._headers, [[row[i] for row in fields] for i in
-                                     range(0, len(self._headers))])
-            )
-        )
+        # (use _headers which is a list with the correct order)
+        super(DBBase, self).update(zip(self._headers, columns))
 
     def _attrproperty(wrapped_function):
         """
@@ -514,7 +605,7 @@ class DBBase(dict):
         if not self.has_key(key):
             raise KeyError(key)
         # return a field object, populated from the dictionary
-        return self._Result(self, key)
+        return self._result(key)
 
     def get(self, key, default=None):
         """
@@ -527,10 +618,19 @@ class DBBase(dict):
         # ensure key is valid
         if self.has_key(key):
             # return a field object, populated from the dictionary
-            return self._Result(self, key)
+            return self._result(key)
         # else return default
         return default
 
+    def _result(self, key):
+        """
+        Return the field object for key, built once per load of the data
+        (so it is shared by all look-ups until the data is reloaded)
+        """
+        if key not in self._results:
+            self._results[key] = self._Result(self, key)
+        return self._results[key]
+
     def keys(self):
         """
         Provide all field titles stored as dictionary keys
@@ -538,13 +638,219 @@ class DBBase(dict):
         self._load_data()
         return super(DBBase, self).keys()
 
+    def rows(self):
+        """
+        Return a list of the records of the file, a _Row per record
+        """
+        self._load_data()
+        return list(self._rows)
+
+    def find(self, **fields):
+        """
+        Return a list of the records (_Rows) holding all of the field values
+        given by attribute name, e.g. vfstab_obj.find(MOUNT_POINT="/mnt"),
+        in file order. Raises: KeyError for an unknown field
+        """
+        self._load_data()
+        numbers = None
+        for (attr, value) in fields.iteritems():
+            found = set(self._index[self.headers[attr]].get(value, ()))
+            if numbers is None:
+                numbers = found
+            else:
+                numbers &= found
+        return [self._rows[number] for number in sorted(numbers or ())]
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Context manager collecting the edits (delete() and append()) made
+        within it to write them back in one rewrite of the file when it
+        exits; the edits are dropped if it exits on an exception. The data is
+        not reloaded within a batch. Batches do not nest (an inner batch
+        joins the outer one).
+        """
+        if self._batch is not None:
+            yield
+            return
+        self._batch = []
+        try:
+            yield
+            edits = self._batch
+        finally:
+            self._batch = None
+        if edits:
+            self._commit(edits)
+
+    def delete(self, *rows):
+        """
+        Remove the records rows (_Rows as returned by rows() or find()) from
+        the file; the file is rewritten at once, or when the enclosing batch
+        ends. Raises: ValueError if a record is no longer in the file,
+        AssertionError if the file is not writable and IOError if writing
+        the file fails
+        """
+        self._edit([("delete", row) for row in rows])
+
+    def append(self, *records):
+        """
+        Add records (each a list of the field values in file order, or a
+        _Row) to the end of the file; the file is rewritten at once, or when
+        the enclosing batch ends. Raises: ValueError if a record does not
+        have a value for each field, AssertionError if the file is not
+        writable and IOError if writing the file fails
+        """
+        edits = []
+        for record in records:
+            if isinstance(record, dict):
+                record = [record[header] for header in self._headers]
+            if len(record) != len(self._headers):
+                raise ValueError("record %s does not have %d fields" %
+                                 (record, len(self._headers)))
+            edits.append(("append", "\t".join(record)))
+        self._edit(edits)
+
+    def _edit(self, edits):
+        """
+        Queue edits to the enclosing batch, or commit them if not in a batch
+        """
+        if self._batch is not None:
+            self._batch.extend(edits)
+        else:
+            self._commit(edits)
+
+    def _commit(self, edits):
+        """
+        Apply edits (a list of ("delete", _Row) and ("append", line) tuples)
+        to the file's lines and write the file back once
+        """
+        # edit what is in the file now (always re-reading it, so edits made
+        # by another process within the mtime's second are not lost)
+        self._reload(force=True)
+        dropped = set()
+        appended = []
+        for (action, arg) in edits:
+            if action == "delete":
+                dropped.add(self._locate(arg, dropped).line)
+            else:
+                appended.append(arg)
+        lines = [line for (line_number, line) in enumerate(self._lines) if
+                 line_number not in dropped] + appended
+        self._rewrite(lines)
+        # no need to read back what was just written
+        self._parse(lines)
+        self.mtime = self.file_obj.last_update
+        self._checked = time.time()
+
+    def _locate(self, row, dropped):
+        """
+        Return the current _Row for row (which may be from an earlier load of
+        the data) skipping records on the lines in dropped.
+        Raises: ValueError if the record is not in the file
+        """
+        if row.number < len(self._rows) and self._rows[row.number] == row \
+            and self._rows[row.number].line not in dropped:
+            return self._rows[row.number]
+        # look the record up by its first field
+        for number in self._index[self._headers[0]].get(
+            row[self._headers[0]], ()):
+            if self._rows[number] == row and \
+                self._rows[number].line not in dropped:
+                return self._rows[number]
+        raise ValueError("record %s not in %s" %
+                         ("\t".join([row[header] for header in
+                                     self._headers]),
+                          self.file_obj.file_name))
+
+    def _rewrite(self, lines):
+        """
+        Replace the contents of the file with lines. A file is written to a
+        temporary file beside it which is then renamed over it (keeping the
+        file's permissions and ownership), so readers see either the old or
+        the new file; the file is reopened read/write afterward.
+        Raises: AssertionError if the file is not writable and IOError if
+        writing the file fails
+        """
+        data = "".join([line + "\n" for line in lines])
+
+        # data not backed by a file can simply be replaced (StringIO_ does
+        # not allow writes)
+        if not isinstance(self.file_obj, File_):
+            self.file_obj = StringIO_(data)
+            return
+
+        file_name = self.file_obj.file_name
+        if not self.file_obj.is_writeable:
+            raise AssertionError("Unable to write whole file %s.\n" %
+                                 file_name)
+        (fd, tmp_name) = tempfile.mkstemp(dir=os.path.dirname(file_name),
+            prefix="." + os.path.basename(file_name) + ".")
+        try:
+            try:
+                tmp_file = os.fdopen(fd, "w")
+            except OSError:
+                os.close(fd)
+                raise
+            try:
+                tmp_file.write(data)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+                file_stat = os.fstat(self.file_obj.fileno())
+                os.fchmod(tmp_file.fileno(),
+                          stat.S_IMODE(file_stat.st_mode))
+                tmp_stat = os.fstat(tmp_file.fileno())
+                if (tmp_stat.st_uid, tmp_stat.st_gid) != \
+                    (file_stat.st_uid, file_stat.st_gid):
+                    os.fchown(tmp_file.fileno(), file_stat.st_uid,
+                              file_stat.st_gid)
+            finally:
+                tmp_file.close()
+            os.rename(tmp_name, file_name)
+        except (IOError, OSError), msg:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+            raise IOError("Unable to write to file %s: %s\n" %
+                          (file_name, msg))
+
+        self.file_obj.close()
+        self.file_obj = File_(file_name, "r+")
+
     # we do not want to deal with rewriting by key
     __setitem__ = None
 
+    class _Row(dict):
+        """
+        Class to represent a record of the file as produced by _load_data: a
+        dictionary of field header to value, which also provides attribute
+        access to the fields (i.e. row.MOUNT_POINT). The record's position is
+        kept in number (its index in the field lists) and line (its line
+        number in the file).
+        """
+        def __init__(self, parent, number, line, values):
+            super(DBBase._Row, self).__init__(zip(parent._headers, values))
+            self.headers = parent.headers
+            self.number = number
+            self.line = line
+
+        def __getattr__(self, attr):
+            """
+            Provide an interface so one can run: row.ATTRIBUTE
+            """
+            try:
+                return self[self.__dict__["headers"][attr]]
+            except KeyError:
+                raise AttributeError(attr)
+
+        # a record is changed by deleting and appending it
+        __setitem__ = None
+
     class _Result(list):
         """
         Class to represent field data as produced by _load_data used for
-        updating and removing entries in the backing file
+        updating and removing entries in the backing file. Membership tests,
+        index() and count() use the parent's index of the field.
         """
         def __init__(self, parent, key):
             # store what we are representing
@@ -553,37 +859,37 @@ class DBBase(dict):
             self.field = key
             # store the parent object
             self.parent = parent
+            # store the records and index of the field this was built from
+            self.rows = parent._rows
+            self._index = parent._index[key]
 
-        def __delitem__(self, index):
+        def __contains__(self, value):
+            return value in self._index
+
+        def index(self, value, *args):
             """
-            Remove an item(s) from the result list and remove its backing store
-            record(s) for the particular item, returning the number of
-            deletions made -- if one record is repeated.
-            This is done constructing a regular expression to match the record
-            by matching each field which should be removed separated by white
-            space for this record.
+            Return the index of the first record with value for this field
+            Raises: ValueError if no record has the value
             """
-            # iterate over every field in the parent for this index building up
-            # a list of field entries for this record
-            regex = [re.escape(self.parent[field][index]) for field in
-                # need the ordered list of headers which is private at this
-                # time and a list stored in _headers
-                self.parent._headers]
-
-            # now separate each field entry with a key for whitespace
-            regex = r"\s".join(regex)
-
-            # end the reg ex. looking for a newline or the end of file (and
-            # grabbing any spacing between
-            # store what we end with for the ending match so we can put it back
-            regex = regex + r"(?P<end>\s|$)"
-
-            # start the reg ex. looking for the beginning of file or a newline
-            regex = r"(?:^|\n)" + regex
+            if args:
+                return super(DBBase._Result, self).index(value, *args)
+            try:
+                return self._index[value][0]
+            except KeyError:
+                raise ValueError("%s is not in list" % repr(value))
+
+        def count(self, value):
+            """
+            Return the number of records with value for this field
+            """
+            return len(self._index.get(value, ()))
 
-            # now match, replace the ending match and write the output
-            self.parent.file_obj.raw = re.sub(regex, "\g<end>",
-                                              self.parent.file_obj.raw)
+        def __delitem__(self, index):
+            """
+            Remove the record at index from the backing store (see
+            DBBase.delete())
+            """
+            self.parent.delete(self.rows[index])
 
         # we do not want to deal with rewriting by key
         __setitem__ = None
@@ -633,6 +939,8 @@ class MNTTab(DBBase):
 
     One can remove a record in the file by running:
     del(mnttab_obj.fields.FIELD[idx])
+    or remove the records holding a value with:
+    mnttab_obj.delete(*mnttab_obj.find(FIELD=value))
     """
 
     # field variables
@@ -670,6 +978,8 @@ class VFSTab(DBBase):
 
     One can remove a record in the file by ruining:
     del(vfstab_obj.fields.FIELD[idx])
+    or remove the records holding a value with:
+    vfstab_obj.delete(*vfstab_obj.find(FIELD=value))
     """
     # field variables
     _DEVICE = "device to mount"
@@ -815,6 +1125,7 @@ class GrubMenu(DBBase):
 
         # need to clear current entries
         super(DBBase, self).clear()
+        self._results = {}
 
         # the menu begins with general commands. The keyword "title" must
         # begin boot entries and they are either terminated by other title
@@ -970,7 +1281,7 @@ class LOFI(DBBase):
         # update the file_obj backing store
         self.file_obj = StringIO_(self._lofi_state['out'])
         # reparse the output
-        super(LOFI, self)._load_data()
+        super(LOFI, self)._reload()
 
 
 class DHCPData:
@@ -30,7 +30,9 @@ from optparse import OptionParser
 import gettext
 import sys
 import os
+import Queue
 import socket
+import threading
 import osol_install.auto_install.AI_database as AIdb
 import osol_install.libaiscf as smf
 import osol_install.auto_install.installadm_common as com
@@ -44,6 +46,9 @@ FDICT = {
     'crit':78 
 }
 
+# number of threads reading install services' databases at the same time
+LIST_THREADS = 8
+
 def parse_options():
     """
     Parses and validate options
@@ -54,7 +59,8 @@ def parse_options():
     Returns
         a dictionary of the valid options
 
-            { 'client':Bol, 'service':None/SName, 'manifest':Bol }
+            { 'client':Bol, 'service':None/SName, 'manifest':Bol,
+              'parsable':Bol }
     
     Raises
         None
@@ -63,8 +69,10 @@ def parse_options():
                 "Or, with -n option, lists a specific install service. "
                 "Or, with -c option, lists information about clients "
                 "of install services. " 
-                "Or, with -m option, lists the manifest information." )
-    usage = _("usage: installadm %prog [-n <servicename>] [-c] [-m]")
+                "Or, with -m option, lists the manifest information. "
+                "With -p option, the manifest information is listed "
+                "in a machine-parsable format." )
+    usage = _("usage: installadm %prog [-n <servicename>] [-c] [-m [-p]]")
 
     parser = OptionParser(usage = usage, description = desc)
 
@@ -80,13 +88,94 @@ def parse_options():
                 action = "store_true",
                 help = _("list manifest information"))
 
+    parser.add_option("-p", "--parsable", dest = "parsable",
+                default = False, action = "store_true",
+                help = _("list manifest information in a machine-parsable "
+                         "format"))
+
     (loptions, args) = parser.parse_args()
 
     if args != []:
         parser.error(_('unknown argument(s): %s') % args)
 
+    if loptions.parsable and not loptions.manifest:
+        parser.error(_('-p option requires -m option'))
+
     return loptions
 
+def map_services(function, services, threads = LIST_THREADS):
+    """
+    Calls function on each of services using a pool of threads, so that
+    slow services do not hold up the others.
+
+    Args
+        function = function taking a service
+        services = list of services
+
+    Returns
+        a generator providing for each service (in the order of services)
+        a (service, result of function, exception raised by function)
+        tuple, as soon as function has returned for the service and each
+        service before it
+
+    Raises
+        None
+    """
+    work = Queue.Queue()
+    done = Queue.Queue()
+    for index in range(len(services)):
+        work.put(index)
+
+    def worker():
+        """
+        Calls function on services from the work queue until it is empty
+        """
+        while True:
+            try:
+                index = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                done.put((index, function(services[index]), None))
+            except (Exception, SystemExit), err:
+                done.put((index, None, err))
+
+    pool = []
+    for i in range(min(threads, len(services))):
+        thread = threading.Thread(target = worker)
+        thread.setDaemon(True)
+        thread.start()
+        pool.append(thread)
+
+    results = {}
+    for index in range(len(services)):
+        while index not in results:
+            (finished, result, err) = done.get()
+            results[finished] = (result, err)
+        (result, err) = results.pop(index)
+        yield (services[index], result, err)
+
+    # the work queue is empty, so the threads are about to finish
+    for thread in pool:
+        thread.join()
+
+def parsable_line(fields):
+    """
+    Joins fields into a line of machine-parsable output.
+
+    Args
+        fields = list of strings
+
+    Returns
+        the fields separated by colons, with any colons or backslashes
+        within them escaped by a backslash
+
+    Raises
+        None
+    """
+    return ':'.join([field.replace('\\', '\\\\').replace(':', '\\:')
+                     for field in fields])
+
 def which_arch(path):
     """
     Looks to see if the platform pointed to by path is x86 or Sparc.
@@ -721,7 +810,7 @@ def list_local_clients(lservices, name = None):
     do_header(fields)
     print_clients(width, sdict)
 
-def list_local_manifests(linst, name = None):
+def list_local_manifests(linst, name = None, parsable = False):
     """
     list the local manifests.  If name is not passed in then
     print all the local manifests.  Otherwise list the named
@@ -730,6 +819,7 @@ def list_local_manifests(linst, name = None):
     Args
         inst = smf.AISCF()
         name = service name
+        parsable = list in machine-parsable format
 
     Returns
         None
@@ -737,29 +827,22 @@ def list_local_manifests(linst, name = None):
     Raises
         None
     """
-    def get_manifest_names(linst):
+    def get_services(linst):
         """
-        Iterate through the services from smf.AISCF() retrieving
-        all the stored manifest names.
+        Iterate through the services from smf.AISCF() finding their
+        AI databases.
 
         Args
             inst = smf.AISCF()
 
         Returns
-            a dictionary of service manifests within a list:
-
-                {
-                    servicename1:[ manifest1, manifest2, ...],
-                    ...
-                }
-
-            the width of the longest service name
+            a list of ( servicename, database path ) tuples, in service
+            name order
 
         Raises
             None
         """
-        width = 0
-        sdict = {}
+        services = []
         lservices = linst.services.keys()
         lservices.sort()
         for akey in lservices:
@@ -773,33 +856,57 @@ def list_local_manifests(linst, name = None):
                                 os.path.basename(sys.argv[0]))
                 sys.exit(1)
 
-            sname = serv['service_name']
             port = serv['txt_record'].split(':')[-1]
-            path = os.path.join('/var/ai', str(port), 'AI.db')
-            if os.path.exists(path):
-                try:
-                    maisql = AIdb.DB(path)
-                    maisql.verifyDBStructure()
-                    for name in AIdb.getManNames(maisql.getQueue()):
-                        width = max(len(sname), width)
-                        if sdict.has_key(sname):
-                            slist = sdict[sname]
-                            slist.extend([name])
-                            sdict[sname] = slist
-                        else:
-                            sdict[sname] = [name]
-                except Exception, err:
-                    sys.stderr.write(_('%s: error: AI database '
-                                       'access error\n%s\n') % \
-                                (os.path.basename(sys.argv[0]), err))
-                    sys.exit(1)
-            else:
-                sys.stderr.write(_('%s: error: unable to locate '
-                                   'AI database on server\n') % \
-                                os.path.basename(sys.argv[0]))
-                sys.exit(1)
+            services.append((serv['service_name'],
+                             os.path.join('/var/ai', str(port), 'AI.db')))
 
-        return sdict, width
+        return services
+
+    def get_manifest_names(services):
+        """
+        Retrieves the stored manifest names of each service.  The
+        databases of the services are read in parallel, each with one
+        query.
+
+        Args
+            services = list of ( servicename, database path ) tuples
+                       from get_services()
+
+        Returns
+            a generator providing for each service, in the order of
+            services as soon as its manifest names are read, a tuple:
+
+                ( servicename, [ manifest1, manifest2, ...] )
+
+            with None instead of the list if the service's database can
+            not be read (which is reported on stderr)
+
+        Raises
+            None
+        """
+        def read_manifest_names(service):
+            """
+            Returns the manifest names stored in the database of service,
+            or None if there is no database
+            """
+            path = service[1]
+            if not os.path.exists(path):
+                return None
+            maisql = AIdb.DB(path)
+            maisql.verifyDBStructure()
+            return list(AIdb.getManNames(maisql.getQueue()))
+
+        for service, names, err in map_services(read_manifest_names,
+                                                services):
+            if err is not None:
+                sys.stderr.write(_('%s: error: AI database '
+                                   'access error\n%s\n') % \
+                            (os.path.basename(sys.argv[0]), err))
+            elif names is None:
+                sys.stderr.write(_('%s: error: unable to locate '
+                                   'AI database on server for %s\n') % \
+                            (os.path.basename(sys.argv[0]), service[0]))
+            yield (service[0], names)
 
     def get_criteria_info(mancriteria):
         """
@@ -896,15 +1003,11 @@ def list_local_manifests(linst, name = None):
                     maisql = AIdb.DB(path)
                     maisql.verifyDBStructure()
                     aiqueue = maisql.getQueue()
-                    for name in AIdb.getManNames(aiqueue):
+                    for name, instances in AIdb.getManifestTable(aiqueue,
+                                            humanOutput = True,
+                                            onlyUsed = True):
                         sdict[name] = []
-                        instances = AIdb.numInstances(name, aiqueue)
-                        for instance in range(0, instances):
-                            criteria = AIdb.getManifestCriteria(name, 
-                                            instance, aiqueue, 
-                                            humanOutput = True, 
-                                            onlyUsed = True)
-    
+                        for criteria in instances:
                             width = max(len(name), width)
                             tdict, twidth = get_criteria_info(criteria)
                             cwidth = max(twidth, cwidth)
@@ -972,23 +1075,15 @@ def list_local_manifests(linst, name = None):
             else:
                 print 'None\n'
 
-    def print_local_manifests(sdict, width):
+    def print_local_manifests(sname, manifests, width):
         """
-        Iterates over the manifest name dictionary printing each
-        manifest within the dictionary.  The manifest name dictionary
-        is populated via get_manifest_names().
+        Prints each manifest of a service.  The manifest names are
+        provided by get_manifest_names().
 
         Args
-            sdict = service manifest dictionary
+            sname = service name
 
-                { 
-                    'servicename1':
-                        [
-                            manifestfile1,
-                            ...
-                        ],
-                    ...
-                }
+            manifests = list of the service's manifest names
 
             width = the length of the widest service name
 
@@ -998,33 +1093,84 @@ def list_local_manifests(linst, name = None):
         Raises
             None
         """
-        tkeys = sdict.keys()
-        tkeys.sort()
-        for akey in tkeys:
-            firstone = True
-            for manifest in sdict[akey]:
-                if firstone == True:
-                    print akey.ljust(width), manifest
-                    firstone = False
-                else:
-                    print ' '.ljust(width), manifest
+        firstone = True
+        for manifest in manifests:
+            if parsable:
+                print parsable_line([sname, manifest])
+            elif firstone == True:
+                print sname.ljust(width), manifest
+                firstone = False
+            else:
+                print ' '.ljust(width), manifest
+        # let a reader of a pipe see each service as it is listed
+        sys.stdout.flush()
+
+    def print_parsable_manifests(sdict):
+        """
+        Prints the manifest dictionary populated via
+        get_service_manifests() in machine-parsable format, one line
+        per criteria of each manifest instance:
+
+            manifest:instance:criteria:value
+
+        with a "manifest:instance::" line for an instance without
+        criteria.
+
+        Args
+            sdict = manifest criteria dictionary
+                    (same as in get_service_manifests() description)
+
+        Returns
+            None
+
+        Raises
+            None
+        """
+        snames = sdict.keys()
+        snames.sort()
+        for name in snames:
+            for instance in range(len(sdict[name])):
+                ldict = sdict[name][instance]
+                keys = [akey for akey in sorted(ldict.keys())
+                        if ldict[akey] != '']
+                if not keys:
+                    print parsable_line([name, str(instance), '', ''])
+                for akey in keys:
+                    print parsable_line([name, str(instance), akey,
+                                         ldict[akey]])
 
     # start of list_local_manifest()
     # list -m
     if not name:
-        sdict, width = get_manifest_names(linst)
-        if sdict == {}:
+        # service names are known before any database is read, so the
+        # output can be aligned as each service is listed
+        services = get_services(linst)
+        width = len(_('Service Name'))
+        for sname, path in services:
+            width = max(width, len(sname))
+
+        listed = False
+        failed = False
+        for sname, manifests in get_manifest_names(services):
+            if manifests is None:
+                failed = True
+                continue
+            if not manifests:
+                continue
+            if not listed and not parsable:
+                fields = [[_('Service Name'), width]]
+                fields.extend([[_('Manifest'), len(_('Manifest'))]])
+                do_header(fields)
+            listed = True
+            print_local_manifests(sname, manifests, width)
+
+        if failed:
+            sys.exit(1)
+        if not listed:
             estr = _('%s: error: no manifests for local service(s)\n') % \
                         os.path.basename(sys.argv[0])
             sys.stderr.write(estr)
             sys.exit(1)
-
-        width = max(width, len(_('Service Name')))
-        fields = [[_('Service Name'), width]]
-        fields.extend([[_('Manifest'), len(_('Manifest'))]])
-
-        do_header(fields)
-        print_local_manifests(sdict, width)
     # list -m -n <service>
     else:
         sdict, width, cwidth = get_service_manifests(name, linst)
@@ -1035,6 +1181,10 @@ def list_local_manifests(linst, name = None):
             sys.stderr.write(estr)
             sys.exit(1)
 
+        if parsable:
+            print_parsable_manifests(sdict)
+            return
+
         width = max(width, len(_('Manifest')))
         fields = [[_('Manifest'), width]]
         fields.extend([[_('Criteria'), len(_('Criteria'))]])
@@ -1074,4 +1224,5 @@ if __name__ == '__main__':
         if OPTIONS.manifest is True:
             if OPTIONS.client is True:
                 print
-            list_local_manifests(INST, name = OPTIONS.service)
+            list_local_manifests(INST, name = OPTIONS.service,
+                                 parsable = OPTIONS.parsable)
@@ -357,6 +357,18 @@ start_ai_webserver()
 		fi
 	fi
 
+	#
+	# A webserver serving every install service (run with -a) serves
+	# this one once it is enabled, so no webserver of its own is started
+	#
+	if [ $ret -eq 0 ] ; then
+		ps -ef | grep "$AIWEBSERVER_PROGRAM" | grep -- " -a" | \
+		    grep -v grep > /dev/null 2>&1
+		if [ $? -eq 0 ]; then
+			return 0
+		fi
+	fi
+
 	if [ $ret -eq 0 ] ; then
 		# Start the webserver
 		$AIWEBSERVER_PROGRAM -p $port $data_dir > $log 2>&1 &
@@ -379,9 +391,10 @@ stop_ai_webserver()
 	port=$1
 
 	# Search the processes to find the webserver that is using $port
-	# and kill the process
+	# and kill the process (a webserver serving every install service,
+	# run with -a, stops serving this one once it is disabled)
 
-	webpid=`ps -ef | grep "$AIWEBSERVER_PROGRAM" | grep "$port" |  nawk '{ print $2 }'`
+	webpid=`ps -ef | grep "$AIWEBSERVER_PROGRAM" | grep -v -- " -a" | grep "$port" |  nawk '{ print $2 }'`
 	if [ "X${webpid}" !=  X ]; then
 		kill $webpid > /dev/null 2>&1
 	fi
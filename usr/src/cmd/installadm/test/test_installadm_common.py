@@ -0,0 +1,264 @@
+#!/usr/bin/python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+# Copyright (c) 2010, Oracle and/or its affiliates. All rights reserved.
+#
+
+'''
+To run these tests, see the instructions in usr/src/tools/tests/README.
+Remember that since the proto area is used for the PYTHONPATH, the gate
+must be rebuilt for these tests to pick up any changes in the tested code.
+
+'''
+
+import gettext
+import os
+import shutil
+import tempfile
+import unittest
+import osol_install.auto_install.installadm_common as com
+
+
+gettext.install("ai-test")
+
+VFSTAB = ("#device\tdevice\tmount\tFS\tfsck\tmount\tmount\n"
+          "/dev/dsk/c0t0d0s1\t-\t-\tswap\t-\tno\t-\n"
+          "/net/a/b\t-\t/mnt/a\tnfs\t-\tyes\tro\n"
+          "/net/c/d\t-\t/mnt/c\tnfs\t-\tyes\tro\n")
+
+NFS = ["/net/e/f", "-", "/mnt/e", "nfs", "-", "yes", "ro"]
+
+
+class VFSTabFile(unittest.TestCase):
+    '''Tests for DBBase edits of a file backed store (VFSTab)'''
+
+    def setUp(self):
+        '''unit test set up'''
+        self.dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.dir, "vfstab")
+        vfstab = open(self.file_name, "w")
+        vfstab.write(VFSTAB)
+        vfstab.close()
+        os.chmod(self.file_name, 0644)
+        self.vfstab = com.VFSTab(file_name=self.file_name, mode="r+")
+
+    def tearDown(self):
+        '''unit test tear down'''
+        self.vfstab.file_obj.close()
+        shutil.rmtree(self.dir)
+
+    def contents(self):
+        '''Return the contents of the file'''
+        return open(self.file_name).read()
+
+    def count_rewrites(self):
+        '''Count the calls to the vfstab's _rewrite() in self.rewrites'''
+        self.rewrites = 0
+        rewrite = self.vfstab._rewrite
+        def counted(lines):
+            '''Count then call _rewrite()'''
+            self.rewrites += 1
+            rewrite(lines)
+        self.vfstab._rewrite = counted
+
+    def test_find(self):
+        '''Verify find() returns the records holding all the values'''
+        rows = self.vfstab.find(FS_TYPE="nfs")
+        self.assertEqual([row.MOUNT_POINT for row in rows],
+                         ["/mnt/a", "/mnt/c"])
+        rows = self.vfstab.find(FS_TYPE="nfs", MOUNT_POINT="/mnt/c")
+        self.assertEqual([row.DEVICE for row in rows], ["/net/c/d"])
+        self.assertEqual(self.vfstab.find(FS_TYPE="ufs"), [])
+        self.assertTrue("/mnt/a" in self.vfstab.fields.MOUNT_POINT)
+        self.assertEqual(self.vfstab.fields.FS_TYPE.count("nfs"), 2)
+        self.assertRaises(KeyError, self.vfstab.find, NO_FIELD="nfs")
+
+    def test_append_delete(self):
+        '''Verify append() and delete() rewrite the file keeping comments'''
+        self.vfstab.append(NFS)
+        self.assertTrue(self.contents().endswith("\t".join(NFS) + "\n"))
+        self.vfstab.delete(*self.vfstab.find(FS_TYPE="nfs"))
+        self.assertEqual(self.contents(),
+                         VFSTAB.split("/net/a/b")[0])
+        self.assertEqual(self.vfstab.fields.FS_TYPE, ["swap"])
+        self.assertRaises(ValueError, self.vfstab.append, NFS[:-1])
+
+    def test_delitem(self):
+        '''Verify deleting from a field removes the record from the file'''
+        index = self.vfstab.fields.MOUNT_POINT.index("/mnt/a")
+        del self.vfstab.fields.MOUNT_POINT[index]
+        self.assertFalse("/net/a/b" in self.contents())
+        self.assertEqual(self.vfstab.fields.MOUNT_POINT, ["-", "/mnt/c"])
+
+    def test_delete_stale(self):
+        '''Verify deleting a record no longer in the file raises'''
+        row = self.vfstab.find(MOUNT_POINT="/mnt/a")[0]
+        self.vfstab.delete(row)
+        self.assertRaises(ValueError, self.vfstab.delete, row)
+
+    def test_batch(self):
+        '''Verify the edits of a batch are written in one rewrite'''
+        self.count_rewrites()
+        with self.vfstab.batch():
+            self.vfstab.delete(*self.vfstab.find(MOUNT_POINT="/mnt/a"))
+            self.vfstab.append(NFS)
+            # nothing is written until the batch ends
+            self.assertEqual(self.contents(), VFSTAB)
+        self.assertEqual(self.rewrites, 1)
+        self.assertEqual(self.vfstab.fields.MOUNT_POINT,
+                         ["-", "/mnt/c", "/mnt/e"])
+        self.assertFalse("/net/a/b" in self.contents())
+        self.assertTrue("/net/e/f" in self.contents())
+
+    def test_batch_rollback(self):
+        '''Verify the edits of a batch ending on an exception are dropped'''
+        self.count_rewrites()
+        inode = os.stat(self.file_name).st_ino
+        def edit():
+            '''Edit the file in a batch then fail'''
+            with self.vfstab.batch():
+                self.vfstab.delete(*self.vfstab.find(FS_TYPE="nfs"))
+                self.vfstab.append(NFS)
+                raise RuntimeError("edit failed")
+        self.assertRaises(RuntimeError, edit)
+        self.assertEqual(self.rewrites, 0)
+        self.assertEqual(self.contents(), VFSTAB)
+        self.assertEqual(os.stat(self.file_name).st_ino, inode)
+        self.assertEqual(self.vfstab.fields.MOUNT_POINT,
+                         ["-", "/mnt/a", "/mnt/c"])
+        # the next edit is not part of the failed batch
+        self.vfstab.append(NFS)
+        self.assertEqual(self.rewrites, 1)
+        self.assertEqual(self.vfstab.fields.MOUNT_POINT,
+                         ["-", "/mnt/a", "/mnt/c", "/mnt/e"])
+
+    def test_rewrite_replaces(self):
+        '''Verify a rewrite renames a new file over the file'''
+        old_file = open(self.file_name)
+        self.vfstab.append(NFS)
+        # the old file is left as it was for readers which have it open
+        self.assertEqual(old_file.read(), VFSTAB)
+        self.assertNotEqual(os.fstat(old_file.fileno()).st_ino,
+                            os.stat(self.file_name).st_ino)
+        old_file.close()
+        self.assertEqual(os.listdir(self.dir), ["vfstab"])
+        # the file is reopened read/write so it can be edited again
+        self.assertEqual(self.vfstab.file_obj.mode, "r+")
+        self.assertEqual(os.fstat(self.vfstab.file_obj.fileno()).st_ino,
+                         os.stat(self.file_name).st_ino)
+        self.vfstab.delete(*self.vfstab.find(MOUNT_POINT="/mnt/e"))
+        self.assertEqual(self.contents(), VFSTAB)
+
+    def test_rewrite_mode(self):
+        '''Verify a rewrite keeps the file's permissions'''
+        os.chmod(self.file_name, 0640)
+        self.vfstab.append(NFS)
+        self.assertEqual(os.stat(self.file_name).st_mode & 0777, 0640)
+
+    @unittest.skipUnless(os.getuid() == 0, "requires root to chown")
+    def test_rewrite_owner(self):
+        '''Verify a rewrite keeps the file's owner and group'''
+        os.chown(self.file_name, 1, 1)
+        self.vfstab.append(NFS)
+        file_stat = os.stat(self.file_name)
+        self.assertEqual((file_stat.st_uid, file_stat.st_gid), (1, 1))
+
+    def test_rewrite_read_only(self):
+        '''Verify a file opened read only is not rewritten'''
+        vfstab = com.VFSTab(file_name=self.file_name)
+        self.assertRaises(AssertionError, vfstab.append, NFS)
+        vfstab.file_obj.close()
+        self.assertEqual(self.contents(), VFSTAB)
+        self.assertEqual(os.listdir(self.dir), ["vfstab"])
+
+    def test_reopen(self):
+        '''Verify another instance's rewrite of the file is seen'''
+        reader = com.VFSTab(file_name=self.file_name)
+        self.assertEqual(reader.find(MOUNT_POINT="/mnt/e"), [])
+        self.vfstab.append(NFS)
+        # the rewrite is within the mtime's second (and _STAT_INTERVAL) of
+        # the reader's load, so only the file's replacement shows it
+        reader._checked = 0
+        self.assertEqual([row.DEVICE for row in
+                          reader.find(MOUNT_POINT="/mnt/e")], ["/net/e/f"])
+        self.assertEqual(os.fstat(reader.file_obj.fileno()).st_ino,
+                         os.stat(self.file_name).st_ino)
+        # a store opened read only is reopened read only
+        self.assertEqual(reader.file_obj.mode, "r")
+        reader.file_obj.close()
+
+    def test_reopen_edit(self):
+        '''Verify edits apply to the file as another instance left it'''
+        other = com.VFSTab(file_name=self.file_name, mode="r+")
+        other.append(NFS)
+        # both edits land within the same mtime second
+        self.vfstab.delete(*self.vfstab.find(MOUNT_POINT="/mnt/a"))
+        other.file_obj.close()
+        self.assertEqual(self.vfstab.fields.MOUNT_POINT,
+                         ["-", "/mnt/c", "/mnt/e"])
+        self.assertTrue("/net/e/f" in self.contents())
+        self.assertFalse("/net/a/b" in self.contents())
+
+
+class StringDBBase(com.DBBase):
+    '''A DBBase of name and value records'''
+    _NAME = "name"
+    _VALUE = "value"
+
+    _headers = [_NAME, _VALUE]
+
+    _fields = [obj.lstrip("_") for obj in locals().keys()
+        if obj.isupper() and locals()[obj] is not None]
+
+
+class StringStore(unittest.TestCase):
+    '''Tests for DBBase edits of a StringIO backed store'''
+
+    def setUp(self):
+        '''unit test set up'''
+        self.store = StringDBBase(data="# names\na\t1\nb\t2\n")
+
+    def test_parse(self):
+        '''Verify the string's records are loaded'''
+        self.assertEqual(self.store.fields.NAME, ["a", "b"])
+        self.assertEqual(self.store.find(VALUE="2")[0].NAME, "b")
+
+    def test_edit(self):
+        '''Verify edits replace the string's data'''
+        self.store.append(["c", "3"])
+        self.store.delete(*self.store.find(NAME="a"))
+        self.assertEqual(self.store.file_obj.raw, "# names\nb\t2\nc\t3\n")
+        self.assertEqual(self.store.fields.NAME, ["b", "c"])
+
+    def test_batch_rollback(self):
+        '''Verify the edits of a batch ending on an exception are dropped'''
+        def edit():
+            '''Edit the store in a batch then fail'''
+            with self.store.batch():
+                self.store.append(["c", "3"])
+                raise RuntimeError("edit failed")
+        self.assertRaises(RuntimeError, edit)
+        self.assertEqual(self.store.file_obj.raw, "# names\na\t1\nb\t2\n")
+        self.assertEqual(self.store.fields.NAME, ["a", "b"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+# Copyright (c) 2010, Oracle and/or its affiliates. All rights reserved.
+#
+
+'''
+To run these tests, see the instructions in usr/src/tools/tests/README.
+Remember that since the proto area is used for the PYTHONPATH, the gate
+must be rebuilt for these tests to pick up any changes in the tested code.
+
+'''
+
+import gettext
+import threading
+import unittest
+import list as installadm_list
+
+
+gettext.install("ai-test")
+
+class MapServices(unittest.TestCase):
+    '''Tests for map_services()'''
+
+    def test_order(self):
+        '''Verify results are in service order when later ones finish first'''
+        services = range(6)
+        finished = []
+        events = [threading.Event() for service in services]
+        # each service waits for the one after it, so they finish last to
+        # first
+        events[-1].set()
+        def function(service):
+            '''Finish service once the service after it has'''
+            events[service].wait(5)
+            finished.append(service)
+            if service:
+                events[service - 1].set()
+            return service * 10
+        results = list(installadm_list.map_services(function, services,
+                                                    threads=len(services)))
+        self.assertEqual(finished, services[::-1])
+        self.assertEqual(results, [(service, service * 10, None)
+                                   for service in services])
+
+    def test_threads(self):
+        '''Verify every service is mapped with fewer threads than services'''
+        services = ["svc%d" % number for number in range(20)]
+        results = list(installadm_list.map_services(str.upper, services,
+                                                    threads=3))
+        self.assertEqual(results, [(service, service.upper(), None)
+                                   for service in services])
+
+    def test_exceptions(self):
+        '''Verify exceptions raised for a service are returned as its err'''
+        def function(service):
+            '''Fail for some services'''
+            if service == "error":
+                raise ValueError(service)
+            if service == "exit":
+                raise SystemExit(1)
+            return service
+        services = ["a", "error", "b", "exit", "c"]
+        results = list(installadm_list.map_services(function, services))
+        self.assertEqual([service for (service, result, err) in results],
+                         services)
+        for (service, result, err) in results:
+            if service == "error":
+                self.assertTrue(isinstance(err, ValueError))
+                self.assertEqual(result, None)
+            elif service == "exit":
+                self.assertTrue(isinstance(err, SystemExit))
+                self.assertEqual(result, None)
+            else:
+                self.assertEqual((result, err), (service, None))
+
+    def test_empty(self):
+        '''Verify no services map to no results'''
+        self.assertEqual(list(installadm_list.map_services(str, [])), [])
+
+
+class ParsableLine(unittest.TestCase):
+    '''Tests for parsable_line()'''
+
+    def test_plain(self):
+        '''Verify fields are joined by colons'''
+        self.assertEqual(installadm_list.parsable_line(["a", "b", ""]),
+                         "a:b:")
+
+    def test_escape(self):
+        '''Verify colons and backslashes within fields are escaped'''
+        self.assertEqual(installadm_list.parsable_line(
+                         ["a:b", "c\\d", "e\\:f"]),
+                         "a\\:b:c\\\\d:e\\\\\\:f")
+        self.assertEqual(installadm_list.parsable_line(["\\", ":"]),
+                         "\\\\:\\:")
+
+
+if __name__ == '__main__':
+    unittest.main()